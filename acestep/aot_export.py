@@ -0,0 +1,331 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Ahead-of-time compiled ACEStepTransformer2DModel encode/decode.
+
+torch.export traces encode and decode with dynamic batch, latent, text and lyric
+lengths, and AOTInductor compiles them into packages that ACEStepPipeline loads
+with aot_transformer_dir, skipping Python dispatch and JIT compilation:
+
+    python -m acestep.aot_export --checkpoint_path ./checkpoints --output_dir ./aot_transformer
+
+The ERG diffusion hooks are built into the exported decode as a per-sample query
+scale. Packages are compiled for one device type and dtype, see metadata.json.
+"""
+
+import json
+import os
+import time
+
+import click
+import torch
+from loguru import logger
+from torch import nn
+
+from acestep.models.ace_step_transformer import (
+    ACEStepTransformer2DModel,
+    Transformer2DModelOutput,
+)
+
+
+DECODE_PACKAGE = "decode.pt2"
+ENCODE_PACKAGE = "encode.pt2"
+METADATA = "metadata.json"
+
+# blocks whose queries use_erg_diffusion scales, see text2music_diffusion_process
+ERG_DIFFUSION_BLOCKS = range(15, 20)
+
+
+class ExportableDecode(nn.Module):
+    """decode with a tensor-only signature; query_scale (B,) multiplies the ERG block queries."""
+
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask,
+        encoder_hidden_states,
+        encoder_hidden_mask,
+        timestep,
+        query_scale,
+    ):
+        def hook(module, input, output):
+            return output * query_scale[:, None, None].to(output.dtype)
+
+        handles = []
+        for i in ERG_DIFFUSION_BLOCKS:
+            if i < len(self.transformer.transformer_blocks):
+                block = self.transformer.transformer_blocks[i]
+                handles.append(block.attn.to_q.register_forward_hook(hook))
+                handles.append(block.cross_attn.to_q.register_forward_hook(hook))
+        try:
+            return self.transformer.decode(
+                hidden_states=hidden_states,
+                attention_mask=attention_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_hidden_mask=encoder_hidden_mask,
+                output_length=hidden_states.shape[-1],
+                timestep=timestep,
+                return_dict=False,
+            )[0]
+        finally:
+            for handle in handles:
+                handle.remove()
+
+
+class ExportableEncode(nn.Module):
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(
+        self,
+        encoder_text_hidden_states,
+        text_attention_mask,
+        speaker_embeds,
+        lyric_token_idx,
+        lyric_mask,
+    ):
+        return self.transformer.encode(
+            encoder_text_hidden_states,
+            text_attention_mask,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+        )
+
+
+def example_inputs(transformer, device, dtype, batch_size=2, frame_length=64, text_length=16, lyric_length=32):
+    """Random encode and decode inputs, with lengths away from the 0/1 specializations."""
+    config = transformer.config
+    encode_inputs = (
+        torch.randn(batch_size, text_length, config.text_embedding_dim, device=device, dtype=dtype),
+        torch.ones(batch_size, text_length, device=device, dtype=torch.long),
+        torch.zeros(batch_size, config.speaker_embedding_dim, device=device, dtype=dtype),
+        torch.randint(0, config.lyric_encoder_vocab_size, (batch_size, lyric_length), device=device),
+        torch.ones(batch_size, lyric_length, device=device, dtype=torch.long),
+    )
+    with torch.no_grad():
+        encoder_hidden_states, encoder_hidden_mask = ExportableEncode(transformer)(*encode_inputs)
+    decode_inputs = (
+        torch.randn(batch_size, config.in_channels, 16, frame_length, device=device, dtype=dtype),
+        torch.ones(batch_size, frame_length, device=device, dtype=dtype),
+        encoder_hidden_states,
+        encoder_hidden_mask,
+        torch.full((batch_size,), 500.0, device=device, dtype=dtype),
+        torch.ones(batch_size, device=device, dtype=dtype),
+    )
+    return encode_inputs, decode_inputs
+
+
+def export_transformer(transformer, output_dir, device, dtype, max_frame_length=4096):
+    """Exports and AOT compiles encode and decode of `transformer` into output_dir."""
+    os.makedirs(output_dir, exist_ok=True)
+    transformer = transformer.to(device=device, dtype=dtype).eval()
+    encode_inputs, decode_inputs = example_inputs(transformer, device, dtype)
+
+    batch = torch.export.Dim("batch", min=1, max=64)
+    frames = torch.export.Dim("frames", min=2, max=max_frame_length)
+    encoder_length = torch.export.Dim("encoder_length", min=2, max=8192)
+    text_length = torch.export.Dim("text_length", min=2, max=1024)
+    lyric_length = torch.export.Dim("lyric_length", min=2, max=8192)
+
+    packages = {
+        ENCODE_PACKAGE: (
+            ExportableEncode(transformer),
+            encode_inputs,
+            (
+                {0: batch, 1: text_length},
+                {0: batch, 1: text_length},
+                {0: batch},
+                {0: batch, 1: lyric_length},
+                {0: batch, 1: lyric_length},
+            ),
+        ),
+        DECODE_PACKAGE: (
+            ExportableDecode(transformer),
+            decode_inputs,
+            (
+                {0: batch, 3: frames},
+                {0: batch, 1: frames},
+                {0: batch, 1: encoder_length},
+                {0: batch, 1: encoder_length},
+                {0: batch},
+                {0: batch},
+            ),
+        ),
+    }
+    for package, (module, inputs, dynamic_shapes) in packages.items():
+        start_time = time.time()
+        with torch.no_grad():
+            exported = torch.export.export(module, inputs, dynamic_shapes=dynamic_shapes, strict=False)
+            torch._inductor.aoti_compile_and_package(
+                exported, package_path=os.path.join(output_dir, package)
+            )
+        logger.info(f"Compiled {package} in {time.time() - start_time:.2f} seconds")
+
+    with open(os.path.join(output_dir, METADATA), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "device": torch.device(device).type,
+                "dtype": str(dtype),
+                "max_frame_length": max_frame_length,
+                "num_layers": len(transformer.transformer_blocks),
+                "torch": torch.__version__,
+            },
+            f,
+            indent=4,
+        )
+    return output_dir
+
+
+class AOTTransformer:
+    """
+    Runs encode/decode from AOTInductor packages with the ACEStepTransformer2DModel API.
+
+    Only plain calls are supported: hooks (ERG lyric), LoRA adapters or padded
+    inputs need the eager model. ERG diffusion is passed as query_scale instead.
+    """
+
+    def __init__(self, package_dir):
+        with open(os.path.join(package_dir, METADATA), encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self.device_type = self.metadata["device"]
+        self.dtype = getattr(torch, self.metadata["dtype"].replace("torch.", ""))
+        self.max_frame_length = self.metadata["max_frame_length"]
+        self._encode = torch._inductor.aoti_load_package(os.path.join(package_dir, ENCODE_PACKAGE))
+        self._decode = torch._inductor.aoti_load_package(os.path.join(package_dir, DECODE_PACKAGE))
+
+    def supports(self, device, dtype):
+        return torch.device(device).type == self.device_type and dtype == self.dtype
+
+    def encode(
+        self,
+        encoder_text_hidden_states,
+        text_attention_mask,
+        speaker_embeds,
+        lyric_token_idx,
+        lyric_mask,
+    ):
+        return self._encode(
+            encoder_text_hidden_states,
+            text_attention_mask,
+            speaker_embeds,
+            lyric_token_idx,
+            lyric_mask,
+        )
+
+    def decode(
+        self,
+        hidden_states,
+        attention_mask,
+        encoder_hidden_states,
+        encoder_hidden_mask,
+        timestep,
+        output_length=0,
+        query_scale=None,
+    ):
+        if output_length and output_length != hidden_states.shape[-1]:
+            raise ValueError("AOT decode does not support padded inputs")
+        if query_scale is None:
+            query_scale = hidden_states.new_ones(hidden_states.shape[0])
+        sample = self._decode(
+            hidden_states,
+            attention_mask,
+            encoder_hidden_states,
+            encoder_hidden_mask,
+            timestep,
+            query_scale,
+        )
+        return Transformer2DModelOutput(sample=sample, proj_losses=None)
+
+
+@torch.no_grad()
+def compare_with_eager(transformer, aot_transformer, device, dtype, frame_length=96, text_length=24, lyric_length=40):
+    """
+    Max abs difference between eager and AOT encode/decode, at lengths other than the
+    ones used for export, with ERG scaling on the second half of the batch.
+    """
+    transformer = transformer.to(device=device, dtype=dtype).eval()
+    encode_inputs, decode_inputs = example_inputs(
+        transformer, device, dtype, batch_size=2, frame_length=frame_length, text_length=text_length, lyric_length=lyric_length
+    )
+    eager_states, eager_mask = transformer.encode(*encode_inputs)
+    aot_states, aot_mask = aot_transformer.encode(*encode_inputs)
+
+    hidden_states, attention_mask, encoder_hidden_states, encoder_hidden_mask, timestep, _ = decode_inputs
+    query_scale = torch.tensor([1.0, 0.01], device=device, dtype=dtype)
+
+    def hook(module, input, output):
+        output[1:] *= 0.01
+        return output
+
+    handles = []
+    for i in ERG_DIFFUSION_BLOCKS:
+        if i < len(transformer.transformer_blocks):
+            block = transformer.transformer_blocks[i]
+            handles.append(block.attn.to_q.register_forward_hook(hook))
+            handles.append(block.cross_attn.to_q.register_forward_hook(hook))
+    try:
+        eager_sample = transformer.decode(
+            hidden_states=hidden_states,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_hidden_mask=encoder_hidden_mask,
+            output_length=hidden_states.shape[-1],
+            timestep=timestep,
+        ).sample
+    finally:
+        for handle in handles:
+            handle.remove()
+    aot_sample = aot_transformer.decode(
+        hidden_states,
+        attention_mask,
+        encoder_hidden_states,
+        encoder_hidden_mask,
+        timestep,
+        query_scale=query_scale,
+    ).sample
+
+    return {
+        "encode": (eager_states.float() - aot_states.float()).abs().max().item(),
+        "encode_mask": (eager_mask.float() - aot_mask.float()).abs().max().item(),
+        "decode": (eager_sample.float() - aot_sample.float()).abs().max().item(),
+    }
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, required=True, help="Checkpoint directory containing ace_step_transformer")
+@click.option("--output_dir", type=str, required=True, help="Directory to write the AOT packages to")
+@click.option("--device", type=str, default="cpu", help="Device the packages are compiled for")
+@click.option("--bf16", type=bool, default=False, help="Whether to use bfloat16")
+@click.option("--max_frame_length", type=int, default=4096, help="Largest latent length the decode package accepts")
+@click.option("--check_parity", type=bool, default=True, help="Compare the packages against the eager model")
+@click.option("--tolerance", type=float, default=None, help="Fail if the parity difference exceeds this")
+def main(checkpoint_path, output_dir, device, bf16, max_frame_length, check_parity, tolerance):
+    dtype = torch.bfloat16 if bf16 else torch.float32
+    transformer = ACEStepTransformer2DModel.from_pretrained(
+        os.path.join(checkpoint_path, "ace_step_transformer"), torch_dtype=dtype
+    )
+    export_transformer(transformer, output_dir, device, dtype, max_frame_length=max_frame_length)
+    if not check_parity:
+        return
+    differences = compare_with_eager(transformer, AOTTransformer(output_dir), device, dtype)
+    logger.info(f"Max abs difference to eager: {differences}")
+    if tolerance is None:
+        tolerance = 1e-2 if bf16 else 1e-3
+    if max(differences.values()) > tolerance:
+        raise click.ClickException(
+            f"AOT packages differ from the eager model by more than {tolerance}: {differences}"
+        )
+
+
+if __name__ == "__main__":
+    main()
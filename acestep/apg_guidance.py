@@ -11,6 +11,76 @@ class MomentumBuffer:
         self.running_average = update_value + new_average
 
 
+class AdaptiveGuidanceTruncation:
+    """
+    Ends guidance early once it has converged: after the conditional and unconditional
+    predictions stayed within `threshold` (relative L2 norm of pred_cond - pred_uncond)
+    for `patience` consecutive steps, `truncated` is set and the remaining steps only
+    evaluate the condition. The distance does not depend on the guidance scale or
+    cfg_type, so one threshold means the same for all of them.
+
+    The distances stay on the device and are read back every `check_interval` steps,
+    so truncation starts at most `check_interval - 1` steps after convergence.
+
+    Truncated steps use the conditional prediction as is: APG momentum is no longer
+    updated and guidance_interval_decay no longer applies to them.
+    """
+
+    def __init__(self, threshold: float = 0.05, patience: int = 3, check_interval: int = 4):
+        self.threshold = threshold
+        self.patience = patience
+        self.check_interval = check_interval
+        self.converged_steps = 0
+        self.truncated_at = None
+        self.passes_saved = 0
+        self.deltas = []
+        # (step, device tensor) not read back yet
+        self._pending = []
+
+    @property
+    def truncated(self):
+        return self.truncated_at is not None
+
+    def update(self, step: int, pred_cond: torch.Tensor, pred_uncond: torch.Tensor):
+        bsz = pred_cond.shape[0]
+        pred_cond = pred_cond.float().reshape(bsz, -1)
+        pred_uncond = pred_uncond.float().reshape(bsz, -1)
+        # every sample in the batch has to converge
+        delta = (
+            (pred_cond - pred_uncond).norm(dim=1)
+            / pred_cond.norm(dim=1).clamp(min=1e-8)
+        ).max()
+        self._pending.append((step, delta))
+        if len(self._pending) >= self.check_interval:
+            self._check(step)
+
+    def _check(self, step=None):
+        if not self._pending:
+            return
+        # one device to host copy for all pending steps
+        values = torch.stack([delta for _, delta in self._pending]).tolist()
+        for (pending_step, _), delta in zip(self._pending, values):
+            self.deltas.append({"step": pending_step, "delta": delta})
+            self.converged_steps = self.converged_steps + 1 if delta < self.threshold else 0
+        self._pending = []
+        if step is not None and not self.truncated and self.converged_steps >= self.patience:
+            self.truncated_at = step + 1
+
+    def skip(self, passes: int):
+        self.passes_saved += passes
+
+    def summary(self):
+        self._check()
+        return {
+            "threshold": self.threshold,
+            "patience": self.patience,
+            "check_interval": self.check_interval,
+            "truncated_at_step": self.truncated_at,
+            "passes_saved": self.passes_saved,
+            "deltas": self.deltas,
+        }
+
+
 def project(
     v0: torch.Tensor,  # [B, C, H, W]
     v1: torch.Tensor,  # [B, C, H, W]
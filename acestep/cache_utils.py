@@ -0,0 +1,127 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from loguru import logger
+from safetensors.torch import load_file, save_file
+
+
+def hash_key(key):
+    """Stable hex digest of a cache key made of strings, numbers and tuples."""
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe bounded mapping that evicts the least recently used entry.
+
+    A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class DiskCache:
+    """
+    Persisted tier for tensor dicts, one safetensors file per key.
+
+    Entries are written atomically and never evicted; remove the directory to reset.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{hash_key(key)}.safetensors")
+
+    def get(self, key, device="cpu"):
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            tensors = load_file(path, device=str(device))
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tensors
+
+    def put(self, key, tensors):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        save_file(
+            {name: tensor.detach().contiguous().cpu() for name, tensor in tensors.items()},
+            tmp_path,
+        )
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,43 +1,318 @@
-import torch
-import functools
-from typing import Callable, TypeVar
-
-
-class CpuOffloader:
-    def __init__(self, model, device="cpu"):
-        self.model = model
-        self.original_device = device
-        self.original_dtype = model.dtype
-    
-    def __enter__(self):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to(self.original_device, dtype=self.original_dtype)
-        return self.model
-    
-    def __exit__(self, *args):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to("cpu")
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-
-
-T = TypeVar('T')
-
-def cpu_offload(model_attr: str):
-    def decorator(func: Callable[..., T]) -> Callable[..., T]:
-        @functools.wraps(func)
-        def wrapper(self, *args, **kwargs):
-            if not self.cpu_offload:
-                return func(self, *args, **kwargs)
-
-            # Get the device from the class
-            device = self.device
-            # Get the model from the class attribute
-            model = getattr(self, model_attr)
-            
-            with CpuOffloader(model, device):
-                return func(self, *args, **kwargs)
-                        
-        return wrapper
-    return decorator
+import torch
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+from loguru import logger
+
+
+def keeps_placement(model):
+    # quantized models are placed when loaded and never moved by offloading
+    return hasattr(model, "torchao_quantized") or hasattr(model, "int8_quantized")
+
+
+class CpuOffloader:
+    def __init__(self, model, device="cpu"):
+        self.model = model
+        self.original_device = device
+
+    def __enter__(self):
+        if not keeps_placement(self.model):
+            # components may keep different dtypes (MusicDCAE.set_dtypes), only the device changes
+            self.model.to(self.original_device)
+        return self.model
+
+    def __exit__(self, *args):
+        if not keeps_placement(self.model):
+            self.model.to("cpu")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
+
+
+class _OffloadedModel:
+    def __init__(self, model):
+        self.model = model
+        # qualified tensor name -> pinned host copy
+        self.pinned = {}
+        self.resident = False
+        self.in_use = 0
+        self.ready_event = None
+        self.last_used = 0.0
+
+    def tensors(self):
+        seen = set()
+        for name, tensor in self.model.named_parameters(remove_duplicate=False):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                yield name, tensor
+        for name, tensor in self.model.named_buffers(remove_duplicate=False):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                yield name, tensor
+
+    def nbytes(self):
+        return sum(tensor.numel() * tensor.element_size() for _, tensor in self.tensors())
+
+    def upload(self, device, stream):
+        """Issues non-blocking copies of the pinned weights to `device` on `stream`."""
+        compute_stream = torch.cuda.current_stream(device)
+        names = set()
+        with torch.cuda.stream(stream):
+            for name, tensor in self.tensors():
+                names.add(name)
+                if tensor.device == device:
+                    continue
+                pinned = self.pinned.get(name)
+                if pinned is None or pinned.shape != tensor.shape or pinned.dtype != tensor.dtype:
+                    pinned = tensor.data if tensor.data.is_pinned() else tensor.data.pin_memory()
+                    self.pinned[name] = pinned
+                device_tensor = pinned.to(device, non_blocking=True)
+                # allocated on the side stream but used on the compute stream
+                device_tensor.record_stream(compute_stream)
+                tensor.data = device_tensor
+        for name in set(self.pinned) - names:
+            del self.pinned[name]
+        self.ready_event = torch.cuda.Event()
+        self.ready_event.record(stream)
+        self.resident = True
+
+    def evict(self, device):
+        """Points the weights back at their pinned host copies."""
+        for name, tensor in self.tensors():
+            if tensor.device != device:
+                continue
+            pinned = self.pinned.get(name)
+            if pinned is None or pinned.shape != tensor.shape or pinned.dtype != tensor.dtype:
+                # created or replaced on the device since the upload
+                pinned = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                pinned.copy_(tensor.data)
+                self.pinned[name] = pinned
+            tensor.data = pinned
+        self.resident = False
+        self.ready_event = None
+
+    def wait(self, device):
+        if self.ready_event is not None:
+            torch.cuda.current_stream(device).wait_event(self.ready_event)
+
+
+class OffloadManager:
+    """
+    Moves whole models between pinned host memory and a CUDA device.
+
+    Host copies are pinned once, uploads are issued as non-blocking copies on a side
+    stream, and the compute stream only waits for them when the model is used, so a
+    model can be prefetched while another stage runs. Weights are treated as read-only:
+    eviction points parameters back at their pinned copies without copying back, except
+    for tensors created on the device since the last upload (e.g. LoRA adapters).
+
+    Released models stay resident until another model needs the memory, so consecutive
+    requests that use the same model do not pay for a round trip. The residency check
+    only counts weights, so stages whose activations dwarf their weights (the DCAE and
+    vocoder decode) are used `exclusive`ly: every other idle model is evicted first.
+    """
+
+    def __init__(self, device, memory_margin_mb=1024):
+        self.device = torch.device(device)
+        self.memory_margin = memory_margin_mb * 1024 ** 2
+        self.stream = torch.cuda.Stream(self.device)
+        self.models = {}
+        self._lock = threading.RLock()
+
+    def _state(self, model):
+        state = self.models.get(id(model))
+        if state is None or state.model is not model:
+            state = _OffloadedModel(model)
+            self.models[id(model)] = state
+            state.resident = next(model.parameters()).device == self.device
+        return state
+
+    def _available_memory(self):
+        free, _ = torch.cuda.mem_get_info(self.device)
+        cached = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return free + cached - self.memory_margin
+
+    def _evict(self, state):
+        start_time = time.time()
+        state.evict(self.device)
+        logger.debug(f"Offloaded {type(state.model).__name__} in {time.time() - start_time:.3f} seconds.")
+
+    def _make_room(self, state, evict):
+        needed = state.nbytes()
+        if self._available_memory() >= needed:
+            return True
+        if not evict:
+            return False
+        candidates = sorted(
+            (
+                other
+                for other in self.models.values()
+                if other is not state and other.resident and other.in_use == 0
+            ),
+            key=lambda other: other.last_used,
+        )
+        for other in candidates:
+            self._evict(other)
+            if self._available_memory() >= needed:
+                return True
+        torch.cuda.empty_cache()
+        return self._available_memory() >= needed
+
+    def prefetch(self, model):
+        """Starts uploading `model` if it fits without evicting anything."""
+        if keeps_placement(model):
+            return
+        with self._lock:
+            state = self._state(model)
+            if state.resident or not self._make_room(state, evict=False):
+                return
+            state.upload(self.device, self.stream)
+
+    def _evict_idle(self, keep=None):
+        for state in self.models.values():
+            if state is not keep and state.resident and state.in_use == 0:
+                self._evict(state)
+        torch.cuda.empty_cache()
+
+    @contextmanager
+    def use(self, model, exclusive=False):
+        """
+        Makes `model` resident for the duration of the block, with `exclusive` as the
+        only resident model so that its activations get the rest of the device.
+        """
+        if keeps_placement(model):
+            yield model
+            return
+        with self._lock:
+            state = self._state(model)
+            if exclusive:
+                self._evict_idle(keep=state)
+            if not state.resident:
+                self._make_room(state, evict=True)
+                state.upload(self.device, self.stream)
+            state.wait(self.device)
+            state.in_use += 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                state.in_use -= 1
+                state.last_used = time.time()
+
+
+class BlockStreamer:
+    """
+    Streams the blocks of a model through a CUDA device one at a time.
+
+    The first `resident_blocks` blocks and everything outside `blocks` (embedders,
+    final layer) stay on the device. The other blocks live in pinned host memory: a
+    block is uploaded on a side stream while the previous one runs (double buffering)
+    and evicted as soon as its forward returns. With `memory_budget_mb` the number of
+    resident blocks is derived from the budget, keeping room for the two streamed ones.
+    Per-block state kept on the device between calls, such as the transformer's
+    cross_attention_cache, grows with every streamed block, so ACEStepPipeline turns
+    that cache off when streaming.
+    """
+
+    def __init__(self, model, blocks, device, resident_blocks=0, memory_budget_mb=None, prefetch_blocks=1):
+        self.model = model
+        self.blocks = blocks
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device)
+        self.prefetch_blocks = prefetch_blocks
+        self.states = [_OffloadedModel(block) for block in blocks]
+        if memory_budget_mb is not None:
+            block_bytes = max(state.nbytes() for state in self.states)
+            budget_blocks = int(memory_budget_mb * 1024 ** 2 // block_bytes)
+            resident_blocks = budget_blocks - (1 + prefetch_blocks)
+        self.resident_blocks = min(len(self.states), max(0, resident_blocks))
+        self._handles = []
+
+    def _is_streamed(self, index):
+        return index >= self.resident_blocks
+
+    def enable(self):
+        block_modules = {id(module) for block in self.blocks for module in block.modules()}
+        for module in self.model.modules():
+            if id(module) in block_modules:
+                continue
+            # tensors owned directly by modules outside the blocks stay on the device
+            for tensors in (module._parameters, module._buffers):
+                for tensor in tensors.values():
+                    if tensor is not None:
+                        tensor.data = tensor.data.to(self.device)
+
+        for index, (block, state) in enumerate(zip(self.blocks, self.states)):
+            if not self._is_streamed(index):
+                block.to(self.device)
+                continue
+            state.evict(self.device)
+            for name, tensor in state.tensors():
+                if not tensor.data.is_pinned():
+                    state.pinned[name] = tensor.data.pin_memory()
+                    tensor.data = state.pinned[name]
+            self._handles.append(block.register_forward_pre_hook(self._pre_hook(index)))
+            self._handles.append(block.register_forward_hook(self._post_hook(index)))
+        logger.info(
+            f"Streaming {len(self.states) - self.resident_blocks}/{len(self.states)} blocks of {type(self.model).__name__}"
+        )
+        return self
+
+    def disable(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _prefetch(self, index):
+        num_streamed = len(self.states) - self.resident_blocks
+        for offset in range(1, min(self.prefetch_blocks, num_streamed - 1) + 1):
+            # wraps around so the first streamed block is ready for the next forward
+            next_index = self.resident_blocks + (index - self.resident_blocks + offset) % num_streamed
+            if not self.states[next_index].resident:
+                self.states[next_index].upload(self.device, self.stream)
+
+    def _pre_hook(self, index):
+        def hook(module, args):
+            state = self.states[index]
+            if not state.resident:
+                state.upload(self.device, self.stream)
+            state.wait(self.device)
+            self._prefetch(index)
+
+        return hook
+
+    def _post_hook(self, index):
+        def hook(module, args, output):
+            self.states[index].evict(self.device)
+
+        return hook
+
+
+def offload_context(owner, model, exclusive=False):
+    manager = getattr(owner, "offload_manager", None)
+    if manager is not None:
+        return manager.use(model, exclusive=exclusive)
+    # CpuOffloader only ever keeps one model on the device
+    return CpuOffloader(model, owner.device)
+
+
+T = TypeVar('T')
+
+def cpu_offload(model_attr: str, exclusive: bool = False):
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.cpu_offload or model_attr in getattr(self, "streamed_models", ()):
+                return func(self, *args, **kwargs)
+
+            # Get the model from the class attribute
+            model = getattr(self, model_attr)
+
+            with offload_context(self, model, exclusive=exclusive):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+    return decorator
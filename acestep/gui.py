@@ -7,6 +7,7 @@ Apache 2.0 License
 """
 
 import os
+import functools
 import click
 
 @click.command()
@@ -68,7 +69,8 @@ def main(checkpoint_path, server_name, port, device_id, share, bf16, torch_compi
     data_sampler = DataSampler()
 
     demo = create_main_demo_ui(
-        text2music_process_func=model_demo.__call__,
+        # one song per run, extra seeds in the seed textbox are ignored
+        text2music_process_func=functools.partial(model_demo.__call__, batch_size=1),
         sample_data_func=data_sampler.sample,
         load_data_func=data_sampler.load_json,
     )
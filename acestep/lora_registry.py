@@ -0,0 +1,142 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from diffusers.utils.peft_utils import set_weights_and_activate_adapters
+from huggingface_hub import snapshot_download
+from loguru import logger
+
+
+LORA_WEIGHTS_NAME = "pytorch_lora_weights.safetensors"
+
+
+class LoRARegistry:
+    """
+    Keeps several LoRA adapters resident on a transformer under distinct adapter names.
+
+    Switching between resident adapters (or to no adapter) only changes the active
+    adapter and its scale, no weights are read or injected. Adapters are loaded on first
+    use and the least recently used ones are deleted when more than `max_adapters` are
+    resident or their parameters exceed `max_memory_mb`.
+    """
+
+    def __init__(self, model, cache_dir=None, max_adapters=4, max_memory_mb=None):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.max_adapters = max(1, max_adapters)
+        self.max_memory_mb = max_memory_mb
+        # lora_name_or_path -> {"adapter_name", "size_mb"}, least recently used first
+        self.adapters = OrderedDict()
+        self.active = None
+        self.active_weight = None
+        self.lora_enabled = True
+        self.last_switch_time = 0.0
+        self.loads = 0
+        self.switches = 0
+        self.evictions = 0
+        self._adapter_index = 0
+        self._lock = threading.Lock()
+
+    def _adapter_size_mb(self, adapter_name):
+        size = 0
+        for name, param in self.model.named_parameters():
+            if f".{adapter_name}." in name:
+                size += param.numel() * param.element_size()
+        return size / (1024 ** 2)
+
+    def _resident_memory_mb(self):
+        return sum(adapter["size_mb"] for adapter in self.adapters.values())
+
+    def _load(self, lora_name_or_path):
+        if not os.path.exists(lora_name_or_path):
+            lora_download_path = snapshot_download(lora_name_or_path, cache_dir=self.cache_dir)
+        else:
+            lora_download_path = lora_name_or_path
+        adapter_name = f"ace_step_lora_{self._adapter_index}"
+        self._adapter_index += 1
+        logger.info(
+            f"Loading lora weights from: {lora_name_or_path} download path is: {lora_download_path} adapter: {adapter_name}"
+        )
+        self.model.load_lora_adapter(
+            os.path.join(lora_download_path, LORA_WEIGHTS_NAME),
+            adapter_name=adapter_name,
+            with_alpha=True,
+            prefix=None,
+        )
+        self.loads += 1
+        self.adapters[lora_name_or_path] = {
+            "adapter_name": adapter_name,
+            "size_mb": self._adapter_size_mb(adapter_name),
+        }
+
+    def _evict(self, keep):
+        while len(self.adapters) > 1 and (
+            len(self.adapters) > self.max_adapters
+            or (
+                self.max_memory_mb is not None
+                and self._resident_memory_mb() > self.max_memory_mb
+            )
+        ):
+            lora_name_or_path = next(name for name in self.adapters if name != keep)
+            adapter = self.adapters.pop(lora_name_or_path)
+            self.model.delete_adapters([adapter["adapter_name"]])
+            self.evictions += 1
+            logger.info(f"Evicted lora {lora_name_or_path} ({adapter['size_mb']:.1f}MB)")
+
+    def activate(self, lora_name_or_path, lora_weight=1.0):
+        """Makes `lora_name_or_path` the only active adapter at `lora_weight`, "none" disables LoRA."""
+        with self._lock:
+            if lora_name_or_path == self.active and lora_weight == self.active_weight:
+                return 0.0
+
+            start_time = time.time()
+            if lora_name_or_path == "none":
+                if self.adapters and self.lora_enabled:
+                    self.model.disable_lora()
+                    self.lora_enabled = False
+            else:
+                if lora_name_or_path in self.adapters:
+                    self.adapters.move_to_end(lora_name_or_path)
+                else:
+                    self._load(lora_name_or_path)
+                    self._evict(keep=lora_name_or_path)
+                if not self.lora_enabled:
+                    self.model.enable_lora()
+                    self.lora_enabled = True
+                set_weights_and_activate_adapters(
+                    self.model,
+                    [self.adapters[lora_name_or_path]["adapter_name"]],
+                    [lora_weight],
+                )
+
+            self.active = lora_name_or_path
+            self.active_weight = lora_weight
+            self.switches += 1
+            self.last_switch_time = time.time() - start_time
+            logger.info(
+                f"Switched lora to {lora_name_or_path} weight: {lora_weight} in {self.last_switch_time:.3f} seconds."
+            )
+            return self.last_switch_time
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "active_weight": self.active_weight,
+            "resident": list(self.adapters),
+            "resident_memory_mb": self._resident_memory_mb(),
+            "max_adapters": self.max_adapters,
+            "max_memory_mb": self.max_memory_mb,
+            "loads": self.loads,
+            "switches": self.switches,
+            "evictions": self.evictions,
+            "last_switch_time": self.last_switch_time,
+        }
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Any, Dict, Optional, Tuple, List, Union
 
@@ -26,6 +27,8 @@ from diffusers.loaders import FromOriginalModelMixin, PeftAdapterMixin
 
 
 from .attention import LinearTransformerBlock, t2i_modulate
+from .customer_attention_processor import RotaryTables
+from ..profiler import profiled
 from .lyrics_utils.lyric_encoder import ConformerEncoder as LyricEncoder
 
 
@@ -43,6 +46,23 @@ def cross_norm(hidden_states, controlnet_input):
     return controlnet_input
 
 
+def masked_group_norm(group_norm, x, mask):
+    # GroupNorm over N x C x H x W with statistics taken from the frames where the
+    # N x W mask is set, so that padding does not change the normalized valid frames
+    batch_size, channels, height, width = x.shape
+    dtype = x.dtype
+    groups = x.float().reshape(batch_size, group_norm.num_groups, -1, height, width)
+    weights = mask.float()[:, None, None, None, :].expand_as(groups)
+    count = weights.sum(dim=(2, 3, 4), keepdim=True)
+    mean = (groups * weights).sum(dim=(2, 3, 4), keepdim=True) / count
+    var = ((groups - mean).square() * weights).sum(dim=(2, 3, 4), keepdim=True) / count
+    groups = (groups - mean) * torch.rsqrt(var + group_norm.eps)
+    x = groups.reshape(batch_size, channels, height, width)
+    if group_norm.affine:
+        x = x * group_norm.weight[None, :, None, None] + group_norm.bias[None, :, None, None]
+    return x.to(dtype)
+
+
 # Copied from transformers.models.mixtral.modeling_mixtral.MixtralRotaryEmbedding with Mixtral->Qwen2
 class Qwen2RotaryEmbedding(nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
@@ -189,9 +209,14 @@ class PatchEmbed(nn.Module):
         self.height, self.width = height // patch_size_h, width // patch_size_w
         self.base_size = self.width
 
-    def forward(self, latent):
+    def forward(self, latent, mask=None):
         # early convolutions, N x C x H x W -> N x 256 * sqrt(patch_size) x H/patch_size x W/patch_size
-        latent = self.early_conv_layers(latent)
+        if mask is None:
+            latent = self.early_conv_layers(latent)
+        else:
+            # padded frames must not contribute to the GroupNorm statistics
+            conv_in, group_norm, conv_out = self.early_conv_layers
+            latent = conv_out(masked_group_norm(group_norm, conv_in(latent), mask))
         latent = latent.flatten(2).transpose(1, 2)  # BCHW -> BNC
         return latent
 
@@ -325,6 +350,10 @@ class ACEStepTransformer2DModel(
             self.inner_dim, patch_size=patch_size, out_channels=out_channels
         )
         self.gradient_checkpointing = False
+        # RotaryTables by (seq_len, device, dtype) while rotary_cache is active
+        self._rotary_tables = None
+        # StepCache deciding which decode calls reuse the blocks' residual, see step_cache
+        self._step_cache = None
 
     # Copied from diffusers.models.unets.unet_3d_condition.UNet3DConditionModel.enable_forward_chunking
     def enable_forward_chunking(
@@ -360,6 +389,69 @@ class ACEStepTransformer2DModel(
         for module in self.children():
             fn_recursive_feed_forward(module, chunk_size, dim)
 
+    @contextmanager
+    def cross_attention_cache(self):
+        """
+        Reuse cross-attention keys, values and masks for the duration of the context.
+
+        Inside the context every block computes `to_k`/`to_v`, RoPE and the combined mask once
+        per distinct `encoder_hidden_states` tensor (one per condition branch) and reuses them for
+        every subsequent `decode` call. Only use it while the encoder states and weights stay fixed,
+        e.g. around the denoising loop of a single generation.
+        """
+        processors = [
+            block.cross_attn.processor
+            for block in self.transformer_blocks
+            if block.add_cross_attention
+        ]
+        for processor in processors:
+            processor.cross_attention_cache = {}
+        try:
+            yield
+        finally:
+            for processor in processors:
+                processor.cross_attention_cache = None
+
+    @contextmanager
+    def rotary_cache(self):
+        """
+        Keep the RoPE tables built by `decode` for the duration of the context.
+
+        A generation decodes the same latent and encoder lengths at every step, so the
+        tables are materialized once on the right device instead of being sliced, cast
+        and moved in every attention call.
+        """
+        self._rotary_tables = {}
+        try:
+            yield
+        finally:
+            self._rotary_tables = None
+
+    @contextmanager
+    def step_cache(self, cache):
+        """
+        Let `cache` (a StepCache) skip the transformer blocks of `decode` calls for the
+        duration of the context.
+
+        When the cache reports that the blocks' input barely changed since the last full
+        forward, decode adds the residual stored by that forward instead of running the
+        blocks. This approximates the output, only use it around a denoising loop.
+        """
+        self._step_cache = cache
+        try:
+            yield cache
+        finally:
+            self._step_cache = None
+
+    def rotary_tables(self, x, seq_len):
+        key = (seq_len, x.device, x.dtype)
+        if self._rotary_tables is not None and key in self._rotary_tables:
+            return self._rotary_tables[key]
+        tables = RotaryTables.from_freqs(*self.rotary_emb(x, seq_len=seq_len), device=x.device)
+        if self._rotary_tables is not None:
+            self._rotary_tables[key] = tables
+        return tables
+
     def forward_lyric_encoder(
         self,
         lyric_token_idx: Optional[torch.LongTensor] = None,
@@ -373,6 +465,7 @@ class ACEStepTransformer2DModel(
         prompt_prenet_out = self.lyric_proj(prompt_prenet_out)
         return prompt_prenet_out
 
+    @profiled("transformer_encode")
     def encode(
         self,
         encoder_text_hidden_states: Optional[torch.Tensor] = None,
@@ -425,14 +518,25 @@ class ACEStepTransformer2DModel(
         ] = None,
         controlnet_scale: Union[float, torch.Tensor] = 1.0,
         return_dict: bool = True,
+        attention_mask_is_full: bool = False,
     ):
+        # frames beyond output_length are padding (see duration buckets in the pipeline):
+        # they are masked out of the patch embedding norm and the feed forward convs,
+        # attention_mask already removes them from attention
+        padding_mask = None
+        if 0 < output_length < hidden_states.shape[-1]:
+            padding_mask = attention_mask
+        # attention_mask_is_full is known by the caller (the pipeline compares frame and
+        # bucket lengths once per generation) and skips multiplying by an all-ones mask in
+        # every block; reading it from the mask here would sync with the device per call
+        attention_mask_is_full = attention_mask is None or attention_mask_is_full
 
         embedded_timestep = self.timestep_embedder(
             self.time_proj(timestep).to(dtype=hidden_states.dtype)
         )
         temb = self.t_block(embedded_timestep)
 
-        hidden_states = self.proj_in(hidden_states)
+        hidden_states = self.proj_in(hidden_states, padding_mask)
 
         # controlnet logic
         if block_controlnet_hidden_states is not None:
@@ -441,14 +545,20 @@ class ACEStepTransformer2DModel(
 
         inner_hidden_states = []
 
-        rotary_freqs_cis = self.rotary_emb(
-            hidden_states, seq_len=hidden_states.shape[1]
-        )
-        encoder_rotary_freqs_cis = self.rotary_emb(
-            encoder_hidden_states, seq_len=encoder_hidden_states.shape[1]
+        rotary_freqs_cis = self.rotary_tables(hidden_states, hidden_states.shape[1])
+        encoder_rotary_freqs_cis = self.rotary_tables(
+            encoder_hidden_states, encoder_hidden_states.shape[1]
         )
 
-        for index_block, block in enumerate(self.transformer_blocks):
+        step_cache_state = cached_residual = None
+        if self._step_cache is not None and not self.training and ssl_hidden_states is None:
+            step_cache_state, cached_residual = self._step_cache.lookup(
+                self.transformer_blocks[0], hidden_states, temb, encoder_hidden_states
+            )
+        blocks_input = hidden_states
+        transformer_blocks = self.transformer_blocks if cached_residual is None else []
+
+        for index_block, block in enumerate(transformer_blocks):
 
             if self.training and self.gradient_checkpointing:
 
@@ -461,6 +571,8 @@ class ACEStepTransformer2DModel(
                     rotary_freqs_cis=rotary_freqs_cis,
                     rotary_freqs_cis_cross=encoder_rotary_freqs_cis,
                     temb=temb,
+                    padding_mask=padding_mask,
+                    attention_mask_is_full=attention_mask_is_full,
                     use_reentrant=False,
                 )
 
@@ -473,12 +585,19 @@ class ACEStepTransformer2DModel(
                     rotary_freqs_cis=rotary_freqs_cis,
                     rotary_freqs_cis_cross=encoder_rotary_freqs_cis,
                     temb=temb,
+                    padding_mask=padding_mask,
+                    attention_mask_is_full=attention_mask_is_full,
                 )
 
             for ssl_encoder_depth in self.ssl_encoder_depths:
                 if index_block == ssl_encoder_depth:
                     inner_hidden_states.append(hidden_states)
 
+        if cached_residual is not None:
+            hidden_states = blocks_input + cached_residual
+        elif step_cache_state is not None:
+            self._step_cache.store(step_cache_state, hidden_states - blocks_input)
+
         proj_losses = []
         if (
             len(inner_hidden_states) > 0
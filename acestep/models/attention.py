@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -179,9 +179,13 @@ class GLUMBConv(nn.Module):
             act=act[2],
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         x = x.transpose(1, 2)
         x = self.inverted_conv(x)
+        if mask is not None:
+            # zero padded frames, so that the depthwise conv sees the same zero padding
+            # at the end of the valid frames as for an unpadded sequence
+            x = x * mask[:, None, :].to(x.dtype)
         x = self.depth_conv(x)
 
         x, gate = torch.chunk(x, 2, dim=1)
@@ -267,9 +271,13 @@ class LinearTransformerBlock(nn.Module):
         rotary_freqs_cis: Union[torch.Tensor, Tuple[torch.Tensor]] = None,
         rotary_freqs_cis_cross: Union[torch.Tensor, Tuple[torch.Tensor]] = None,
         temb: torch.FloatTensor = None,
+        padding_mask: torch.FloatTensor = None,
+        attention_mask_is_full: bool = False,
     ):
 
         N = hidden_states.shape[0]
+        # linear self-attention skips a mask without masked frames
+        self_attention_mask = None if attention_mask_is_full else attention_mask
 
         # step 1: AdaLN single
         if self.use_adaln_single:
@@ -285,7 +293,7 @@ class LinearTransformerBlock(nn.Module):
         if not self.add_cross_attention:
             attn_output, encoder_hidden_states = self.attn(
                 hidden_states=norm_hidden_states,
-                attention_mask=attention_mask,
+                attention_mask=self_attention_mask,
                 encoder_hidden_states=encoder_hidden_states,
                 encoder_attention_mask=encoder_attention_mask,
                 rotary_freqs_cis=rotary_freqs_cis,
@@ -294,7 +302,7 @@ class LinearTransformerBlock(nn.Module):
         else:
             attn_output, _ = self.attn(
                 hidden_states=norm_hidden_states,
-                attention_mask=attention_mask,
+                attention_mask=self_attention_mask,
                 encoder_hidden_states=None,
                 encoder_attention_mask=None,
                 rotary_freqs_cis=rotary_freqs_cis,
@@ -322,7 +330,7 @@ class LinearTransformerBlock(nn.Module):
             norm_hidden_states = norm_hidden_states * (1 + scale_mlp) + shift_mlp
 
         # step 4: feed forward
-        ff_output = self.ff(norm_hidden_states)
+        ff_output = self.ff(norm_hidden_states, mask=padding_mask)
         if self.use_adaln_single:
             ff_output = gate_mlp * ff_output
 
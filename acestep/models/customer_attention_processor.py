@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Optional, Union, Tuple
+from typing import NamedTuple, Optional, Union, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -23,6 +23,41 @@ from diffusers.models.attention_processor import Attention
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+class RotaryTables(NamedTuple):
+    """
+    RoPE tables in the layout apply_rotary_emb uses: float32 [1, 1, S, D] cos and sin,
+    with the sign of the pair rotation folded into sin. Build them once per sequence
+    length (see ACEStepTransformer2DModel.rotary_cache) instead of on every call.
+    """
+
+    cos: torch.Tensor
+    sin: torch.Tensor
+
+    @classmethod
+    def from_freqs(cls, cos, sin, device=None):
+        """From the [S, D] cos/sin of Qwen2RotaryEmbedding."""
+        cos = cos.to(device=device, dtype=torch.float32)
+        sin = sin.to(device=device, dtype=torch.float32)
+        # rotating the pair (x0, x1) gives (-x1, x0): negate sin at the even positions
+        sign = torch.tensor([-1.0, 1.0], device=sin.device).repeat(sin.shape[-1] // 2)
+        return cls(cos[None, None].contiguous(), (sin * sign)[None, None].contiguous())
+
+
+def apply_rotary_emb(x, freqs_cis):
+    """
+    Rotates x [B, H, S, D] by RotaryTables (or a raw ([S, D], [S, D]) cos/sin pair) in
+    float32: x * cos + swap_pairs(x) * sin, with one product accumulated in place.
+    """
+    if not isinstance(freqs_cis, RotaryTables):
+        freqs_cis = RotaryTables.from_freqs(*freqs_cis, device=x.device)
+    x_float = x.float()
+    # (x0, x1, x2, x3, ...) -> (x1, x0, x3, x2, ...)
+    x_swapped = x_float.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+    out = x_float * freqs_cis.cos
+    out.addcmul_(x_swapped, freqs_cis.sin)
+    return out.to(x.dtype)
+
+
 class CustomLiteLAProcessor2_0:
     """Attention processor used typically in processing the SD3-like self-attention projections. add rms norm for query and key and apply RoPE"""
 
@@ -50,16 +85,7 @@ class CustomLiteLAProcessor2_0:
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: Tuple of modified query tensor and key tensor with rotary embeddings.
         """
-        cos, sin = freqs_cis  # [S, D]
-        cos = cos[None, None]
-        sin = sin[None, None]
-        cos, sin = cos.to(x.device), sin.to(x.device)
-
-        x_real, x_imag = x.reshape(*x.shape[:-1], -1, 2).unbind(-1)  # [B, S, H, D//2]
-        x_rotated = torch.stack([-x_imag, x_real], dim=-1).flatten(3)
-        out = (x.float() * cos + x_rotated.float() * sin).to(x.dtype)
-
-        return out
+        return apply_rotary_emb(x, freqs_cis)
 
     def __call__(
         self,
@@ -121,17 +147,10 @@ class CustomLiteLAProcessor2_0:
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
 
-        query = query.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
-        key = (
-            key.transpose(-1, -2)
-            .reshape(batch_size, attn.heads, head_dim, -1)
-            .transpose(-1, -2)
-        )
-        value = value.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
-
-        # RoPE需要 [B, H, S, D] 输入
-        # 此时 query是 [B, H, D, S], 需要转成 [B, H, S, D] 才能应用RoPE
-        query = query.permute(0, 1, 3, 2)  # [B, H, S, D]  (从 [B, H, D, S])
+        # [B, S, H * D] -> [B, H, S, D], views without copies
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
         # Apply query and key normalization if needed
         if attn.norm_q is not None:
@@ -147,58 +166,41 @@ class CustomLiteLAProcessor2_0:
             elif rotary_freqs_cis_cross is not None and has_encoder_hidden_state_proj:
                 key = self.apply_rotary_emb(key, rotary_freqs_cis_cross)
 
-        # 此时 query是 [B, H, S, D]，需要还原成 [B, H, D, S]
-        query = query.permute(0, 1, 3, 2)  # [B, H, D, S]
-
+        # masked keys contribute nothing to K^T V or to the normalizer, so values need
+        # no masking; masked queries give 0 / eps = 0. None skips masking entirely
         if attention_mask is not None:
-            # attention_mask: [B, S] -> [B, 1, S, 1]
-            attention_mask = attention_mask[:, None, :, None].to(
-                key.dtype
-            )  # [B, 1, S, 1]
-            query = query * attention_mask.permute(
-                0, 1, 3, 2
-            )  # [B, H, S, D] * [B, 1, S, 1]
+            attention_mask = attention_mask[:, None, :, None].to(key.dtype)  # [B, 1, S, 1]
+            query = query * attention_mask
             if not attn.is_cross_attention:
-                key = (
-                    key * attention_mask
-                )  # key: [B, h, S, D] 与 mask [B, 1, S, 1] 相乘
-                value = value * attention_mask.permute(
-                    0, 1, 3, 2
-                )  # 如果 value 是 [B, h, D, S]，那么需调整mask以匹配S维度
+                key = key * attention_mask
 
         if (
             attn.is_cross_attention
             and encoder_attention_mask is not None
             and has_encoder_hidden_state_proj
         ):
-            encoder_attention_mask = encoder_attention_mask[:, None, :, None].to(
-                key.dtype
-            )  # [B, 1, S_enc, 1]
-            # 此时 key: [B, h, S_enc, D], value: [B, h, D, S_enc]
-            key = key * encoder_attention_mask  # [B, h, S_enc, D] * [B, 1, S_enc, 1]
-            value = value * encoder_attention_mask.permute(
-                0, 1, 3, 2
-            )  # [B, h, D, S_enc] * [B, 1, 1, S_enc]
+            key = key * encoder_attention_mask[:, None, :, None].to(key.dtype)
 
         query = self.kernel_func(query)
         key = self.kernel_func(key)
 
+        # state, normalizer and division stay in float32 like the baseline: half
+        # precision sums over long sequences overflow (float16) or lose the low bits
+        # of numerator and normalizer before the division (bfloat16)
         query, key, value = query.float(), key.float(), value.float()
 
-        value = F.pad(value, (0, 0, 0, 1), mode="constant", value=self.pad_val)
-
-        vk = torch.matmul(value, key)
+        # one [D, D + 1] state per head: K^T V next to the normalizer K^T 1, so that a
+        # single matmul with the queries gives numerators and denominators
+        key_value = torch.matmul(key.transpose(-1, -2), value)  # [B, H, D, D]
+        key_sum = key.sum(dim=-2)  # [B, H, D]
+        key_value = torch.cat([key_value, key_sum.unsqueeze(-1)], dim=-1)
 
-        hidden_states = torch.matmul(vk, query)
+        hidden_states = torch.matmul(query, key_value)  # [B, H, S, D + 1]
+        hidden_states = hidden_states[..., :-1] / (hidden_states[..., -1:] + self.eps)
 
-        if hidden_states.dtype in [torch.float16, torch.bfloat16]:
-            hidden_states = hidden_states.float()
-
-        hidden_states = hidden_states[:, :, :-1] / (hidden_states[:, :, -1:] + self.eps)
-
-        hidden_states = hidden_states.view(
-            batch_size, attn.heads * head_dim, -1
-        ).permute(0, 2, 1)
+        hidden_states = hidden_states.transpose(1, 2).reshape(
+            batch_size, -1, attn.heads * head_dim
+        )
 
         hidden_states = hidden_states.to(dtype)
         if encoder_hidden_states is not None:
@@ -254,6 +256,9 @@ class CustomerAttnProcessor2_0:
             raise ImportError(
                 "AttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
             )
+        # dict of cross-attention keys/values/masks while
+        # ACEStepTransformer2DModel.cross_attention_cache is active, None otherwise
+        self.cross_attention_cache = None
 
     def apply_rotary_emb(
         self,
@@ -274,16 +279,7 @@ class CustomerAttnProcessor2_0:
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: Tuple of modified query tensor and key tensor with rotary embeddings.
         """
-        cos, sin = freqs_cis  # [S, D]
-        cos = cos[None, None]
-        sin = sin[None, None]
-        cos, sin = cos.to(x.device), sin.to(x.device)
-
-        x_real, x_imag = x.reshape(*x.shape[:-1], -1, 2).unbind(-1)  # [B, S, H, D//2]
-        x_rotated = torch.stack([-x_imag, x_real], dim=-1).flatten(3)
-        out = (x.float() * cos + x_rotated.float() * sin).to(x.dtype)
-
-        return out
+        return apply_rotary_emb(x, freqs_cis)
 
     def __call__(
         self,
@@ -326,64 +322,103 @@ class CustomerAttnProcessor2_0:
 
         query = attn.to_q(hidden_states)
 
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
+        # key, value and mask only depend on the condition, so with a cache attached
+        # they are computed once per (encoder_hidden_states, masks) and reused
+        cache_key = None
+        cache_entry = None
+        if (
+            self.cross_attention_cache is not None
+            and attn.is_cross_attention
+            and encoder_hidden_states is not None
+        ):
+            cache_key = (
+                id(encoder_hidden_states),
+                id(attention_mask),
+                id(encoder_attention_mask),
             )
+            cache_entry = self.cross_attention_cache.get(cache_key)
+        cache_sources = (encoder_hidden_states, attention_mask, encoder_attention_mask)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
-
-        inner_dim = key.shape[-1]
+        inner_dim = query.shape[-1]
         head_dim = inner_dim // attn.heads
 
         query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         if attn.norm_q is not None:
             query = attn.norm_q(query)
-        if attn.norm_k is not None:
-            key = attn.norm_k(key)
 
         # Apply RoPE if needed
         if rotary_freqs_cis is not None:
             query = self.apply_rotary_emb(query, rotary_freqs_cis)
-            if not attn.is_cross_attention:
-                key = self.apply_rotary_emb(key, rotary_freqs_cis)
-            elif rotary_freqs_cis_cross is not None and has_encoder_hidden_state_proj:
-                key = self.apply_rotary_emb(key, rotary_freqs_cis_cross)
-
-        if (
-            attn.is_cross_attention
-            and encoder_attention_mask is not None
-            and has_encoder_hidden_state_proj
-        ):
-            # attention_mask: N x S1
-            # encoder_attention_mask: N x S2
-            # cross attention 整合attention_mask和encoder_attention_mask
-            combined_mask = (
-                attention_mask[:, :, None] * encoder_attention_mask[:, None, :]
-            )
-            attention_mask = torch.where(combined_mask == 1, 0.0, -torch.inf)
-            attention_mask = (
-                attention_mask[:, None, :, :]
-                .expand(-1, attn.heads, -1, -1)
-                .to(query.dtype)
-            )
 
-        elif not attn.is_cross_attention and attention_mask is not None:
-            attention_mask = attn.prepare_attention_mask(
-                attention_mask, sequence_length, batch_size
-            )
-            # scaled_dot_product_attention expects attention_mask shape to be
-            # (batch, heads, source_length, target_length)
-            attention_mask = attention_mask.view(
-                batch_size, attn.heads, -1, attention_mask.shape[-1]
-            )
+        if cache_entry is not None:
+            key, value, attention_mask = cache_entry[:3]
+        else:
+            if encoder_hidden_states is None:
+                encoder_hidden_states = hidden_states
+            elif attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(
+                    encoder_hidden_states
+                )
+
+            key = attn.to_k(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states)
+
+            key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+            if attn.norm_k is not None:
+                key = attn.norm_k(key)
+
+            # Apply RoPE if needed
+            if rotary_freqs_cis is not None:
+                if not attn.is_cross_attention:
+                    key = self.apply_rotary_emb(key, rotary_freqs_cis)
+                elif rotary_freqs_cis_cross is not None and has_encoder_hidden_state_proj:
+                    key = self.apply_rotary_emb(key, rotary_freqs_cis_cross)
+
+            if (
+                attn.is_cross_attention
+                and encoder_attention_mask is not None
+                and has_encoder_hidden_state_proj
+            ):
+                # attention_mask: N x S1
+                # encoder_attention_mask: N x S2
+                # cross attention 整合attention_mask和encoder_attention_mask
+                combined_mask = (
+                    attention_mask[:, :, None] * encoder_attention_mask[:, None, :]
+                )
+                attention_mask = torch.where(combined_mask == 1, 0.0, -torch.inf)
+                # rows of padded frames mask every key and would make the softmax return
+                # NaN, which spreads to valid frames through later layers; these rows are
+                # discarded, so let them attend to every key instead
+                attention_mask = attention_mask.masked_fill(
+                    (combined_mask == 0).all(dim=-1, keepdim=True), 0.0
+                )
+                attention_mask = (
+                    attention_mask[:, None, :, :]
+                    .expand(-1, attn.heads, -1, -1)
+                    .to(query.dtype)
+                )
+
+            elif not attn.is_cross_attention and attention_mask is not None:
+                attention_mask = attn.prepare_attention_mask(
+                    attention_mask, sequence_length, batch_size
+                )
+                # scaled_dot_product_attention expects attention_mask shape to be
+                # (batch, heads, source_length, target_length)
+                attention_mask = attention_mask.view(
+                    batch_size, attn.heads, -1, attention_mask.shape[-1]
+                )
+
+            if cache_key is not None:
+                # keep the source tensors alive so their ids cannot be reused
+                self.cross_attention_cache[cache_key] = (
+                    key,
+                    value,
+                    attention_mask,
+                    cache_sources,
+                )
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
@@ -0,0 +1,118 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import torch
+
+
+def modulated_block_input(block, hidden_states, temb):
+    """The AdaLN-modulated input of a LinearTransformerBlock's self-attention."""
+    N = hidden_states.shape[0]
+    shift_msa, scale_msa = (
+        block.scale_shift_table[None, :2] + temb.reshape(N, 6, -1)[:, :2]
+    ).unbind(1)
+    return block.norm1(hidden_states) * (1 + scale_msa[:, None]) + shift_msa[:, None]
+
+
+@dataclass
+class _CacheState:
+    previous_input: Optional[torch.Tensor] = None
+    residual: Optional[torch.Tensor] = None
+    # a device tensor once measured, read on the host only to decide a hit
+    accumulated_change: Union[float, torch.Tensor] = 0.0
+    consecutive_hits: int = 0
+
+
+class StepCache:
+    """
+    Reuses the output residual of the transformer blocks between adjacent denoising steps.
+
+    Each decode measures the relative L1 change of the first block's modulated input
+    (which depends on both the latents and the timestep embedding) since the previous
+    step. While the change accumulated since the last full forward stays below
+    `threshold`, the blocks are skipped and their cached residual is added to the
+    input instead. The first `warmup_steps` and last `cooldown_steps` steps always run
+    in full, as does a step after `max_consecutive_hits` reuses in a row.
+
+    Calls are cached separately per batch shape and encoder state, so guidance
+    branches decoded one by one or together each keep their own residual.
+
+    The change is only measured on calls that may skip the blocks, and read back from
+    the device once per such call; steps that run in full anyway do not sync.
+    """
+
+    def __init__(self, threshold=0.1, warmup_steps=2, cooldown_steps=1, max_consecutive_hits=2):
+        self.threshold = threshold
+        self.warmup_steps = warmup_steps
+        self.cooldown_steps = cooldown_steps
+        self.max_consecutive_hits = max_consecutive_hits
+        self.states = {}
+        self.records = []
+        self.step = 0
+        self.num_steps = None
+
+    def begin_step(self, step, num_steps=None):
+        self.step = step
+        self.num_steps = num_steps
+
+    def _refresh_required(self, state):
+        if self.step < self.warmup_steps:
+            return True
+        if self.num_steps is not None and self.step >= self.num_steps - self.cooldown_steps:
+            return True
+        return state.consecutive_hits >= self.max_consecutive_hits
+
+    @torch.no_grad()
+    def lookup(self, block, hidden_states, temb, encoder_hidden_states):
+        """Returns (state, residual), residual being None when the blocks have to run."""
+        key = (tuple(hidden_states.shape), encoder_hidden_states.data_ptr())
+        state = self.states.setdefault(key, _CacheState())
+        current_input = modulated_block_input(block, hidden_states, temb)
+
+        change = None
+        hit = False
+        if (
+            state.previous_input is not None
+            and state.residual is not None
+            and not self._refresh_required(state)
+        ):
+            change = (current_input - state.previous_input).abs().mean() / (
+                state.previous_input.abs().mean().clamp(min=1e-8)
+            )
+            state.accumulated_change = state.accumulated_change + change
+            hit = bool(state.accumulated_change < self.threshold)
+        state.previous_input = current_input
+        self.records.append(
+            {"step": self.step, "batch_size": hidden_states.shape[0], "hit": hit, "change": change}
+        )
+
+        if hit:
+            state.consecutive_hits += 1
+            return state, state.residual
+        state.accumulated_change = 0.0
+        state.consecutive_hits = 0
+        return state, None
+
+    def store(self, state, residual):
+        state.residual = residual
+
+    def summary(self):
+        for record in self.records:
+            if torch.is_tensor(record["change"]):
+                record["change"] = record["change"].item()
+        hits = sum(record["hit"] for record in self.records)
+        return {
+            "threshold": self.threshold,
+            "calls": len(self.records),
+            "hits": hits,
+            "hit_rate": hits / len(self.records) if self.records else 0.0,
+            "hit_steps": sorted({record["step"] for record in self.records if record["hit"]}),
+            "steps": self.records,
+        }
@@ -14,18 +14,49 @@ import torchvision.transforms as transforms
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.loaders import FromOriginalModelMixin
 from diffusers.configuration_utils import ConfigMixin, register_to_config
+from loguru import logger
 from tqdm import tqdm
 
 try:
     from .music_vocoder import ADaMoSHiFiGANV1
+    from .resampler import resample
+    from ..profiler import span
 except ImportError:
     from music_vocoder import ADaMoSHiFiGANV1
+    from resampler import resample
+    from acestep.profiler import span
+
+
+def _cast_inputs(module, args):
+    # inputs follow the dtype and, for channels-last conv weights, the memory format of
+    # the module they enter
+    weight = next(module.parameters())
+    channels_last = (
+        weight.dim() == 4
+        and not weight.is_contiguous()
+        and weight.is_contiguous(memory_format=torch.channels_last)
+    )
+    cast_args = []
+    for arg in args:
+        if torch.is_tensor(arg) and arg.is_floating_point():
+            arg = arg.to(weight.dtype)
+            if channels_last and arg.dim() == 4:
+                arg = arg.contiguous(memory_format=torch.channels_last)
+        cast_args.append(arg)
+    return tuple(cast_args)
 
 
 root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DEFAULT_PRETRAINED_PATH = os.path.join(root_dir, "checkpoints", "music_dcae_f8c8")
 VOCODER_PRETRAINED_PATH = os.path.join(root_dir, "checkpoints", "music_vocoder")
 
+# overlapped vocoder decode: window, overlap trimmed from inner window edges and
+# crossfade between consecutive windows, in audio samples at 44.1kHz
+VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME = 512
+VOCODER_WIN_LEN_AUDIO = 512 * 512
+VOCODER_OVERLAP_LEN_AUDIO = 1024
+VOCODER_CROSSFADE_LEN_AUDIO = 128
+
 
 class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
     @register_to_config
@@ -39,6 +70,9 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
 
         self.dcae = AutoencoderDC.from_pretrained(dcae_checkpoint_path)
         self.vocoder = ADaMoSHiFiGANV1.from_pretrained(vocoder_checkpoint_path)
+        # the DCAE and the vocoder may run in different dtypes, see set_dtypes
+        for module in (self.dcae.encoder, self.dcae.decoder, self.vocoder.backbone):
+            module.register_forward_pre_hook(_cast_inputs)
 
         if source_sample_rate is None:
             source_sample_rate = 48000
@@ -59,6 +93,28 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         self.scale_factor = 0.1786
         self.shift_factor = -1.9091
 
+    def set_dtypes(self, dcae_dtype, vocoder_dtype):
+        """Runs the DCAE and the vocoder (with its mel transform) in separate dtypes."""
+        self.dcae.to(dcae_dtype)
+        self.vocoder.to(vocoder_dtype)
+        self.resampler.to(vocoder_dtype)
+        return self
+
+    def set_channels_last(self):
+        """Stores the DCAE conv weights channels-last, which oneDNN runs without reorders on CPU."""
+        self.dcae.to(memory_format=torch.channels_last)
+        return self
+
+    def fold_vocoder_weight_norm(self):
+        """
+        Folds the vocoder's weight norm into its conv weights, so that it is not
+        recomputed on every call. Inference only: the state_dict loses the
+        weight_g/weight_v keys, so a folded vocoder cannot be trained or saved as a
+        vocoder checkpoint.
+        """
+        self.vocoder.remove_weight_norm()
+        return self
+
     def load_audio(self, audio_path):
         audio, sr = torchaudio.load(audio_path)
         if audio.shape[0] == 1:
@@ -66,30 +122,35 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return audio, sr
 
     def forward_mel(self, audios):
-        mels = []
-        for i in range(len(audios)):
-            image = self.vocoder.mel_transform(audios[i])
-            mels.append(image)
-        mels = torch.stack(mels)
-        return mels
+        # one STFT/mel over every (item, channel) pair: N x C x T -> N x C x n_mels x frames
+        mels = self.vocoder.mel_transform(audios.flatten(0, 1))
+        return mels.unflatten(0, audios.shape[:2])
+
+    def pad_audios(self, audios):
+        """Stacks C x T_i audios into a zero padded N x C x T batch and their lengths."""
+        audio_lengths = torch.tensor([audio.shape[-1] for audio in audios])
+        batch = audios[0].new_zeros(len(audios), audios[0].shape[0], int(audio_lengths.max()))
+        for i, audio in enumerate(audios):
+            batch[i, :, : audio.shape[-1]] = audio
+        return batch, audio_lengths.to(batch.device)
 
     @torch.no_grad()
     def encode(self, audios, audio_lengths=None, sr=None):
+        # a list of 2 x T_i audios of different lengths is padded into one batch
+        if isinstance(audios, (list, tuple)):
+            audios, list_lengths = self.pad_audios(audios)
+            if audio_lengths is None:
+                audio_lengths = list_lengths
         if audio_lengths is None:
             audio_lengths = torch.tensor([audios.shape[2]] * audios.shape[0])
             audio_lengths = audio_lengths.to(audios.device)
 
         # audios: N x 2 x T, 48kHz
-        device = audios.device
-        dtype = audios.dtype
-
         if sr is None:
             sr = 48000
-            resampler = self.resampler
+            audio = self.resampler(audios)
         else:
-            resampler = torchaudio.transforms.Resample(sr, 44100).to(device).to(dtype)
-
-        audio = resampler(audios)
+            audio = resample(audios, sr, 44100)
 
         max_audio_len = audio.shape[-1]
         if max_audio_len % (8 * 512) != 0:
@@ -100,11 +161,7 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         mels = self.forward_mel(audio)
         mels = (mels - self.min_mel_value) / (self.max_mel_value - self.min_mel_value)
         mels = self.transform(mels)
-        latents = []
-        for mel in mels:
-            latent = self.dcae.encoder(mel.unsqueeze(0))
-            latents.append(latent)
-        latents = torch.cat(latents, dim=0)
+        latents = self.dcae.encoder(mels)
         latent_lengths = (
             audio_lengths / sr * 44100 / 512 / self.time_dimention_multiple
         ).long()
@@ -112,30 +169,24 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return latents, latent_lengths
 
     @torch.no_grad()
-    def decode(self, latents, audio_lengths=None, sr=None):
+    def decode(self, latents, audio_lengths=None, sr=None, memory_budget_mb=None):
         latents = latents / self.scale_factor + self.shift_factor
 
-        pred_wavs = []
-
-        for latent in latents:
-            mels = self.dcae.decoder(latent.unsqueeze(0))
-            mels = mels * 0.5 + 0.5
-            mels = mels * (self.max_mel_value - self.min_mel_value) + self.min_mel_value
-
-            # wav = self.vocoder.decode(mels[0]).squeeze(1)
-            # decode waveform for each channels to reduce vram footprint
-            wav_ch1 = self.vocoder.decode(mels[:,0,:,:]).squeeze(1).cpu()
-            wav_ch2 = self.vocoder.decode(mels[:,1,:,:]).squeeze(1).cpu()
-            wav = torch.cat([wav_ch1, wav_ch2],dim=0)
+        try:
+            wavs = self._decode_batched(latents, self._decode_memory_budget(memory_budget_mb))
+        except torch.cuda.OutOfMemoryError:
+            logger.warning("Out of memory in batched decode, falling back to per-channel decode")
+            torch.cuda.empty_cache()
+            wavs = self._decode_sequential(latents)
 
-            if sr is not None:
-                resampler = (
-                    torchaudio.transforms.Resample(44100, sr)
-                )
-                wav = resampler(wav.cpu().float())
-            else:
-                sr = 44100
-            pred_wavs.append(wav)
+        if sr is None:
+            sr = 44100
+        pred_wavs = []
+        for wav in wavs:
+            # resampled where the vocoder ran, before the copy to the host
+            with span("resample"):
+                wav = resample(wav.float(), 44100, sr)
+            pred_wavs.append(wav.cpu())
 
         if audio_lengths is not None:
             pred_wavs = [
@@ -143,211 +194,396 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
             ]
         return sr, pred_wavs
 
-    @torch.no_grad()
-    def decode_overlap(self, latents, audio_lengths=None, sr=None):
+    def _decode_memory_budget(self, memory_budget_mb=None):
+        """Bytes available for decode activations, None for no limit (CPU)."""
+        if memory_budget_mb is not None:
+            return memory_budget_mb * 1024 ** 2
+        if self.device.type != "cuda":
+            return None
+        free, _ = torch.cuda.mem_get_info(self.device)
+        cached = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        # leave headroom for allocator fragmentation
+        return int((free + cached) * 0.8)
+
+    def _dcae_decode_bytes(self, latent):
+        # largest decoder feature map, with a few live temporaries per block
+        config = self.dcae.config
+        block_out_channels = getattr(config, "decoder_block_out_channels", None) or config.block_out_channels
+        _, height, width = latent.shape
+        compression = 2 ** (len(block_out_channels) - 1)
+        feature_elements = max(
+            channels * (height * compression // 2 ** i) * (width * compression // 2 ** i)
+            for i, channels in enumerate(block_out_channels)
+        )
+        return 4 * feature_elements * next(self.dcae.parameters()).dtype.itemsize
+
+    def _vocoder_decode_bytes(self, mel_frames):
+        # largest upsampling stage of one channel, with the resblock temporaries
+        config = self.vocoder.config
+        feature_elements = 0
+        length = mel_frames
+        for i, rate in enumerate(config.upsample_rates):
+            length *= rate
+            channels = config.upsample_initial_channel // 2 ** (i + 1)
+            feature_elements = max(feature_elements, channels * length)
+        # set_dtypes may run the vocoder in another dtype than the DCAE
+        return 4 * feature_elements * next(self.vocoder.parameters()).dtype.itemsize
+
+    def _decode_batched(self, latents, memory_budget=None):
         """
-        Decodes latents into waveforms using an overlapped DCAE and Vocoder.
+        Decodes all items with batched DCAE calls and one vocoder batch over every
+        (item, channel) pair, sized to the memory budget.
         """
-        print("Using Overlapped DCAE and Vocoder")
+        num_items = latents.shape[0]
+        num_channels = self.dcae.config.in_channels
+        mel_frames = latents.shape[-1] * 8
+        dcae_batch_size = num_items
+        vocoder_batch_size = num_items * num_channels
+        if memory_budget is not None:
+            dcae_batch_size = min(num_items, memory_budget // self._dcae_decode_bytes(latents[0]))
+            vocoder_batch_size = min(vocoder_batch_size, memory_budget // self._vocoder_decode_bytes(mel_frames))
+        if dcae_batch_size < 1 or vocoder_batch_size < num_channels:
+            # not even one item with all its channels fits
+            return self._decode_sequential(latents)
 
-        MODEL_INTERNAL_SR = 44100
-        DCAE_LATENT_TO_MEL_STRIDE = 8
-        VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME = 512
+        mels = []
+        for start in range(0, num_items, dcae_batch_size):
+            with span("dcae_decode", batch_size=min(dcae_batch_size, num_items - start)):
+                mels.append(self.dcae.decoder(latents[start:start + dcae_batch_size]))
+        mels = self._denormalize_mels(torch.cat(mels, dim=0))
+
+        # (items, channels, n_mels, frames) -> (items * channels, n_mels, frames)
+        mels = mels.flatten(0, 1)
+        wavs = []
+        for start in range(0, mels.shape[0], vocoder_batch_size):
+            with span("vocoder", batch_size=min(vocoder_batch_size, mels.shape[0] - start)):
+                wavs.append(self.vocoder.decode(mels[start:start + vocoder_batch_size]))
+        wavs = torch.cat(wavs, dim=0).squeeze(1)
+        return list(wavs.unflatten(0, (num_items, -1)))
+
+    def _decode_sequential(self, latents):
+        wavs = []
+        for latent in latents:
+            with span("dcae_decode"):
+                mels = self.dcae.decoder(latent.unsqueeze(0))
+            mels = self._denormalize_mels(mels)
 
-        pred_wavs = []
-        final_output_sr = sr if sr is not None else MODEL_INTERNAL_SR
+            # wav = self.vocoder.decode(mels[0]).squeeze(1)
+            # decode waveform for each channels to reduce vram footprint
+            with span("vocoder", channel=0):
+                wav_ch1 = self.vocoder.decode(mels[:,0,:,:]).squeeze(1).cpu()
+            with span("vocoder", channel=1):
+                wav_ch2 = self.vocoder.decode(mels[:,1,:,:]).squeeze(1).cpu()
+            wavs.append(torch.cat([wav_ch1, wav_ch2],dim=0))
+        return wavs
+
+    def _overlap_mel_windows(self, latent_len):
+        """
+        Plans the overlapped DCAE decode of a latent with latent_len frames.
+
+        Returns (win_start, win_end, keep_start, keep_end) per window: the latent frames
+        the window decodes and the part of its mel output that is kept. The kept parts
+        of consecutive windows are contiguous in the mel domain.
+        """
+        DCAE_LATENT_TO_MEL_STRIDE = 8
 
         # --- DCAE Parameters ---
         # dcae_win_len_latent: Window length in the latent domain for DCAE processing
-        dcae_win_len_latent = 512 
-        # dcae_mel_win_len: Expected mel window length from DCAE decoder output (latent_win * stride)
-        dcae_mel_win_len = dcae_win_len_latent * 8
+        dcae_win_len_latent = 512
         # dcae_anchor_offset: Offset from anchor point to actual start of latent window slice
         dcae_anchor_offset = dcae_win_len_latent // 4
         # dcae_anchor_hop: Hop size for anchor points in latent domain
         dcae_anchor_hop = dcae_win_len_latent // 2
         # dcae_mel_overlap_len: Overlap length in the mel domain to be trimmed/blended
-        dcae_mel_overlap_len = dcae_mel_win_len // 4
-
-        # --- Vocoder Parameters ---
-        # vocoder_win_len_audio: Audio samples per vocoder processing window
-        vocoder_win_len_audio = 512 * 512 # Example: 262144 samples
-        # vocoder_overlap_len_audio: Audio samples for overlap between vocoder windows
-        vocoder_overlap_len_audio = 1024  
-        # vocoder_hop_len_audio: Hop size in audio samples for vocoder processing
-        vocoder_hop_len_audio = vocoder_win_len_audio - 2 * vocoder_overlap_len_audio
-        # vocoder_input_mel_frames_per_block: Number of mel frames fed to vocoder in one go
-        vocoder_input_mel_frames_per_block = vocoder_win_len_audio // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
-        
-        crossfade_len_audio = 128 # Audio samples for crossfading vocoder outputs
-        cf_win_tail = torch.linspace(1, 0, crossfade_len_audio, device=self.device).unsqueeze(0).unsqueeze(0)
-        cf_win_head = torch.linspace(0, 1, crossfade_len_audio, device=self.device).unsqueeze(0).unsqueeze(0)
+        dcae_mel_overlap_len = dcae_win_len_latent * DCAE_LATENT_TO_MEL_STRIDE // 4
+
+        if latent_len == 0:
+            return [] # No mel segments to generate
+
+        # Determine anchor points for DCAE windows
+        # An anchor marks a reference point for a window slice.
+        # Window slice: current_latent[..., anchor - offset : anchor - offset + win_len]
+        # First anchor ensures window starts at 0. Last anchor ensures tail is covered.
+        dcae_anchors = list(range(dcae_anchor_offset, latent_len - dcae_anchor_offset, dcae_anchor_hop))
+        if not dcae_anchors: # If latent is too short for the range, use one anchor
+            dcae_anchors = [dcae_anchor_offset]
+
+        windows = []
+        for i, anchor in enumerate(dcae_anchors):
+            win_start_idx = max(0, anchor - dcae_anchor_offset)
+            win_end_idx = min(latent_len, win_start_idx + dcae_win_len_latent)
+            mel_len = (win_end_idx - win_start_idx) * DCAE_LATENT_TO_MEL_STRIDE
+
+            is_first = (i == 0)
+            is_last = (i == len(dcae_anchors) - 1)
+            # first and last windows keep their outer edge, the overlaps are trimmed
+            keep_start = 0 if is_first else dcae_mel_overlap_len
+            keep_end = mel_len if is_last else mel_len - dcae_mel_overlap_len
+            if keep_end > keep_start:
+                windows.append((win_start_idx, win_end_idx, keep_start, keep_end))
+        return windows
+
+    def _denormalize_mels(self, mels):
+        mels = mels * 0.5 + 0.5
+        return mels * (self.max_mel_value - self.min_mel_value) + self.min_mel_value
+
+    def _write_mel_windows(self, current_latent, windows, mels, mel_offset, mel_total_frames):
+        """
+        Decodes DCAE windows of equal length in one call and writes their kept, denormalized
+        mel parts into mels (C, H_mel, mel_total_frames) from mel_offset on. mels is
+        allocated on the first call if None. Returns (mels, mel_offset after the windows).
+        """
+        with span("dcae_decode", batch_size=len(windows)):
+            mel_outputs = self.dcae.decoder(
+                torch.cat([current_latent[:, :, :, start:end] for start, end, _, _ in windows], dim=0)
+            ) # (B, C, H_mel, W_mel)
+        if mels is None:
+            mels = mel_outputs.new_empty(mel_outputs.shape[1:3] + (mel_total_frames,))
+        for mel_output, (_, _, keep_start, keep_end) in zip(mel_outputs, windows):
+            segment = mels[:, :, mel_offset:mel_offset + keep_end - keep_start]
+            segment.copy_(mel_output[:, :, keep_start:keep_end])
+            # Denormalize, in the same order of operations as _denormalize_mels
+            segment.mul_(0.5).add_(0.5).mul_(self.max_mel_value - self.min_mel_value).add_(self.min_mel_value)
+            mel_offset += keep_end - keep_start
+        return mels, mel_offset
+
+    def _overlap_vocoder_windows(self, mel_total_frames):
+        """
+        Plans the overlapped vocoder decode of mel_total_frames mel frames.
 
-        for latent_idx, latent_item in enumerate(latents):
-            latent_item = latent_item.to(self.device)
-            current_latent = (latent_item / self.scale_factor + self.shift_factor).unsqueeze(0) # (1, C, H, W_latent)
-            latent_len = current_latent.shape[3]
-
-            # 1. DCAE: Latent to Mel Spectrogram (Overlapped)
-            mels_segments = []
-            if latent_len == 0:
-                pass # No mel segments to generate
+        Returns (mel_start, mel_end, audio_start, keep_end) per window: the mel frames
+        the window decodes (zero padded to the window length), the output sample its
+        first sample lands on, and how many of its samples are kept. Every window after
+        the first is crossfaded into the previous one just before its kept part.
+        """
+        vocoder_hop_len_audio = VOCODER_WIN_LEN_AUDIO - 2 * VOCODER_OVERLAP_LEN_AUDIO
+        vocoder_input_mel_frames_per_block = VOCODER_WIN_LEN_AUDIO // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+
+        total_audio_len = mel_total_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+        windows = []
+        p_audio_samples = 0
+        while p_audio_samples == 0 or p_audio_samples < total_audio_len:
+            mel_frame_start = p_audio_samples // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+            mel_frame_end = min(mel_frame_start + vocoder_input_mel_frames_per_block, mel_total_frames)
+            # only the last of several windows keeps its end overlap
+            is_final = p_audio_samples > 0 and p_audio_samples + vocoder_hop_len_audio >= total_audio_len
+            keep_end = VOCODER_WIN_LEN_AUDIO if is_final else VOCODER_WIN_LEN_AUDIO - VOCODER_OVERLAP_LEN_AUDIO
+            windows.append((mel_frame_start, mel_frame_end, p_audio_samples, keep_end))
+            p_audio_samples += vocoder_hop_len_audio
+        return windows
+
+    def _vocoder_mel_blocks(self, mels, windows):
+        """The zero padded (B, C, H_mel, frames per window) vocoder inputs of windows."""
+        mel_blocks = mels.new_zeros(
+            len(windows), mels.shape[0], mels.shape[1],
+            VOCODER_WIN_LEN_AUDIO // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME,
+        )
+        for mel_block, (mel_frame_start, mel_frame_end, _, _) in zip(mel_blocks, windows):
+            mel_block[:, :, :mel_frame_end - mel_frame_start] = mels[:, :, mel_frame_start:mel_frame_end]
+        return mel_blocks
+
+    def _write_vocoder_window(self, audio, audio_win, audio_start, keep_end):
+        """Writes one vocoder window (C_audio, Samples) into audio, crossfading its head in place."""
+        if audio_start == 0:
+            audio[:, :keep_end] = audio_win[:, :keep_end]
+            return
+        cf_win_tail = torch.linspace(1, 0, VOCODER_CROSSFADE_LEN_AUDIO, device=audio.device)
+        cf_win_head = torch.linspace(0, 1, VOCODER_CROSSFADE_LEN_AUDIO, device=audio.device)
+        # Crossfade the previous window's tail with this window's head
+        actual_cf_len = min(
+            VOCODER_CROSSFADE_LEN_AUDIO,
+            audio_start + VOCODER_OVERLAP_LEN_AUDIO,
+            VOCODER_WIN_LEN_AUDIO - (VOCODER_OVERLAP_LEN_AUDIO - VOCODER_CROSSFADE_LEN_AUDIO),
+        )
+        cf_start = audio_start + VOCODER_OVERLAP_LEN_AUDIO - actual_cf_len
+        head_part = audio_win[:, VOCODER_OVERLAP_LEN_AUDIO - actual_cf_len:VOCODER_OVERLAP_LEN_AUDIO]
+        audio[:, cf_start:cf_start + actual_cf_len].mul_(cf_win_tail[:actual_cf_len]).add_(
+            head_part * cf_win_head[:actual_cf_len]
+        )
+        audio[:, audio_start + VOCODER_OVERLAP_LEN_AUDIO:audio_start + keep_end] = (
+            audio_win[:, VOCODER_OVERLAP_LEN_AUDIO:keep_end]
+        )
+
+    @torch.no_grad()
+    def _decode_overlap_item(self, latent_item, memory_budget=None, max_window_batch=8):
+        """
+        Decodes one latent (C, H, W_latent) with the overlapped DCAE and Vocoder into a
+        (C_audio, Samples) float32 waveform at 44.1kHz, or None if it is empty.
+
+        All window boundaries are planned up front: several DCAE tiles and vocoder windows
+        are decoded per call and written into preallocated mel and audio buffers instead
+        of growing them.
+        """
+        current_latent = (latent_item.to(self.device) / self.scale_factor + self.shift_factor).unsqueeze(0)
+
+        # 1. DCAE: Latent to Mel Spectrogram, windows of equal length batched together
+        mel_windows = self._overlap_mel_windows(current_latent.shape[3])
+        if not mel_windows:
+            return None
+        mel_total_frames = sum(keep_end - keep_start for _, _, keep_start, keep_end in mel_windows)
+        dcae_batch_size = max_window_batch
+        if memory_budget is not None:
+            win_start_idx, win_end_idx = mel_windows[0][:2]
+            window_bytes = self._dcae_decode_bytes(current_latent[0, :, :, win_start_idx:win_end_idx])
+            dcae_batch_size = max(1, min(max_window_batch, memory_budget // window_bytes))
+
+        batches = []
+        for window in mel_windows:
+            window_len = window[1] - window[0]
+            if batches and len(batches[-1]) < dcae_batch_size and batches[-1][0][1] - batches[-1][0][0] == window_len:
+                batches[-1].append(window)
             else:
-                # Determine anchor points for DCAE windows
-                # An anchor marks a reference point for a window slice.
-                # Window slice: current_latent[..., anchor - offset : anchor - offset + win_len]
-                # First anchor ensures window starts at 0. Last anchor ensures tail is covered.
-                dcae_anchors = list(range(dcae_anchor_offset, latent_len - dcae_anchor_offset, dcae_anchor_hop))
-                if not dcae_anchors: # If latent is too short for the range, use one anchor
-                    dcae_anchors = [dcae_anchor_offset]
-                
-                for i, anchor in enumerate(dcae_anchors):
-                    win_start_idx = max(0, anchor - dcae_anchor_offset)
-                    win_end_idx = min(latent_len, win_start_idx + dcae_win_len_latent)
-                    
-                    dcae_input_segment = current_latent[:, :, :, win_start_idx:win_end_idx]
-                    if dcae_input_segment.shape[3] == 0: continue
-
-                    mel_output_full = self.dcae.decoder(dcae_input_segment) # (1, C, H_mel, W_mel_fixed_from_dcae)
-
-                    is_first = (i == 0)
-                    is_last = (i == len(dcae_anchors) - 1)
-
-                    if is_first and is_last: # Only one segment
-                        # Use mel corresponding to actual input latent length
-                        true_mel_content_len = dcae_input_segment.shape[3] * DCAE_LATENT_TO_MEL_STRIDE
-                        mel_to_keep = mel_output_full[:, :, :, :min(true_mel_content_len, mel_output_full.shape[3])]
-                    elif is_first: # First segment, trim end overlap
-                        mel_to_keep = mel_output_full[:, :, :, :-dcae_mel_overlap_len]
-                    elif is_last: # Last segment, trim start overlap
-                        # And ensure we only take content relevant to the (potentially partial) last latent window
-                        # The mel_output_full is fixed length. The useful part starts after overlap.
-                        # The length of the useful part depends on how much of dcae_input_segment was actual content.
-                        # For simplicity in overlap-add, typically trim fixed overlap.
-                        # If dcae_input_segment was shorter than dcae_win_len_latent, mel_output_full might contain padding effects.
-                        # Standard OLA keeps the corresponding tail.
-                        mel_to_keep = mel_output_full[:, :, :, dcae_mel_overlap_len:]
-                    else: # Middle segment, trim both overlaps
-                        mel_to_keep = mel_output_full[:, :, :, dcae_mel_overlap_len:-dcae_mel_overlap_len]
-                    
-                    if mel_to_keep.shape[3] > 0:
-                        mels_segments.append(mel_to_keep)
-            
-            if not mels_segments:
-                num_mel_channels = current_latent.shape[1]
-                mel_height = self.dcae.decoder_output_mel_height
-                concatenated_mels = torch.empty(
-                    (1, num_mel_channels, mel_height, 0),
-                    device=current_latent.device, dtype=current_latent.dtype
+                batches.append([window])
+        mels = None
+        mel_offset = 0
+        for batch in batches:
+            mels, mel_offset = self._write_mel_windows(current_latent, batch, mels, mel_offset, mel_total_frames)
+
+        # 2. Vocoder: Mel Spectrogram to Waveform, several windows per call
+        vocoder_windows = self._overlap_vocoder_windows(mel_total_frames)
+        num_channels = mels.shape[0]
+        vocoder_batch_size = max_window_batch
+        if memory_budget is not None:
+            window_bytes = num_channels * self._vocoder_decode_bytes(
+                VOCODER_WIN_LEN_AUDIO // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+            )
+            vocoder_batch_size = max(1, min(max_window_batch, memory_budget // window_bytes))
+
+        _, _, last_audio_start, last_keep_end = vocoder_windows[-1]
+        audio = torch.empty(num_channels, last_audio_start + last_keep_end, device=self.device)
+        for batch_start in range(0, len(vocoder_windows), vocoder_batch_size):
+            batch = vocoder_windows[batch_start:batch_start + vocoder_batch_size]
+            mel_blocks = self._vocoder_mel_blocks(mels, batch)
+            with span("vocoder", batch_size=len(batch)):
+                audio_windows = self.vocoder.decode(mel_blocks.flatten(0, 1)) # (B * C_audio, 1, Samples)
+            audio_windows = audio_windows.squeeze(1).unflatten(0, (len(batch), num_channels))
+            for audio_win, (_, _, audio_start, keep_end) in zip(audio_windows, batch):
+                self._write_vocoder_window(audio, audio_win, audio_start, keep_end)
+        return audio
+
+    @torch.no_grad()
+    def _iter_overlap_audio(self, latent_item):
+        """
+        Decodes one latent (C, H, W_latent) with the overlapped DCAE and Vocoder, yielding
+        finished waveform chunks (C_audio, Samples) at 44.1kHz as soon as they are final.
+
+        Same window plan and buffers as _decode_overlap_item, one window per call: DCAE
+        windows are decoded only as far as the next vocoder window needs, and each chunk
+        is a slice of the output buffer that no later crossfade writes to.
+        """
+        current_latent = (latent_item.to(self.device) / self.scale_factor + self.shift_factor).unsqueeze(0)
+
+        mel_windows = self._overlap_mel_windows(current_latent.shape[3])
+        if not mel_windows:
+            return
+        mel_total_frames = sum(keep_end - keep_start for _, _, keep_start, keep_end in mel_windows)
+        vocoder_windows = self._overlap_vocoder_windows(mel_total_frames)
+        _, _, last_audio_start, last_keep_end = vocoder_windows[-1]
+
+        mels = None
+        mel_offset = 0
+        next_mel_window = 0
+        audio = None
+        emitted_len = 0
+        for i, window in enumerate(vocoder_windows):
+            mel_frame_end = window[1]
+            while mel_offset < mel_frame_end:
+                mels, mel_offset = self._write_mel_windows(
+                    current_latent, mel_windows[next_mel_window:next_mel_window + 1], mels, mel_offset, mel_total_frames
                 )
+                next_mel_window += 1
+            if audio is None:
+                audio = torch.empty(mels.shape[0], last_audio_start + last_keep_end, device=self.device)
+
+            with span("vocoder", window=i):
+                audio_win = self.vocoder.decode(self._vocoder_mel_blocks(mels, [window])[0]) # (C_audio, 1, Samples)
+            _, _, audio_start, keep_end = window
+            self._write_vocoder_window(audio, audio_win.squeeze(1), audio_start, keep_end)
+
+            if i + 1 < len(vocoder_windows):
+                # the next window crossfades at most this far back into the output
+                final_len = vocoder_windows[i + 1][2] + VOCODER_OVERLAP_LEN_AUDIO - VOCODER_CROSSFADE_LEN_AUDIO
             else:
-                concatenated_mels = torch.cat(mels_segments, dim=3)
+                final_len = audio.shape[1]
+            if final_len > emitted_len:
+                yield audio[:, emitted_len:final_len]
+                emitted_len = final_len
+
+    def _overlap_max_audio_length(self, latent_item, sr):
+        DCAE_LATENT_TO_MEL_STRIDE = 8
+        # Calculate expected length based on original latent, at the output sample rate
+        _num_latent_frames = latent_item.shape[-1]
+        _num_mel_frames = _num_latent_frames * DCAE_LATENT_TO_MEL_STRIDE
+        _conceptual_native_audio_len = _num_mel_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
+        return int(_conceptual_native_audio_len * sr / 44100)
 
-            # Denormalize mels
-            concatenated_mels = concatenated_mels * 0.5 + 0.5
-            concatenated_mels = concatenated_mels * (self.max_mel_value - self.min_mel_value) + self.min_mel_value
-            
-            mel_total_frames = concatenated_mels.shape[3]
+    @torch.no_grad()
+    def iter_decode_overlap(self, latents, audio_lengths=None):
+        """
+        Streaming counterpart of decode_overlap.
 
-            # 2. Vocoder: Mel Spectrogram to Waveform (Overlapped)
-            if mel_total_frames == 0:
+        Yields (index, wav_chunk) pairs, where wav_chunk is a (C_audio, Samples) CPU float
+        tensor at 44.1kHz. Chunks of one item are yielded in order and already crossfaded,
+        so concatenating them gives the same waveform as decode_overlap(latents)[1][index].
+        """
+        logger.debug("Streaming Overlapped DCAE and Vocoder")
+        for latent_idx, latent_item in enumerate(latents):
+            max_possible_len = self._overlap_max_audio_length(latent_item, 44100)
+            if audio_lengths is not None:
+                max_possible_len = min(audio_lengths[latent_idx], max_possible_len)
+
+            emitted_len = 0
+            for wav_chunk in self._iter_overlap_audio(latent_item):
+                wav_chunk = wav_chunk[:, :max(0, max_possible_len - emitted_len)]
+                if wav_chunk.shape[1] == 0:
+                    break
+                emitted_len += wav_chunk.shape[1]
+                yield latent_idx, wav_chunk.float().cpu()
+
+    @torch.no_grad()
+    def decode_overlap(self, latents, audio_lengths=None, sr=None, memory_budget_mb=None, max_window_batch=8):
+        """
+        Decodes latents into waveforms using an overlapped DCAE and Vocoder.
+
+        Up to max_window_batch DCAE tiles or vocoder windows are decoded per call,
+        fewer if they do not fit the memory budget (see decode).
+        """
+        logger.debug("Using Overlapped DCAE and Vocoder")
+
+        MODEL_INTERNAL_SR = 44100
+
+        pred_wavs = []
+        final_output_sr = sr if sr is not None else MODEL_INTERNAL_SR
+        memory_budget = self._decode_memory_budget(memory_budget_mb)
+
+        for latent_item in latents:
+            final_wav = self._decode_overlap_item(latent_item, memory_budget, max_window_batch)
+            if final_wav is None:
                 # Assuming mono or stereo output based on mel channels (typically mono for vocoder from single mel)
                 num_audio_channels = 1 # Or determine from vocoder capabilities / mel channels
                 final_wav = torch.zeros((num_audio_channels, 0), device=self.device, dtype=torch.float32)
-            else:
-                # Initial vocoder window
-                # Vocoder expects (C_mel, H_mel, W_mel_block)
-                mel_block = concatenated_mels[0, :, :, :vocoder_input_mel_frames_per_block].to(self.device)
-                
-                # Pad mel_block if it's shorter than vocoder_input_mel_frames_per_block (e.g. very short audio)
-                if 0 < mel_block.shape[2] < vocoder_input_mel_frames_per_block:
-                    pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
-                    mel_block = torch.nn.functional.pad(mel_block, (0, pad_len), mode='constant', value=0) # Pad last dim
-                
-                current_audio_output = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
-                current_audio_output = current_audio_output[:, :, :-vocoder_overlap_len_audio] # Remove end overlap
-
-                # p_audio_samples tracks the start of the *next* audio segment to generate (in conceptual total audio samples)
-                p_audio_samples = vocoder_hop_len_audio 
-                conceptual_total_audio_len_native_sr = mel_total_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
-                
-                pbar_total = 1 + max(0, (conceptual_total_audio_len_native_sr - (vocoder_win_len_audio - vocoder_overlap_len_audio))) // vocoder_hop_len_audio
-                
-                # Use tqdm if you want a progress bar for the vocoder part
-                # with tqdm(total=pbar_total, desc=f"Vocoder {latent_idx+1}/{len(latents)}", leave=False) as pbar:
-                # pbar.update(1) # For initial window
-                # The loop for subsequent windows
-                while p_audio_samples < conceptual_total_audio_len_native_sr:
-                    mel_frame_start = p_audio_samples // VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
-                    mel_frame_end = mel_frame_start + vocoder_input_mel_frames_per_block
-                    
-                    if mel_frame_start >= mel_total_frames: break # No more mel frames
-
-                    mel_block = concatenated_mels[0, :, :, mel_frame_start:min(mel_frame_end, mel_total_frames)].to(self.device)
-                    
-                    if mel_block.shape[2] == 0: break # Should not happen if mel_frame_start is valid
-
-                    # Pad if current mel_block is too short (end of sequence)
-                    if mel_block.shape[2] < vocoder_input_mel_frames_per_block:
-                        pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
-                        mel_block = torch.nn.functional.pad(mel_block, (0, pad_len), mode='constant', value=0)
-
-                    new_audio_win = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
-
-                    # Crossfade
-                    # Determine actual crossfade length based on available audio
-                    actual_cf_len = min(crossfade_len_audio, current_audio_output.shape[2], new_audio_win.shape[2] - (vocoder_overlap_len_audio - crossfade_len_audio))
-                    if actual_cf_len > 0: # Ensure valid slice lengths for crossfade
-                        tail_part = current_audio_output[:, :, -actual_cf_len:]
-                        head_part = new_audio_win[:, :, vocoder_overlap_len_audio - actual_cf_len : vocoder_overlap_len_audio]
-                        
-                        crossfaded_segment = tail_part * cf_win_tail[:,:,:actual_cf_len] + \
-                                             head_part * cf_win_head[:,:,:actual_cf_len]
-                        
-                        current_audio_output = torch.cat([current_audio_output[:, :, :-actual_cf_len], crossfaded_segment], dim=2)
-
-                    # Append non-overlapping part of new_audio_win
-                    is_final_append = (p_audio_samples + vocoder_hop_len_audio >= conceptual_total_audio_len_native_sr)
-                    if is_final_append:
-                        segment_to_append = new_audio_win[:, :, vocoder_overlap_len_audio:]
-                    else:
-                        segment_to_append = new_audio_win[:, :, vocoder_overlap_len_audio:-vocoder_overlap_len_audio]
-                    
-                    current_audio_output = torch.cat([current_audio_output, segment_to_append], dim=2)
-                    
-                    p_audio_samples += vocoder_hop_len_audio
-                    # pbar.update(1) # if using tqdm
-                
-                final_wav = current_audio_output.squeeze(1) # (C_audio, Samples)
 
             # 3. Resampling (if necessary)
             if final_output_sr != MODEL_INTERNAL_SR and final_wav.numel() > 0:
-                # Resample expects CPU tensor if using torchaudio.transforms on older versions or for some backends
-                resampler = torchaudio.transforms.Resample(
-                    MODEL_INTERNAL_SR, final_output_sr, dtype=final_wav.dtype
-                )
-                final_wav = resampler(final_wav.cpu()).to(self.device) # Move back to device if needed later
-            
+                with span("resample"):
+                    final_wav = resample(final_wav.float(), MODEL_INTERNAL_SR, final_output_sr)
+
             pred_wavs.append(final_wav)
 
         # 4. Final Truncation
         processed_pred_wavs = []
         for i, wav in enumerate(pred_wavs):
-            # Calculate expected length based on original latent, at the FINAL output sample rate
-            _num_latent_frames = latents[i].shape[-1] # Use original latent item for shape
-            _num_mel_frames = _num_latent_frames * DCAE_LATENT_TO_MEL_STRIDE
-            _conceptual_native_audio_len = _num_mel_frames * VOCODER_AUDIO_SAMPLES_PER_MEL_FRAME
-            max_possible_len = int(_conceptual_native_audio_len * final_output_sr / MODEL_INTERNAL_SR)
+            max_possible_len = self._overlap_max_audio_length(latents[i], final_output_sr)
 
             current_wav_len = wav.shape[1]
-            
+
             if audio_lengths is not None:
                 # User-provided length is the primary target, capped by actual and max possible
                 target_len = min(audio_lengths[i], current_wav_len, max_possible_len)
             else:
                 # No user length, use max possible capped by actual
                 target_len = min(max_possible_len, current_wav_len)
-            
+
             processed_pred_wavs.append(wav[:, :max(0, target_len)].cpu()) # Ensure length is non-negative
 
         return final_output_sr, processed_pred_wavs
@@ -56,10 +56,13 @@ class LinearSpectrogram(nn.Module):
             onesided=True,
             return_complex=True,
         )
-        spec = torch.view_as_real(spec)
-
         if self.mode == "pow2_sqrt":
-            spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+            # |z| from real^2 + imag^2 in place, without a stacked (..., 2) copy
+            magnitude = spec.real.square()
+            magnitude.addcmul_(spec.imag, spec.imag).add_(1e-6).sqrt_()
+            spec = magnitude
+        else:
+            spec = torch.view_as_real(spec)
         spec = spec.to(dtype)
         return spec
 
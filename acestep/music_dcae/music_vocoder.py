@@ -18,7 +18,10 @@ import numpy as np
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn.utils import weight_norm
-from torch.nn.utils.parametrize import remove_parametrizations as remove_weight_norm
+# weight_norm is the hook-based version (weight_g/weight_v keys, as in the checkpoints);
+# parametrize.remove_parametrizations raises "Module ... does not have a parametrization
+# on weight" for it, so the matching hook-based removal is imported
+from torch.nn.utils import remove_weight_norm
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.loaders import FromOriginalModelMixin
 from diffusers.configuration_utils import ConfigMixin, register_to_config
@@ -555,6 +558,10 @@ class ADaMoSHiFiGANV1(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         )
         self.eval()
 
+    def remove_weight_norm(self):
+        """Folds the weight norm into the conv weights, saving its recomputation on every forward."""
+        self.head.remove_weight_norm()
+
     @torch.no_grad()
     def decode(self, mel):
         y = self.backbone(mel)
@@ -0,0 +1,96 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import math
+import threading
+
+import torch
+import torchaudio
+
+
+_resamplers = {}
+_lock = threading.Lock()
+
+
+def get_resampler(orig_freq, new_freq, dtype=torch.float32, device="cpu"):
+    """
+    Returns a shared torchaudio Resample for (orig_freq, new_freq, dtype, device).
+
+    Building a Resample computes its sinc kernel, so the modules are created once per
+    process and reused. They hold no state besides the kernel and are safe to share.
+    """
+    device = torch.device(device)
+    key = (int(orig_freq), int(new_freq), dtype, device)
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        with _lock:
+            resampler = _resamplers.get(key)
+            if resampler is None:
+                # the kernel is built in float32 and cast, as low precision kernels are inaccurate
+                resampler = torchaudio.transforms.Resample(int(orig_freq), int(new_freq))
+                resampler = resampler.to(device=device, dtype=dtype)
+                _resamplers[key] = resampler
+    return resampler
+
+
+def resample(audio, orig_freq, new_freq):
+    """Resamples audio on its own device and in its own dtype, a no-op if the rates match."""
+    if int(orig_freq) == int(new_freq):
+        return audio
+    return get_resampler(orig_freq, new_freq, audio.dtype, audio.device)(audio)
+
+
+class StreamingResampler:
+    """
+    Resamples audio that arrives in consecutive (channels, samples) chunks as if it
+    were one signal, without clicks at the chunk boundaries.
+
+    New samples are resampled together with `context` samples of the previous chunk
+    and are only returned once `context` samples after them have arrived, so every
+    output sample sees the same neighbours as in a single resample call. The context
+    and the emitted blocks are multiples of the rate ratio, which keeps input and
+    output samples aligned. flush() returns what is left at the end of the stream.
+    """
+
+    def __init__(self, orig_freq, new_freq, context=256):
+        self.orig_freq = int(orig_freq)
+        self.new_freq = int(new_freq)
+        gcd = math.gcd(self.orig_freq, self.new_freq)
+        self.orig_step = self.orig_freq // gcd
+        self.new_step = self.new_freq // gcd
+        # well beyond the width of the sinc kernel, rounded up to whole ratio steps
+        self.context = self.orig_step * math.ceil(context / self.orig_step)
+        self.buffer = None
+        # samples at the start of the buffer that were already emitted (left context)
+        self.emitted = 0
+
+    def _output_index(self, index):
+        return index // self.orig_step * self.new_step
+
+    def __call__(self, chunk):
+        if self.orig_freq == self.new_freq:
+            return chunk
+        self.buffer = chunk if self.buffer is None else torch.cat([self.buffer, chunk], dim=-1)
+        ready = (self.buffer.shape[-1] - self.context) // self.orig_step * self.orig_step
+        if ready <= self.emitted:
+            return self.buffer[..., :0]
+        audio = resample(self.buffer[..., : ready + self.context], self.orig_freq, self.new_freq)
+        audio = audio[..., self._output_index(self.emitted) : self._output_index(ready)]
+        start = max(0, ready - self.context)
+        self.buffer = self.buffer[..., start:]
+        self.emitted = ready - start
+        return audio
+
+    def flush(self):
+        if self.buffer is None or self.orig_freq == self.new_freq:
+            return None
+        audio = resample(self.buffer, self.orig_freq, self.new_freq)
+        audio = audio[..., self._output_index(self.emitted) :]
+        self.buffer = None
+        self.emitted = 0
+        return audio
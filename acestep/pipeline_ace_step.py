@@ -6,6 +6,7 @@ https://github.com/ace-step/ACE-Step
 Apache 2.0 License
 """
 
+import contextlib
 import random
 import time
 import os
@@ -32,22 +33,36 @@ from diffusers.pipelines.stable_diffusion_3.pipeline_stable_diffusion_3 import (
     retrieve_timesteps,
 )
 from diffusers.utils.torch_utils import randn_tensor
-from diffusers.utils.peft_utils import set_weights_and_activate_adapters
-from transformers import UMT5EncoderModel, AutoTokenizer
+from transformers import UMT5Config, UMT5EncoderModel, AutoTokenizer
 
 from acestep.language_segmentation import LangSegment, language_filters
 from acestep.music_dcae.music_dcae_pipeline import MusicDCAE
 from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+from acestep.models.step_cache import StepCache
+from acestep.aot_export import AOTTransformer
+from acestep.quantization import (
+    TEXT_ENCODER_INT8_WEIGHTS,
+    TEXT_ENCODER_QUANTIZED_MODULES,
+    TRANSFORMER_INT8_WEIGHTS,
+    TRANSFORMER_QUANTIZED_MODULES,
+    load_int8_model,
+    quantize_linear_layers,
+)
 from acestep.models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
 from acestep.apg_guidance import (
     apg_forward,
+    AdaptiveGuidanceTruncation,
     MomentumBuffer,
     cfg_forward,
     cfg_zero_star,
     cfg_double_condition_forward,
 )
 import torchaudio
-from .cpu_offload import cpu_offload
+from typing import List, Union
+from .cpu_offload import cpu_offload, offload_context, OffloadManager, BlockStreamer
+from .cache_utils import LRUCache, DiskCache, hash_file
+from .lora_registry import LoRARegistry
+from .profiler import activates_profiler, get_profiler, profiled, span
 
 
 torch.backends.cudnn.benchmark = False
@@ -103,6 +118,31 @@ class ACEStepPipeline:
         cpu_offload=False,
         quantized=False,
         overlapped_decode=False,
+        cross_attention_cache=True,
+        batch_guidance_branches=True,
+        text_embedding_cache_size=128,
+        text_embedding_cache_dir=None,
+        lyric_cache_size=1024,
+        latent_cache_size=16,
+        latent_cache_dir=None,
+        lora_cache_size=4,
+        lora_cache_memory_mb=None,
+        offload_prefetch_steps=3,
+        block_streaming=False,
+        block_streaming_memory_mb=None,
+        block_streaming_resident_blocks=0,
+        decode_memory_budget_mb=None,
+        output_sample_rate=48000,
+        duration_buckets=None,
+        compile_cache_dir=None,
+        aot_transformer_dir=None,
+        device=None,
+        cpu_threads=None,
+        cpu_interop_threads=None,
+        component_dtypes=None,
+        step_cache_threshold=None,
+        step_cache_warmup_steps=2,
+        step_cache_max_skips=2,
         **kwargs,
     ):
         if not checkpoint_dir:
@@ -118,13 +158,18 @@ class ACEStepPipeline:
         self.checkpoint_dir = checkpoint_dir
         self.lora_path = "none"
         self.lora_weight = 1
-        device = (
-            torch.device(f"cuda:{device_id}")
-            if torch.cuda.is_available()
-            else torch.device("cpu")
-        )
-        if device.type == "cpu" and torch.backends.mps.is_available():
-            device = torch.device("mps")
+        if device is not None:
+            device = torch.device(device)
+            if device.type == "cuda" and device.index is None:
+                device = torch.device(f"cuda:{device_id}")
+        else:
+            device = (
+                torch.device(f"cuda:{device_id}")
+                if torch.cuda.is_available()
+                else torch.device("cpu")
+            )
+            if device.type == "cpu" and torch.backends.mps.is_available():
+                device = torch.device("mps")
         self.dtype = torch.bfloat16 if dtype == "bfloat16" else torch.float32
         if device.type == "mps" and self.dtype == torch.bfloat16:
             self.dtype = torch.float16
@@ -133,11 +178,138 @@ class ACEStepPipeline:
         if 'ACE_PIPELINE_DTYPE' in os.environ and len(os.environ['ACE_PIPELINE_DTYPE']):
             self.dtype = getattr(torch, os.environ['ACE_PIPELINE_DTYPE'])
         self.device = device
+        # dtypes of the text encoder, DCAE and vocoder, self.dtype is the transformer's
+        self.text_encoder_dtype = self.dcae_dtype = self.vocoder_dtype = self.dtype
+        if device.type == "cpu":
+            self.configure_cpu(cpu_threads, cpu_interop_threads, torch_compile)
+        self.set_component_dtypes(component_dtypes)
         self.loaded = False
         self.torch_compile = torch_compile
         self.cpu_offload = cpu_offload
+        # pinned, asynchronous offload on CUDA; other devices move models synchronously
+        self.offload_manager = (
+            OffloadManager(device) if cpu_offload and device.type == "cuda" else None
+        )
+        # start uploading the DCAE this many steps before diffusion ends
+        self.offload_prefetch_steps = offload_prefetch_steps
+        # page transformer blocks through the device instead of loading the whole model
+        if block_streaming and device.type != "cuda":
+            logger.warning("block_streaming requires a CUDA device, disabling it")
+            block_streaming = False
+        self.block_streaming = block_streaming
+        self.block_streaming_memory_mb = block_streaming_memory_mb
+        self.block_streaming_resident_blocks = block_streaming_resident_blocks
+        self.block_streamer = None
+        # activation memory for batched DCAE/vocoder decoding, free device memory if None
+        self.decode_memory_budget_mb = decode_memory_budget_mb
+        # the vocoder runs at 44.1kHz, output_sample_rate=44100 skips resampling
+        self.output_sample_rate = output_sample_rate
+        # durations (seconds) the transformer input is padded up to, so that compiled
+        # kernels are only built for a few sequence lengths
+        self.frame_length_buckets = sorted(
+            int(duration * 44100 / 512 / 8) for duration in duration_buckets or ()
+        )
+        # inductor artifacts are kept here across restarts
+        if torch_compile and compile_cache_dir is None:
+            compile_cache_dir = os.path.join(checkpoint_dir, "torch_compile_cache")
+        self.compile_cache_dir = compile_cache_dir
+        # AOTInductor packages from acestep.aot_export, used for encode/decode where possible
+        self.aot_transformer_dir = aot_transformer_dir
+        self.aot_transformer = None
+        # models that manage their own placement and skip whole-model offload
+        self.streamed_models = {"ace_step_transformer"} if block_streaming else set()
+        # True/"int4": torchao int4 weight-only export, "int8": int8 dynamic (CPU)
         self.quantized = quantized
         self.overlapped_decode = overlapped_decode
+        # dynamo cannot trace the python-side cache, so it is only used in eager mode.
+        # The cached K/V of every block stay on the device for the whole diffusion,
+        # which block_streaming is meant to avoid, so the two are exclusive
+        if cross_attention_cache and block_streaming:
+            logger.info("cross_attention_cache keeps every block's K/V on the device, disabling it for block_streaming")
+        self.cross_attention_cache = cross_attention_cache and not torch_compile and not block_streaming
+        # run cond/uncond(/only-text) guidance branches as one batched decode per step;
+        # disable to trade speed for a lower activation peak
+        self.batch_guidance_branches = batch_guidance_branches
+        # reuse the transformer blocks' residual across steps whose input changed less
+        # than this (relative L1), None runs every block at every step
+        self.step_cache_threshold = step_cache_threshold
+        self.step_cache_warmup_steps = step_cache_warmup_steps
+        self.step_cache_max_skips = step_cache_max_skips
+        # StepCache.summary() of the last text2music diffusion, None without step cache
+        self.last_step_cache_stats = None
+        # AdaptiveGuidanceTruncation.summary() of the last text2music diffusion
+        self.last_guidance_truncation_stats = None
+        # prompt embeddings are reused across requests (genre presets, retakes)
+        self.text_embedding_cache = LRUCache(text_embedding_cache_size)
+        self.text_embedding_disk_cache = (
+            DiskCache(text_embedding_cache_dir) if text_embedding_cache_dir else None
+        )
+        # lyric lines repeat within songs (choruses) and whole lyrics across retakes
+        self.lyric_line_cache = LRUCache(lyric_cache_size)
+        self.lyric_cache = LRUCache(max(lyric_cache_size // 16, 1) if lyric_cache_size else 0)
+        # DCAE latents of source/reference audio, keyed by file content
+        self.latent_cache = LRUCache(latent_cache_size)
+        self.latent_disk_cache = DiskCache(latent_cache_dir) if latent_cache_dir else None
+        # resident LoRA adapters, created with the transformer in load_lora
+        self.lora_registry = None
+        self.lora_cache_size = lora_cache_size
+        self.lora_cache_memory_mb = lora_cache_memory_mb
+
+    def configure_cpu(self, num_threads=None, num_interop_threads=None, torch_compile=False):
+        """
+        CPU profile: sizes the thread pools, falls back from bfloat16 to float32 where
+        the CPU has no native bfloat16 and keeps the vocoder in float32.
+
+        The thread pools and inductor settings are process-wide, so they apply to every
+        pipeline in the process.
+        """
+        if num_threads is None:
+            # torch sizes its pool from the host, not from the cores this process may use
+            num_threads = torch.get_num_threads()
+            if hasattr(os, "sched_getaffinity"):
+                num_threads = min(num_threads, len(os.sched_getaffinity(0)))
+        torch.set_num_threads(num_threads)
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError as e:
+                # only possible before the first inter-op parallel work in the process
+                logger.warning(f"Could not set inter-op threads: {e}")
+        if torch_compile:
+            # constant-folds the weights so inductor can prepack them for oneDNN and
+            # fuse convolutions/linears with their epilogues
+            import torch._inductor.config as inductor_config
+
+            inductor_config.freezing = True
+
+        bf16_supported = (
+            torch.backends.mkldnn.is_available()
+            and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        )
+        if self.dtype == torch.bfloat16 and not bf16_supported:
+            logger.warning("This CPU has no native bfloat16 support, using float32")
+            self.dtype = torch.float32
+        self.text_encoder_dtype = self.dcae_dtype = self.dtype
+        self.vocoder_dtype = torch.float32
+        logger.info(
+            f"CPU profile: {torch.get_num_threads()} threads, transformer/text encoder/DCAE "
+            f"{self.dtype}, vocoder {self.vocoder_dtype}"
+        )
+
+    def set_component_dtypes(self, component_dtypes=None):
+        """Overrides per component dtypes, e.g. {"transformer": "bfloat16", "vocoder": "float32"}."""
+        attributes = {
+            "transformer": "dtype",
+            "text_encoder": "text_encoder_dtype",
+            "dcae": "dcae_dtype",
+            "vocoder": "vocoder_dtype",
+        }
+        for component, dtype in (component_dtypes or {}).items():
+            if component not in attributes:
+                raise ValueError(
+                    f"Unknown component {component}, expected one of {', '.join(attributes)}"
+                )
+            setattr(self, attributes[component], getattr(torch, dtype) if isinstance(dtype, str) else dtype)
 
     def cleanup_memory(self):
         """Clean up GPU and CPU memory to prevent VRAM overflow during multiple generations."""
@@ -154,6 +326,15 @@ class ACEStepPipeline:
         import gc
         gc.collect()
 
+    @profiled("load_model")
+    def ensure_loaded(self):
+        if not self.loaded:
+            logger.warning("Checkpoint not loaded, loading checkpoint...")
+            if self.quantized:
+                self.load_quantized_checkpoint(self.checkpoint_dir)
+            else:
+                self.load_checkpoint(self.checkpoint_dir)
+
     def get_checkpoint_path(self, checkpoint_dir, repo):
         checkpoint_dir_models = None
         
@@ -190,7 +371,7 @@ class ACEStepPipeline:
             ace_step_checkpoint_path, torch_dtype=self.dtype
         )
         # self.ace_step_transformer.to(self.device).eval().to(self.dtype)
-        if self.cpu_offload:
+        if self.cpu_offload or self.block_streaming:
             self.ace_step_transformer = (
                 self.ace_step_transformer.to("cpu").eval().to(self.dtype)
             )
@@ -198,7 +379,21 @@ class ACEStepPipeline:
             self.ace_step_transformer = (
                 self.ace_step_transformer.to(self.device).eval().to(self.dtype)
             )
+        if self.block_streaming:
+            self.block_streamer = BlockStreamer(
+                self.ace_step_transformer,
+                self.ace_step_transformer.transformer_blocks,
+                self.device,
+                resident_blocks=self.block_streaming_resident_blocks,
+                memory_budget_mb=self.block_streaming_memory_mb,
+            ).enable()
+        if self.aot_transformer_dir:
+            self.load_aot_transformer()
         if self.torch_compile:
+            self.configure_compile_cache()
+        # the streaming hooks move weights, which dynamo cannot trace
+        if self.torch_compile and not self.block_streaming:
+            self.compile_transformer_blocks()
             self.ace_step_transformer = torch.compile(self.ace_step_transformer)
 
         self.music_dcae = MusicDCAE(
@@ -207,9 +402,13 @@ class ACEStepPipeline:
         )
         # self.music_dcae.to(self.device).eval().to(self.dtype)
         if self.cpu_offload:  # might be redundant
-            self.music_dcae = self.music_dcae.to("cpu").eval().to(self.dtype)
+            self.music_dcae = self.music_dcae.to("cpu").eval()
         else:
-            self.music_dcae = self.music_dcae.to(self.device).eval().to(self.dtype)
+            self.music_dcae = self.music_dcae.to(self.device).eval()
+        self.music_dcae.set_dtypes(self.dcae_dtype, self.vocoder_dtype)
+        if self.device.type == "cpu":
+            # CPU inference profile, see configure_cpu
+            self.music_dcae.set_channels_last().fold_vocoder_weight_norm()
         if self.torch_compile:
             self.music_dcae = torch.compile(self.music_dcae)
 
@@ -219,13 +418,13 @@ class ACEStepPipeline:
         self.lyric_tokenizer = VoiceBpeTokenizer()
 
         text_encoder_model = UMT5EncoderModel.from_pretrained(
-            text_encoder_checkpoint_path, torch_dtype=self.dtype
+            text_encoder_checkpoint_path, torch_dtype=self.text_encoder_dtype
         ).eval()
         # text_encoder_model = text_encoder_model.to(self.device).to(self.dtype)
         if self.cpu_offload:
-            text_encoder_model = text_encoder_model.to("cpu").eval().to(self.dtype)
+            text_encoder_model = text_encoder_model.to("cpu").eval().to(self.text_encoder_dtype)
         else:
-            text_encoder_model = text_encoder_model.to(self.device).eval().to(self.dtype)
+            text_encoder_model = text_encoder_model.to(self.device).eval().to(self.text_encoder_dtype)
         text_encoder_model.requires_grad_(False)
         self.text_encoder_model = text_encoder_model
         if self.torch_compile:
@@ -277,7 +476,105 @@ class ACEStepPipeline:
                     os.path.join(text_encoder_checkpoint_path, "pytorch_model_int4wo.bin"),
                 )
 
+        if self.torch_compile and self.frame_length_buckets:
+            self.warmup_duration_buckets()
+
+    def load_aot_transformer(self):
+        """Loads the AOT packages, keeping the eager transformer if they do not match."""
+        try:
+            aot_transformer = AOTTransformer(self.aot_transformer_dir)
+        except Exception as e:
+            logger.warning(f"Failed to load AOT transformer from {self.aot_transformer_dir}: {e}")
+            return
+        if not aot_transformer.supports(self.device, self.dtype):
+            logger.warning(
+                f"AOT transformer was compiled for {aot_transformer.device_type}/{aot_transformer.dtype}, "
+                f"not {self.device.type}/{self.dtype}, using the eager transformer"
+            )
+            return
+        self.aot_transformer = aot_transformer
+        logger.info(f"Loaded AOT transformer from {self.aot_transformer_dir}")
+
+    def configure_compile_cache(self):
+        """Keeps inductor's compiled artifacts in compile_cache_dir, reloading saved ones."""
+        if self.compile_cache_dir is None:
+            return
+        os.makedirs(self.compile_cache_dir, exist_ok=True)
+        os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR", os.path.join(self.compile_cache_dir, "inductor")
+        )
+        import torch._inductor.config as inductor_config
+
+        inductor_config.fx_graph_cache = True
+        artifacts_path = os.path.join(self.compile_cache_dir, "cache_artifacts.bin")
+        if os.path.exists(artifacts_path) and hasattr(torch.compiler, "load_cache_artifacts"):
+            with open(artifacts_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            logger.info(f"Loaded torch.compile artifacts from {artifacts_path}")
+
+    def save_compile_cache(self):
+        if self.compile_cache_dir is None or not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        artifacts_path = os.path.join(self.compile_cache_dir, "cache_artifacts.bin")
+        with open(artifacts_path + ".tmp", "wb") as f:
+            f.write(artifacts[0])
+        os.replace(artifacts_path + ".tmp", artifacts_path)
+        logger.info(f"Saved torch.compile artifacts to {artifacts_path}")
+
+    def compile_transformer_blocks(self):
+        # the diffusion loop calls decode, which compiling the model (forward) does not
+        # cover, so the blocks are compiled in place; they share their compiled code
+        variants = 8 * (len(self.frame_length_buckets) + 1)
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, variants
+        )
+        for block in self.ace_step_transformer.transformer_blocks:
+            block.compile()
+
+    def bucket_frame_length(self, frame_length):
+        """The smallest duration bucket holding frame_length latent frames, or frame_length."""
+        for bucket in self.frame_length_buckets:
+            if bucket >= frame_length:
+                return bucket
+        return frame_length
+
+    def warmup_duration_buckets(self, infer_steps=4):
+        """
+        Runs a short generation for every duration bucket, so that the compiled kernels of
+        all buckets are built (or loaded from the compile cache) before the first request.
+        """
+        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings_batch(["warmup"])
+        encoder_text_hidden_states_null = self.get_text_embeddings_null_batch(["warmup"])
+        lyric_token_idx, lyric_mask = self.tokenize_lyrics_batch(["[inst]"])
+        speaker_embeds = torch.zeros(1, 512).to(self.device).to(self.dtype)
+        for frame_length in self.frame_length_buckets:
+            start_time = time.time()
+            random_generators, _ = self.set_seeds(1, "0")
+            # 4 steps cover both the guided and the unguided steps
+            self.text2music_diffusion_process(
+                duration=frame_length * 512 * 8 / 44100,
+                encoder_text_hidden_states=encoder_text_hidden_states,
+                text_attention_mask=text_attention_mask,
+                speaker_embds=speaker_embeds,
+                lyric_token_ids=lyric_token_idx,
+                lyric_mask=lyric_mask,
+                random_generators=random_generators,
+                infer_steps=infer_steps,
+                encoder_text_hidden_states_null=encoder_text_hidden_states_null,
+                use_erg_lyric=True,
+                use_erg_diffusion=True,
+            )
+            logger.info(
+                f"Warmed up {frame_length} frame bucket in {time.time() - start_time:.2f} seconds"
+            )
+        self.save_compile_cache()
+
     def load_quantized_checkpoint(self, checkpoint_dir=None):
+        if self.quantized == "int8":
+            return self.load_int8_checkpoint(checkpoint_dir)
         checkpoint_dir = self.get_checkpoint_path(checkpoint_dir, REPO_ID_QUANT)
         dcae_checkpoint_path = os.path.join(checkpoint_dir, "music_dcae_f8c8")
         vocoder_checkpoint_path = os.path.join(checkpoint_dir, "music_vocoder")
@@ -289,18 +586,23 @@ class ACEStepPipeline:
             vocoder_checkpoint_path=vocoder_checkpoint_path,
         )
         if self.cpu_offload:
-            self.music_dcae.eval().to(self.dtype).to(self.device)
-        else:
             self.music_dcae.eval().to(self.dtype).to('cpu')
+        else:
+            self.music_dcae.eval().to(self.dtype).to(self.device)
+        self.music_dcae.set_dtypes(self.dcae_dtype, self.vocoder_dtype)
         self.music_dcae = torch.compile(self.music_dcae)
 
+        # The models are built on the CPU and load_state_dict(assign=True) then swaps in
+        # the int4 tensors as they were loaded, so map_location decides their device:
+        # the CPU when cpu_offload moves them in and out, the device otherwise
+        weights_device = "cpu" if self.cpu_offload else self.device
         self.ace_step_transformer = ACEStepTransformer2DModel.from_pretrained(ace_step_checkpoint_path)
         self.ace_step_transformer.eval().to(self.dtype).to('cpu')
         self.ace_step_transformer = torch.compile(self.ace_step_transformer)
         self.ace_step_transformer.load_state_dict(
             torch.load(
                 os.path.join(ace_step_checkpoint_path, "diffusion_pytorch_model_int4wo.bin"),
-                map_location=self.device,
+                map_location=weights_device,
             ),assign=True
         )
         self.ace_step_transformer.torchao_quantized = True
@@ -311,7 +613,7 @@ class ACEStepPipeline:
         self.text_encoder_model.load_state_dict(
             torch.load(
                 os.path.join(text_encoder_checkpoint_path, "pytorch_model_int4wo.bin"),
-                map_location=self.device,
+                map_location=weights_device,
             ), assign=True
         )
         self.text_encoder_model.torchao_quantized = True
@@ -327,8 +629,140 @@ class ACEStepPipeline:
 
         self.loaded = True
 
-    @cpu_offload("text_encoder_model")
+    def load_int8_checkpoint(self, checkpoint_dir=None):
+        """
+        Loads the transformer and UMT5 with int8 dynamically quantized linear layers,
+        written by `python -m acestep.quantization`. Without those files the float
+        weights are quantized while loading.
+        """
+        checkpoint_dir = self.get_checkpoint_path(checkpoint_dir, REPO_ID)
+        dcae_checkpoint_path = os.path.join(checkpoint_dir, "music_dcae_f8c8")
+        vocoder_checkpoint_path = os.path.join(checkpoint_dir, "music_vocoder")
+        ace_step_checkpoint_path = os.path.join(checkpoint_dir, "ace_step_transformer")
+        text_encoder_checkpoint_path = os.path.join(checkpoint_dir, "umt5-base")
+        # int8 models are placed once, cpu_offload only moves the DCAE
+        device = self.device
+
+        def load(model_class, checkpoint_path, weights_name, modules, build, dtype):
+            weights_path = os.path.join(checkpoint_path, weights_name)
+            if os.path.exists(weights_path):
+                return load_int8_model(build, weights_path, modules, device=device, dtype=dtype)
+            logger.warning(
+                f"{weights_path} not found, quantizing {model_class.__name__} while loading"
+            )
+            model = model_class.from_pretrained(checkpoint_path, torch_dtype=dtype)
+            quantize_linear_layers(model, modules)
+            return model.to(device).eval()
+
+        self.ace_step_transformer = load(
+            ACEStepTransformer2DModel,
+            ace_step_checkpoint_path,
+            TRANSFORMER_INT8_WEIGHTS,
+            TRANSFORMER_QUANTIZED_MODULES,
+            lambda: ACEStepTransformer2DModel.from_config(
+                ACEStepTransformer2DModel.load_config(ace_step_checkpoint_path)
+            ),
+            self.dtype,
+        )
+        self.ace_step_transformer.int8_quantized = True
+
+        text_encoder_model = load(
+            UMT5EncoderModel,
+            text_encoder_checkpoint_path,
+            TEXT_ENCODER_INT8_WEIGHTS,
+            TEXT_ENCODER_QUANTIZED_MODULES,
+            lambda: UMT5EncoderModel(UMT5Config.from_pretrained(text_encoder_checkpoint_path)),
+            self.text_encoder_dtype,
+        )
+        text_encoder_model.requires_grad_(False)
+        text_encoder_model.int8_quantized = True
+        self.text_encoder_model = text_encoder_model
+
+        self.music_dcae = MusicDCAE(
+            dcae_checkpoint_path=dcae_checkpoint_path,
+            vocoder_checkpoint_path=vocoder_checkpoint_path,
+        )
+        if self.cpu_offload:
+            self.music_dcae = self.music_dcae.to("cpu").eval()
+        else:
+            self.music_dcae = self.music_dcae.to(self.device).eval()
+        self.music_dcae.set_dtypes(self.dcae_dtype, self.vocoder_dtype)
+        if self.device.type == "cpu":
+            # CPU inference profile, see configure_cpu
+            self.music_dcae.set_channels_last().fold_vocoder_weight_norm()
+
+        self.text_tokenizer = AutoTokenizer.from_pretrained(
+            text_encoder_checkpoint_path
+        )
+
+        lang_segment = LangSegment()
+        lang_segment.setfilters(language_filters.default)
+        self.lang_segment = lang_segment
+        self.lyric_tokenizer = VoiceBpeTokenizer()
+
+        self.loaded = True
+
+    def cache_stats(self):
+        stats = {
+            "text_embeddings": self.text_embedding_cache.stats(),
+            "lyric_lines": self.lyric_line_cache.stats(),
+            "lyrics": self.lyric_cache.stats(),
+        }
+        if self.text_embedding_disk_cache is not None:
+            stats["text_embeddings_disk"] = self.text_embedding_disk_cache.stats()
+        stats["latents"] = self.latent_cache.stats()
+        if self.lora_registry is not None:
+            stats["lora"] = self.lora_registry.stats()
+        if self.latent_disk_cache is not None:
+            stats["latents_disk"] = self.latent_disk_cache.stats()
+        return stats
+
+    def get_cached_text_embeddings(self, key, encode):
+        """
+        Returns the tensors of `encode()` for `key` from the memory or disk cache,
+        running the text encoder only on a miss.
+        """
+        key = key + (str(self.text_encoder_dtype), str(self.dtype), str(self.quantized))
+        tensors = self.text_embedding_cache.get(key)
+        if tensors is None and self.text_embedding_disk_cache is not None:
+            tensors = self.text_embedding_disk_cache.get(key, device=self.device)
+            if tensors is not None:
+                self.text_embedding_cache.put(key, tensors)
+        if tensors is None:
+            tensors = encode()
+            self.text_embedding_cache.put(key, tensors)
+            if self.text_embedding_disk_cache is not None:
+                self.text_embedding_disk_cache.put(key, tensors)
+        # copied so that callers can never modify the cached entry
+        return {name: tensor.to(self.device, copy=True) for name, tensor in tensors.items()}
+
     def get_text_embeddings(self, texts, text_max_length=256):
+        tensors = self.get_cached_text_embeddings(
+            ("text", tuple(texts), text_max_length),
+            lambda: dict(
+                zip(
+                    ("last_hidden_states", "attention_mask"),
+                    self.encode_text(texts, text_max_length),
+                )
+            ),
+        )
+        return tensors["last_hidden_states"], tensors["attention_mask"]
+
+    def get_text_embeddings_null(
+        self, texts, text_max_length=256, tau=0.01, l_min=8, l_max=10
+    ):
+        tensors = self.get_cached_text_embeddings(
+            ("text_null", tuple(texts), text_max_length, tau, l_min, l_max),
+            lambda: {
+                "last_hidden_states": self.encode_text_null(
+                    texts, text_max_length, tau, l_min, l_max
+                )
+            },
+        )
+        return tensors["last_hidden_states"]
+
+    @cpu_offload("text_encoder_model")
+    def encode_text(self, texts, text_max_length=256):
         inputs = self.text_tokenizer(
             texts,
             return_tensors="pt",
@@ -341,12 +775,12 @@ class ACEStepPipeline:
             self.text_encoder_model.to(self.device)
         with torch.no_grad():
             outputs = self.text_encoder_model(**inputs)
-            last_hidden_states = outputs.last_hidden_state
+            last_hidden_states = outputs.last_hidden_state.to(self.dtype)
         attention_mask = inputs["attention_mask"]
         return last_hidden_states, attention_mask
 
     @cpu_offload("text_encoder_model")
-    def get_text_embeddings_null(
+    def encode_text_null(
         self, texts, text_max_length=256, tau=0.01, l_min=8, l_max=10
     ):
         inputs = self.text_tokenizer(
@@ -377,7 +811,7 @@ class ACEStepPipeline:
 
             with torch.no_grad():
                 outputs = self.text_encoder_model(**inputs)
-                last_hidden_states = outputs.last_hidden_state
+                last_hidden_states = outputs.last_hidden_state.to(self.dtype)
 
             for hook in handlers:
                 hook.remove()
@@ -387,7 +821,9 @@ class ACEStepPipeline:
         last_hidden_states = forward_with_temperature(inputs, tau, l_min, l_max)
         return last_hidden_states
 
-    def set_seeds(self, batch_size, manual_seeds=None):
+    @staticmethod
+    def parse_seeds(manual_seeds=None):
+        """Seeds as an int, a list of ints (one per sample) or None for random seeds."""
         processed_input_seeds = None
         if manual_seeds is not None:
             if isinstance(manual_seeds, str):
@@ -402,6 +838,10 @@ class ACEStepPipeline:
                     processed_input_seeds = list(manual_seeds)
             elif isinstance(manual_seeds, int):
                 processed_input_seeds = manual_seeds
+        return processed_input_seeds
+
+    def set_seeds(self, batch_size, manual_seeds=None):
+        processed_input_seeds = self.parse_seeds(manual_seeds)
         random_generators = [
             torch.Generator(device=self.device) for _ in range(batch_size)
         ]
@@ -436,37 +876,141 @@ class ACEStepPipeline:
         return language
 
     def tokenize_lyrics(self, lyrics, debug=False):
+        # debug logs every line, so it always goes through the tokenizer
+        if debug:
+            return self._tokenize_lyrics(lyrics, debug=True)[0]
+        lyric_token_idx = self.lyric_cache.get(lyrics)
+        if lyric_token_idx is None:
+            lyric_token_idx, complete = self._tokenize_lyrics(lyrics)
+            # lyrics with lines the tokenizer failed on are retried next time
+            if complete:
+                self.lyric_cache.put(lyrics, lyric_token_idx)
+        return list(lyric_token_idx)
+
+    def tokenize_lyric_line(self, line, debug=False):
+        """Returns (lang, token_ids) of one stripped lyric line, token_ids is None on tokenizer errors."""
+        if not debug:
+            cached = self.lyric_line_cache.get(line)
+            if cached is not None:
+                return cached
+
+        lang = self.get_lang(line)
+
+        if lang not in SUPPORT_LANGUAGES:
+            lang = "en"
+        if "zh" in lang:
+            lang = "zh"
+        if "spa" in lang:
+            lang = "es"
+
+        token_idx = None
+        try:
+            if structure_pattern.match(line):
+                token_idx = self.lyric_tokenizer.encode(line, "en")
+            else:
+                token_idx = self.lyric_tokenizer.encode(line, lang)
+            if debug:
+                toks = self.lyric_tokenizer.batch_decode(
+                    [[tok_id] for tok_id in token_idx]
+                )
+                logger.info(f"debbug {line} --> {lang} --> {toks}")
+            token_idx = tuple(token_idx)
+        except Exception as e:
+            # not cached, the line is tokenized again next time
+            logger.warning(f"tokenize error {e} for line {line} major_language {lang}")
+            return lang, None
+
+        if not debug:
+            self.lyric_line_cache.put(line, (lang, token_idx))
+        return lang, token_idx
+
+    def _tokenize_lyrics(self, lyrics, debug=False):
+        """Returns the token ids of `lyrics` and whether every line could be tokenized."""
         lines = lyrics.split("\n")
         lyric_token_idx = [261]
+        complete = True
         for line in lines:
             line = line.strip()
             if not line:
                 lyric_token_idx += [2]
                 continue
 
-            lang = self.get_lang(line)
+            _, token_idx = self.tokenize_lyric_line(line, debug=debug)
+            if token_idx is not None:
+                lyric_token_idx = lyric_token_idx + list(token_idx) + [2]
+            else:
+                complete = False
+        return lyric_token_idx, complete
+
+    @profiled("lyric_tokenizer")
+    def tokenize_lyrics_batch(self, lyrics_list, debug=False):
+        """Tokenize one lyric per sample and right-pad to the longest, returning (token_ids, mask)."""
+        token_idx_list = []
+        for lyrics in lyrics_list:
+            if lyrics is not None and len(lyrics) > 0:
+                token_idx_list.append(self.tokenize_lyrics(lyrics, debug=debug))
+            else:
+                token_idx_list.append(None)
 
-            if lang not in SUPPORT_LANGUAGES:
-                lang = "en"
-            if "zh" in lang:
-                lang = "zh"
-            if "spa" in lang:
-                lang = "es"
+        max_length = max([len(token_idx) for token_idx in token_idx_list if token_idx is not None] + [1])
+        lyric_token_idx = torch.zeros(len(lyrics_list), max_length, dtype=torch.long)
+        lyric_mask = torch.zeros(len(lyrics_list), max_length, dtype=torch.long)
+        for i, token_idx in enumerate(token_idx_list):
+            if token_idx is None:
+                continue
+            lyric_token_idx[i, : len(token_idx)] = torch.tensor(token_idx)
+            lyric_mask[i, : len(token_idx)] = 1
+        return lyric_token_idx.to(self.device), lyric_mask.to(self.device)
+
+    def get_batch_size(self, batch_size, manual_seeds=None, **per_sample_args):
+        """
+        Infer the batch size from the per-sample (list) arguments and check they agree.
+        A seed list only sets the batch size when batch_size is None, an explicit
+        batch_size pads or truncates it (see set_seeds).
+        """
+        if batch_size is None:
+            per_sample_args["manual_seeds"] = manual_seeds
+        lengths = {
+            name: len(value)
+            for name, value in per_sample_args.items()
+            if isinstance(value, (list, tuple)) and len(value) > 1
+        }
+        if not lengths:
+            return batch_size or 1
+        if len(set(lengths.values())) > 1:
+            raise ValueError(f"Per-sample arguments have different lengths: {lengths}")
+        list_batch_size = next(iter(lengths.values()))
+        if batch_size is not None and batch_size > 1 and batch_size != list_batch_size:
+            raise ValueError(
+                f"batch_size={batch_size} does not match per-sample arguments: {lengths}"
+            )
+        return list_batch_size
+
+    @staticmethod
+    def expand_to_batch(value, batch_size):
+        """Return `value` as a list with one entry per sample."""
+        if isinstance(value, (list, tuple)):
+            if len(value) == 1:
+                return list(value) * batch_size
+            return list(value)
+        return [value] * batch_size
+
+    @profiled("text_encoder")
+    def get_text_embeddings_batch(self, prompts):
+        """Encode one prompt per sample, running the text encoder once if they are all the same."""
+        if len(set(prompts)) == 1:
+            encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(prompts[:1])
+            encoder_text_hidden_states = encoder_text_hidden_states.repeat(len(prompts), 1, 1)
+            text_attention_mask = text_attention_mask.repeat(len(prompts), 1)
+        else:
+            encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(prompts)
+        return encoder_text_hidden_states, text_attention_mask
 
-            try:
-                if structure_pattern.match(line):
-                    token_idx = self.lyric_tokenizer.encode(line, "en")
-                else:
-                    token_idx = self.lyric_tokenizer.encode(line, lang)
-                if debug:
-                    toks = self.lyric_tokenizer.batch_decode(
-                        [[tok_id] for tok_id in token_idx]
-                    )
-                    logger.info(f"debbug {line} --> {lang} --> {toks}")
-                lyric_token_idx = lyric_token_idx + token_idx + [2]
-            except Exception as e:
-                print("tokenize error", e, "for line", line, "major_language", lang)
-        return lyric_token_idx
+    @profiled("text_encoder_null")
+    def get_text_embeddings_null_batch(self, prompts):
+        if len(set(prompts)) == 1:
+            return self.get_text_embeddings_null(prompts[:1]).repeat(len(prompts), 1, 1)
+        return self.get_text_embeddings_null(prompts)
 
     @cpu_offload("ace_step_transformer")
     def calc_v(
@@ -562,6 +1106,7 @@ class ACEStepPipeline:
                 )
         return noise_pred_src, noise_pred_tar
 
+    @profiled("diffusion")
     @torch.no_grad()
     def flowedit_diffusion_process(
         self,
@@ -806,6 +1351,7 @@ class ACEStepPipeline:
         logger.info(f"{scheduler.sigma_min=} {scheduler.sigma_max=} {timesteps=} {num_inference_steps=}")
         return noisy_image, timesteps, scheduler, num_inference_steps
 
+    @profiled("diffusion")
     @cpu_offload("ace_step_transformer")
     @torch.no_grad()
     def text2music_diffusion_process(
@@ -842,6 +1388,8 @@ class ACEStepPipeline:
         audio2audio_enable=False,
         ref_audio_strength=0.5,
         ref_latents=None,
+        guidance_truncation_threshold=None,
+        guidance_truncation_patience=3,
     ):
 
         logger.info(
@@ -850,7 +1398,19 @@ class ACEStepPipeline:
             )
         )
         do_classifier_free_guidance = True
-        if guidance_scale == 0.0 or guidance_scale == 1.0:
+        no_guidance_mask = None
+        if isinstance(guidance_scale, (list, tuple)):
+            # per-sample guidance, 0.0 and 1.0 both mean "no guidance" for that sample
+            no_guidance = [g in (0.0, 1.0) for g in guidance_scale]
+            if all(no_guidance):
+                do_classifier_free_guidance = False
+            no_guidance_mask = torch.tensor(no_guidance, device=self.device).view(-1, 1, 1, 1)
+            guidance_scale = torch.tensor(
+                [1.0 if g == 0.0 else g for g in guidance_scale],
+                device=self.device,
+                dtype=self.dtype,
+            ).view(-1, 1, 1, 1)
+        elif guidance_scale == 0.0 or guidance_scale == 1.0:
             do_classifier_free_guidance = False
 
         do_double_condition_guidance = False
@@ -1064,7 +1624,33 @@ class ACEStepPipeline:
                 infer_steps=infer_steps,
             )
 
-        attention_mask = torch.ones(bsz, frame_length, device=self.device, dtype=self.dtype)
+        # with duration buckets the transformer sees latents padded to the bucket length;
+        # the padding is masked and output_length trims it from the predictions, so
+        # guidance and scheduler steps stay on the real frames
+        bucket_length = self.bucket_frame_length(frame_length)
+        attention_mask = torch.ones(bsz, bucket_length, device=self.device, dtype=self.dtype)
+        attention_mask[:, frame_length:] = 0
+        # passed to every eager decode instead of checking the mask on the device
+        attention_mask_is_full = bucket_length == frame_length
+
+        def pad_to_bucket(latents):
+            if latents.shape[-1] >= bucket_length:
+                return latents
+            return torch.nn.functional.pad(latents, (0, bucket_length - latents.shape[-1]))
+
+        # the AOT packages have no LoRA adapters and no padding support
+        aot_transformer = self.aot_transformer
+        if aot_transformer is not None and (
+            self.lora_path != "none"
+            or bucket_length != frame_length
+            or frame_length > aot_transformer.max_frame_length
+        ):
+            aot_transformer = None
+        transformer_encode = (
+            aot_transformer.encode
+            if aot_transformer is not None
+            else self.ace_step_transformer.encode
+        )
 
         # guidance interval
         start_idx = int(num_inference_steps * ((1 - guidance_interval) / 2))
@@ -1074,6 +1660,16 @@ class ACEStepPipeline:
         )
 
         momentum_buffer = MomentumBuffer()
+        # stop evaluating the unconditional branches once guidance no longer changes
+        # the prediction
+        guidance_truncation = (
+            AdaptiveGuidanceTruncation(
+                threshold=guidance_truncation_threshold,
+                patience=guidance_truncation_patience,
+            )
+            if guidance_truncation_threshold is not None
+            else None
+        )
 
         def forward_encoder_with_temperature(self, inputs, tau=0.01, l_min=4, l_max=6):
             handlers = []
@@ -1098,7 +1694,7 @@ class ACEStepPipeline:
             return encoder_hidden_states
 
         # P(speaker, text, lyric)
-        encoder_hidden_states, encoder_hidden_mask = self.ace_step_transformer.encode(
+        encoder_hidden_states, encoder_hidden_mask = transformer_encode(
             encoder_text_hidden_states,
             text_attention_mask,
             speaker_embds,
@@ -1124,7 +1720,7 @@ class ACEStepPipeline:
             )
         else:
             # P(null_speaker, null_text, null_lyric)
-            encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
+            encoder_hidden_states_null, _ = transformer_encode(
                 torch.zeros_like(encoder_text_hidden_states),
                 text_attention_mask,
                 torch.zeros_like(speaker_embds),
@@ -1148,7 +1744,7 @@ class ACEStepPipeline:
                 )
             # P(null_speaker, text, no_lyric)
             else:
-                encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
+                encoder_hidden_states_no_lyric, _ = transformer_encode(
                     encoder_text_hidden_states,
                     text_attention_mask,
                     torch.zeros_like(speaker_embds),
@@ -1156,13 +1752,14 @@ class ACEStepPipeline:
                     lyric_mask,
                 )
 
-        def forward_diffusion_with_temperature(
-            self, hidden_states, timestep, inputs, tau=0.01, l_min=15, l_max=20
-        ):
+        @contextlib.contextmanager
+        def diffusion_temperature(batch_slice, tau=0.01, l_min=15, l_max=20):
+            # scale the queries of the selected batch rows only, so that the ERG branch
+            # can share a forward with the other guidance branches
             handlers = []
 
             def hook(module, input, output):
-                output[:] *= tau
+                output[batch_slice] *= tau
                 return output
 
             for i in range(l_min, l_max):
@@ -1175,164 +1772,253 @@ class ACEStepPipeline:
                 ].cross_attn.to_q.register_forward_hook(hook)
                 handlers.append(handler)
 
-            sample = self.ace_step_transformer.decode(
-                hidden_states=hidden_states, timestep=timestep, **inputs
-            ).sample
-
-            for hook in handlers:
-                hook.remove()
-
-            return sample
-
-        for i, t in tqdm(enumerate(timesteps), total=num_inference_steps):
-
-            if is_repaint:
-                if i < n_min:
-                    continue
-                elif i == n_min:
-                    t_i = t / 1000
-                    zt_src = (1 - t_i) * x0 + (t_i) * z0
-                    target_latents = zt_edit + zt_src - x0
-                    logger.info(f"repaint start from {n_min} add {t_i} level of noise")
-
-            # expand the latents if we are doing classifier free guidance
-            latents = target_latents
-
-            is_in_guidance_interval = start_idx <= i < end_idx
-            if is_in_guidance_interval and do_classifier_free_guidance:
-                # compute current guidance scale
-                if guidance_interval_decay > 0:
-                    # Linearly interpolate to calculate the current guidance scale
-                    progress = (i - start_idx) / (
-                        end_idx - start_idx - 1
-                    )  # 归一化到[0,1]
-                    current_guidance_scale = (
-                        guidance_scale
-                        - (guidance_scale - min_guidance_scale)
-                        * progress
-                        * guidance_interval_decay
+            try:
+                yield
+            finally:
+                for hook in handlers:
+                    hook.remove()
+
+        def transformer_decode(erg_slice=None, **kwargs):
+            # ERG diffusion on the erg_slice rows: hooks in eager mode, a query scale
+            # input for the AOT package
+            if aot_transformer is not None:
+                query_scale = None
+                if erg_slice is not None:
+                    query_scale = torch.ones(
+                        kwargs["hidden_states"].shape[0], device=self.device, dtype=self.dtype
                     )
-                else:
-                    current_guidance_scale = guidance_scale
-
-                latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
-                output_length = latent_model_input.shape[-1]
-                # P(x|speaker, text, lyric)
-                noise_pred_with_cond = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=output_length,
-                    timestep=timestep,
-                ).sample
-
-                noise_pred_with_only_text_cond = None
-                if (
-                    do_double_condition_guidance
-                    and encoder_hidden_states_no_lyric is not None
-                ):
-                    noise_pred_with_only_text_cond = self.ace_step_transformer.decode(
-                        hidden_states=latent_model_input,
-                        attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_no_lyric,
-                        encoder_hidden_mask=encoder_hidden_mask,
+                    query_scale[erg_slice] = 0.01
+                return aot_transformer.decode(query_scale=query_scale, **kwargs)
+            with (
+                diffusion_temperature(erg_slice)
+                if erg_slice is not None
+                else contextlib.nullcontext()
+            ):
+                return self.ace_step_transformer.decode(
+                    attention_mask_is_full=attention_mask_is_full, **kwargs
+                )
+
+        # condition branches evaluated inside the guidance interval
+        guidance_branches = {"cond": encoder_hidden_states}
+        if do_double_condition_guidance and encoder_hidden_states_no_lyric is not None:
+            guidance_branches["only_text_cond"] = encoder_hidden_states_no_lyric
+        # keep uncond last, ERG hooks address it by its batch rows
+        guidance_branches["uncond"] = encoder_hidden_states_null
+        num_branches = len(guidance_branches)
+
+        if self.batch_guidance_branches and do_classifier_free_guidance:
+            # built once so that every step passes the same tensors (see cross_attention_cache)
+            guidance_encoder_hidden_states = torch.cat(list(guidance_branches.values()), dim=0)
+            guidance_encoder_hidden_mask = torch.cat([encoder_hidden_mask] * num_branches, dim=0)
+            guidance_attention_mask = torch.cat([attention_mask] * num_branches, dim=0)
+
+        def decode_guidance_branches(latent_model_input, t, output_length):
+            if self.batch_guidance_branches:
+                uncond_slice = slice((num_branches - 1) * bsz, num_branches * bsz)
+                with span("transformer_decode", branches=",".join(guidance_branches)):
+                    sample = transformer_decode(
+                        erg_slice=uncond_slice if use_erg_diffusion else None,
+                        hidden_states=torch.cat([latent_model_input] * num_branches, dim=0),
+                        attention_mask=guidance_attention_mask,
+                        encoder_hidden_states=guidance_encoder_hidden_states,
+                        encoder_hidden_mask=guidance_encoder_hidden_mask,
                         output_length=output_length,
-                        timestep=timestep,
+                        timestep=t.expand(num_branches * bsz),
                     ).sample
+                return dict(zip(guidance_branches, sample.chunk(num_branches)))
 
-                if use_erg_diffusion:
-                    noise_pred_uncond = forward_diffusion_with_temperature(
-                        self,
-                        hidden_states=latent_model_input,
-                        timestep=timestep,
-                        inputs={
-                            "encoder_hidden_states": encoder_hidden_states_null,
-                            "encoder_hidden_mask": encoder_hidden_mask,
-                            "output_length": output_length,
-                            "attention_mask": attention_mask,
-                        },
-                    )
-                else:
-                    noise_pred_uncond = self.ace_step_transformer.decode(
+            noise_preds = {}
+            for name, branch_encoder_hidden_states in guidance_branches.items():
+                with span("transformer_decode", branches=name):
+                    noise_preds[name] = transformer_decode(
+                        erg_slice=slice(None) if use_erg_diffusion and name == "uncond" else None,
                         hidden_states=latent_model_input,
                         attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_null,
+                        encoder_hidden_states=branch_encoder_hidden_states,
                         encoder_hidden_mask=encoder_hidden_mask,
                         output_length=output_length,
-                        timestep=timestep,
+                        timestep=t.expand(bsz),
                     ).sample
+            return noise_preds
 
-                if (
-                    do_double_condition_guidance
-                    and noise_pred_with_only_text_cond is not None
-                ):
-                    noise_pred = cfg_double_condition_forward(
-                        cond_output=noise_pred_with_cond,
-                        uncond_output=noise_pred_uncond,
-                        only_text_cond_output=noise_pred_with_only_text_cond,
-                        guidance_scale_text=guidance_scale_text,
-                        guidance_scale_lyric=guidance_scale_lyric,
-                    )
-
-                elif cfg_type == "apg":
-                    noise_pred = apg_forward(
-                        pred_cond=noise_pred_with_cond,
-                        pred_uncond=noise_pred_uncond,
-                        guidance_scale=current_guidance_scale,
-                        momentum_buffer=momentum_buffer,
-                    )
-                elif cfg_type == "cfg":
-                    noise_pred = cfg_forward(
-                        cond_output=noise_pred_with_cond,
-                        uncond_output=noise_pred_uncond,
-                        cfg_strength=current_guidance_scale,
-                    )
-                elif cfg_type == "cfg_star":
-                    noise_pred = cfg_zero_star(
-                        noise_pred_with_cond=noise_pred_with_cond,
-                        noise_pred_uncond=noise_pred_uncond,
-                        guidance_scale=current_guidance_scale,
-                        i=i,
-                        zero_steps=zero_steps,
-                        use_zero_init=use_zero_init,
-                    )
-            else:
-                latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
-                noise_pred = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=latent_model_input.shape[-1],
-                    timestep=timestep,
-                ).sample
-
-            if is_repaint and i >= n_min:
-                t_i = t / 1000
-                if i + 1 < len(timesteps):
-                    t_im1 = (timesteps[i + 1]) / 1000
-                else:
-                    t_im1 = torch.zeros_like(t_i).to(self.device)
-                target_latents = target_latents.to(torch.float32)
-                prev_sample = target_latents + (t_im1 - t_i) * noise_pred
-                prev_sample = prev_sample.to(self.dtype)
-                target_latents = prev_sample
-                zt_src = (1 - t_im1) * x0 + (t_im1) * z0
-                target_latents = torch.where(
-                    repaint_mask == 1.0, target_latents, zt_src
-                )
-            else:
-                target_latents = scheduler.step(
-                    model_output=noise_pred,
-                    timestep=t,
-                    sample=target_latents,
-                    return_dict=False,
-                    omega=omega_scale,
-                    generator=random_generators[0],
-                )[0]
+        cross_attention_cache = (
+            self.ace_step_transformer.cross_attention_cache()
+            if self.cross_attention_cache
+            else contextlib.nullcontext()
+        )
+        # per-block spans, only recorded while a profiler is active
+        block_spans = get_profiler().instrument_modules(
+            {
+                f"transformer_block_{i}": block
+                for i, block in enumerate(self.ace_step_transformer.transformer_blocks)
+            },
+            cat="block",
+        )
+        # the AOT packages always run every block
+        step_cache = None
+        if self.step_cache_threshold is not None and aot_transformer is None:
+            step_cache = StepCache(
+                threshold=self.step_cache_threshold,
+                warmup_steps=self.step_cache_warmup_steps,
+                max_consecutive_hits=self.step_cache_max_skips,
+            )
+        self.last_step_cache_stats = None
+        self.last_guidance_truncation_stats = None
+        step_cache_context = (
+            self.ace_step_transformer.step_cache(step_cache)
+            if step_cache is not None
+            else contextlib.nullcontext()
+        )
+        with cross_attention_cache, self.ace_step_transformer.rotary_cache(), step_cache_context, block_spans:
+            for i, t in tqdm(enumerate(timesteps), total=num_inference_steps):
+                if step_cache is not None:
+                    step_cache.begin_step(i, num_inference_steps)
+                with span("denoise_step", cat="step", step=i):
+                    if (
+                        self.offload_manager is not None
+                        and i == num_inference_steps - self.offload_prefetch_steps
+                    ):
+                        # overlap the decoder upload with the last steps
+                        self.offload_manager.prefetch(self.music_dcae)
+
+                    if is_repaint:
+                        if i < n_min:
+                            continue
+                        elif i == n_min:
+                            t_i = t / 1000
+                            zt_src = (1 - t_i) * x0 + (t_i) * z0
+                            target_latents = zt_edit + zt_src - x0
+                            logger.info(f"repaint start from {n_min} add {t_i} level of noise")
+
+                    # expand the latents if we are doing classifier free guidance
+                    latents = target_latents
+
+                    is_in_guidance_interval = start_idx <= i < end_idx
+                    if (
+                        is_in_guidance_interval
+                        and do_classifier_free_guidance
+                        and guidance_truncation is not None
+                        and guidance_truncation.truncated
+                    ):
+                        is_in_guidance_interval = False
+                        guidance_truncation.skip(num_branches - 1)
+                    if is_in_guidance_interval and do_classifier_free_guidance:
+                        # compute current guidance scale
+                        if guidance_interval_decay > 0:
+                            # Linearly interpolate to calculate the current guidance scale
+                            progress = (i - start_idx) / (
+                                end_idx - start_idx - 1
+                            )  # 归一化到[0,1]
+                            current_guidance_scale = (
+                                guidance_scale
+                                - (guidance_scale - min_guidance_scale)
+                                * progress
+                                * guidance_interval_decay
+                            )
+                        else:
+                            current_guidance_scale = guidance_scale
+                        if no_guidance_mask is not None:
+                            current_guidance_scale = torch.where(
+                                no_guidance_mask, 1.0, current_guidance_scale
+                            )
+
+                        latent_model_input = pad_to_bucket(latents)
+                        output_length = latents.shape[-1]
+                        # P(x|speaker, text, lyric), P(x|null_speaker, text, no_lyric) and P(x|null)
+                        noise_preds = decode_guidance_branches(
+                            latent_model_input, t, output_length
+                        )
+                        noise_pred_with_cond = noise_preds["cond"]
+                        noise_pred_with_only_text_cond = noise_preds.get("only_text_cond")
+                        noise_pred_uncond = noise_preds["uncond"]
+
+                        if (
+                            do_double_condition_guidance
+                            and noise_pred_with_only_text_cond is not None
+                        ):
+                            noise_pred = cfg_double_condition_forward(
+                                cond_output=noise_pred_with_cond,
+                                uncond_output=noise_pred_uncond,
+                                only_text_cond_output=noise_pred_with_only_text_cond,
+                                guidance_scale_text=guidance_scale_text,
+                                guidance_scale_lyric=guidance_scale_lyric,
+                            )
+
+                        elif cfg_type == "apg":
+                            noise_pred = apg_forward(
+                                pred_cond=noise_pred_with_cond,
+                                pred_uncond=noise_pred_uncond,
+                                guidance_scale=current_guidance_scale,
+                                momentum_buffer=momentum_buffer,
+                            )
+                        elif cfg_type == "cfg":
+                            noise_pred = cfg_forward(
+                                cond_output=noise_pred_with_cond,
+                                uncond_output=noise_pred_uncond,
+                                cfg_strength=current_guidance_scale,
+                            )
+                        elif cfg_type == "cfg_star":
+                            noise_pred = cfg_zero_star(
+                                noise_pred_with_cond=noise_pred_with_cond,
+                                noise_pred_uncond=noise_pred_uncond,
+                                guidance_scale=current_guidance_scale,
+                                i=i,
+                                zero_steps=zero_steps,
+                                use_zero_init=use_zero_init,
+                            )
+                        if guidance_truncation is not None:
+                            guidance_truncation.update(i, noise_pred_with_cond, noise_pred_uncond)
+                    else:
+                        latent_model_input = pad_to_bucket(latents)
+                        timestep = t.expand(latent_model_input.shape[0])
+                        with span("transformer_decode", branches="cond"):
+                            noise_pred = transformer_decode(
+                                hidden_states=latent_model_input,
+                                attention_mask=attention_mask,
+                                encoder_hidden_states=encoder_hidden_states,
+                                encoder_hidden_mask=encoder_hidden_mask,
+                                output_length=latents.shape[-1],
+                                timestep=timestep,
+                            ).sample
+
+                    if is_repaint and i >= n_min:
+                        t_i = t / 1000
+                        if i + 1 < len(timesteps):
+                            t_im1 = (timesteps[i + 1]) / 1000
+                        else:
+                            t_im1 = torch.zeros_like(t_i).to(self.device)
+                        target_latents = target_latents.to(torch.float32)
+                        prev_sample = target_latents + (t_im1 - t_i) * noise_pred
+                        prev_sample = prev_sample.to(self.dtype)
+                        target_latents = prev_sample
+                        zt_src = (1 - t_im1) * x0 + (t_im1) * z0
+                        target_latents = torch.where(
+                            repaint_mask == 1.0, target_latents, zt_src
+                        )
+                    else:
+                        with span("scheduler_step"):
+                            target_latents = scheduler.step(
+                                model_output=noise_pred,
+                                timestep=t,
+                                sample=target_latents,
+                                return_dict=False,
+                                omega=omega_scale,
+                                generator=random_generators[0],
+                            )[0]
+
+        if guidance_truncation is not None:
+            self.last_guidance_truncation_stats = guidance_truncation.summary()
+            logger.info(
+                f"Guidance truncated at step {guidance_truncation.truncated_at}, "
+                f"saved {guidance_truncation.passes_saved} transformer passes"
+            )
+        if step_cache is not None:
+            self.last_step_cache_stats = step_cache.summary()
+            logger.info(
+                f"Step cache skipped the transformer blocks in {self.last_step_cache_stats['hits']}"
+                f"/{self.last_step_cache_stats['calls']} decodes, "
+                f"steps {self.last_step_cache_stats['hit_steps']}"
+            )
 
         if is_extend:
             if to_right_pad_gt_latents is not None:
@@ -1345,23 +2031,34 @@ class ACEStepPipeline:
                 )
         return target_latents
 
-    @cpu_offload("music_dcae")
+    @profiled("latents2audio")
+    @cpu_offload("music_dcae", exclusive=True)
     def latents2audio(
         self,
         latents,
         target_wav_duration_second=30,
-        sample_rate=48000,
+        sample_rate=None,
         save_path=None,
         format="wav",
     ):
         output_audio_paths = []
         bs = latents.shape[0]
         pred_latents = latents
+        if sample_rate is None:
+            sample_rate = self.output_sample_rate
         with torch.no_grad():
             if self.overlapped_decode and target_wav_duration_second > 48:
-                _, pred_wavs = self.music_dcae.decode_overlap(pred_latents, sr=sample_rate)
+                sample_rate, pred_wavs = self.music_dcae.decode_overlap(
+                    pred_latents,
+                    sr=sample_rate,
+                    memory_budget_mb=self.decode_memory_budget_mb,
+                )
             else:
-                _, pred_wavs = self.music_dcae.decode(pred_latents, sr=sample_rate)
+                sample_rate, pred_wavs = self.music_dcae.decode(
+                    pred_latents,
+                    sr=sample_rate,
+                    memory_budget_mb=self.decode_memory_budget_mb,
+                )
         pred_wavs = [pred_wav.cpu().float() for pred_wav in pred_wavs]
         for i in tqdm(range(bs)):
             output_audio_path = self.save_wav_file(
@@ -1374,6 +2071,28 @@ class ACEStepPipeline:
             output_audio_paths.append(output_audio_path)
         return output_audio_paths
 
+    def latents2audio_stream(self, latents):
+        """
+        Streaming counterpart of latents2audio.
+
+        Yields (index, wav) pairs, wav being a (channels, samples) float CPU tensor at
+        44.1kHz, as each window of the overlapped DCAE/vocoder decode is finished.
+        Nothing is written to disk.
+        """
+        # the cpu_offload decorator would return before the generator is consumed,
+        # so the decoder is moved on and off the device here
+        offloader = (
+            offload_context(self, self.music_dcae, exclusive=True)
+            if self.cpu_offload
+            else contextlib.nullcontext()
+        )
+        try:
+            with offloader, torch.no_grad():
+                yield from self.music_dcae.iter_decode_overlap(latents)
+        finally:
+            self.cleanup_memory()
+
+    @profiled("write_audio")
     def save_wav_file(
         self, target_wav, idx, save_path=None, sample_rate=48000, format="wav"
     ):
@@ -1402,41 +2121,59 @@ class ACEStepPipeline:
         )
         return output_path_wav
 
-    @cpu_offload("music_dcae")
+    @profiled("encode_audio")
     def infer_latents(self, input_audio_path):
         if input_audio_path is None:
             return None
+        # audio is always resampled to 44.1kHz before encoding, so the content hash
+        # and the encoder dtype identify the latents
+        key = ("latents", hash_file(input_audio_path), str(self.dcae_dtype), str(self.dtype))
+        latents = self.latent_cache.get(key)
+        if latents is None and self.latent_disk_cache is not None:
+            tensors = self.latent_disk_cache.get(key)
+            if tensors is not None:
+                latents = tensors["latents"]
+                self.latent_cache.put(key, latents)
+        if latents is None:
+            latents = self.encode_audio_latents(input_audio_path).cpu()
+            self.latent_cache.put(key, latents)
+            if self.latent_disk_cache is not None:
+                self.latent_disk_cache.put(key, {"latents": latents})
+        else:
+            logger.info(f"Using cached latents for {input_audio_path}")
+        # copied so that callers can never modify the cached entry
+        return latents.to(self.device, copy=True)
+
+    @cpu_offload("music_dcae")
+    def encode_audio_latents(self, input_audio_path):
         input_audio, sr = self.music_dcae.load_audio(input_audio_path)
         input_audio = input_audio.unsqueeze(0)
-        input_audio = input_audio.to(device=self.device, dtype=self.dtype)
+        input_audio = input_audio.to(device=self.device, dtype=self.vocoder_dtype)
         latents, _ = self.music_dcae.encode(input_audio, sr=sr)
-        return latents
+        return latents.to(self.dtype)
 
+    @profiled("lora_switch")
     def load_lora(self, lora_name_or_path, lora_weight):
-        if (lora_name_or_path != self.lora_path or lora_weight != self.lora_weight) and lora_name_or_path != "none":
-            if not os.path.exists(lora_name_or_path):
-                lora_download_path = snapshot_download(lora_name_or_path, cache_dir=self.checkpoint_dir)
-            else:
-                lora_download_path = lora_name_or_path
-            if self.lora_path != "none":
-                self.ace_step_transformer.unload_lora()
-            self.ace_step_transformer.load_lora_adapter(os.path.join(lora_download_path, "pytorch_lora_weights.safetensors"), adapter_name="ace_step_lora", with_alpha=True, prefix=None)
-            logger.info(f"Loading lora weights from: {lora_name_or_path} download path is: {lora_download_path} weight: {lora_weight}")
-            set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [lora_weight])
-            self.lora_path = lora_name_or_path
-            self.lora_weight = lora_weight
-        elif self.lora_path != "none" and lora_name_or_path == "none":
-            logger.info("No lora weights to load.")
-            self.ace_step_transformer.unload_lora()
+        if self.lora_registry is None:
+            self.lora_registry = LoRARegistry(
+                self.ace_step_transformer,
+                cache_dir=self.checkpoint_dir,
+                max_adapters=self.lora_cache_size,
+                max_memory_mb=self.lora_cache_memory_mb,
+            )
+        self.lora_registry.activate(lora_name_or_path, lora_weight)
+        self.lora_path = lora_name_or_path
+        self.lora_weight = lora_weight
 
+    @activates_profiler
     def __call__(
         self,
         format: str = "wav",
         audio_duration: float = 60.0,
-        prompt: str = None,
-        lyrics: str = None,
+        prompt: Union[str, List[str]] = None,
+        lyrics: Union[str, List[str]] = None,
         infer_step: int = 60,
-        guidance_scale: float = 15.0,
+        guidance_scale: Union[float, List[float]] = 15.0,
         scheduler_type: str = "euler",
         cfg_type: str = "apg",
         omega_scale: int = 10.0,
@@ -1454,7 +2191,7 @@ class ACEStepPipeline:
         ref_audio_strength: float = 0.5,
         ref_audio_input: str = None,
         lora_name_or_path: str = "none",
-        lora_weight: float = 1.0,
+        lora_weight: Union[float, List[float]] = 1.0,
         retake_seeds: list = None,
         retake_variance: float = 0.5,
         task: str = "text2music",
@@ -1467,23 +2204,66 @@ class ACEStepPipeline:
         edit_n_max: float = 1.0,
         edit_n_avg: int = 1,
         save_path: str = None,
-        batch_size: int = 1,
+        batch_size: int = None,
         debug: bool = False,
+        stream: bool = False,
+        profile: bool = False,
+        guidance_truncation_threshold: float = None,
+        guidance_truncation_patience: int = 3,
     ):
-
+        """
+        Generates batch_size songs and returns their output paths followed by the
+        input params dict, or [audio_stream, input params] with stream=True.
+
+        prompt, lyrics, guidance_scale and manual_seeds may be lists with one entry per
+        sample, the batch size is then their (common) length. With an explicit
+        batch_size, manual_seeds keeps its old behavior: the last seed is repeated for
+        the missing samples and extra seeds are ignored. lora_weight may be a list too,
+        but all its entries must be equal: the LoRA scale is set on the whole
+        transformer, so a batch cannot mix weights.
+        """
+        # profile records spans of every stage (see activates_profiler), written as a
+        # Chrome trace next to each output and summarized in its _input_params.json
+        profiler = get_profiler() if profile else None
         start_time = time.time()
+        # set by text2music_diffusion_process, not by the edit and audio2audio paths
+        self.last_step_cache_stats = self.last_guidance_truncation_stats = None
 
         if audio2audio_enable and ref_audio_input is not None:
             task = "audio2audio"
 
-        if not self.loaded:
-            logger.warning("Checkpoint not loaded, loading checkpoint...")
-            if self.quantized:
-                self.load_quantized_checkpoint(self.checkpoint_dir)
-            else:
-                self.load_checkpoint(self.checkpoint_dir)
+        # prompt, lyrics, guidance_scale, seeds and lora_weight may be given per sample;
+        # all samples then share one batched diffusion run
+        batch_size = self.get_batch_size(
+            batch_size,
+            prompt=prompt,
+            lyrics=lyrics,
+            guidance_scale=guidance_scale,
+            manual_seeds=self.parse_seeds(manual_seeds),
+            lora_weight=lora_weight,
+        )
+        prompts = self.expand_to_batch(prompt, batch_size)
+        lyrics_list = self.expand_to_batch(lyrics, batch_size)
+        guidance_scales = self.expand_to_batch(guidance_scale, batch_size)
+        lora_weights = self.expand_to_batch(lora_weight, batch_size)
+        if len(set(lora_weights)) > 1:
+            raise ValueError(
+                f"LoRA weight is applied to the whole transformer and must be the same for all samples in a batch, got {lora_weights}"
+            )
+        lora_weight = lora_weights[0]
+        is_heterogeneous_guidance = len(set(guidance_scales)) > 1
+        if is_heterogeneous_guidance and task == "edit":
+            raise ValueError("Per-sample guidance_scale is not supported for the edit task")
+        guidance_scale = guidance_scales if is_heterogeneous_guidance else guidance_scales[0]
+
+        self.ensure_loaded()
 
         self.load_lora(lora_name_or_path, lora_weight)
+        if self.offload_manager is not None:
+            # upload the transformer while prompts and lyrics are being encoded
+            self.offload_manager.prefetch(self.text_encoder_model)
+            if self.block_streamer is None:
+                self.offload_manager.prefetch(self.ace_step_transformer)
         load_model_cost = time.time() - start_time
         logger.info(f"Model loaded in {load_model_cost:.2f} seconds.")
 
@@ -1499,37 +2279,17 @@ class ACEStepPipeline:
         else:
             oss_steps = []
 
-        texts = [prompt]
-        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(texts)
-        encoder_text_hidden_states = encoder_text_hidden_states.repeat(batch_size, 1, 1)
-        text_attention_mask = text_attention_mask.repeat(batch_size, 1)
+        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings_batch(prompts)
 
         encoder_text_hidden_states_null = None
         if use_erg_tag:
-            encoder_text_hidden_states_null = self.get_text_embeddings_null(texts)
-            encoder_text_hidden_states_null = encoder_text_hidden_states_null.repeat(batch_size, 1, 1)
+            encoder_text_hidden_states_null = self.get_text_embeddings_null_batch(prompts)
 
         # not support for released checkpoint
         speaker_embeds = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
 
         # 6 lyric
-        lyric_token_idx = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        lyric_mask = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        if len(lyrics) > 0:
-            lyric_token_idx = self.tokenize_lyrics(lyrics, debug=debug)
-            lyric_mask = [1] * len(lyric_token_idx)
-            lyric_token_idx = (
-                torch.tensor(lyric_token_idx)
-                .unsqueeze(0)
-                .to(self.device)
-                .repeat(batch_size, 1)
-            )
-            lyric_mask = (
-                torch.tensor(lyric_mask)
-                .unsqueeze(0)
-                .to(self.device)
-                .repeat(batch_size, 1)
-            )
+        lyric_token_idx, lyric_mask = self.tokenize_lyrics_batch(lyrics_list, debug=debug)
 
         if audio_duration <= 0:
             audio_duration = random.uniform(30.0, 240.0)
@@ -1556,7 +2316,7 @@ class ACEStepPipeline:
                 src_audio_path
             ), f"src_audio_path {src_audio_path} does not exist"
             src_latents = self.infer_latents(src_audio_path)
-        
+    
         ref_latents = None
         if ref_audio_input is not None and audio2audio_enable:
             assert ref_audio_input is not None, "ref_audio_input is required for audio2audio task"
@@ -1566,40 +2326,13 @@ class ACEStepPipeline:
             ref_latents = self.infer_latents(ref_audio_input)
 
         if task == "edit":
-            texts = [edit_target_prompt]
             target_encoder_text_hidden_states, target_text_attention_mask = (
-                self.get_text_embeddings(texts)
-            )
-            target_encoder_text_hidden_states = (
-                target_encoder_text_hidden_states.repeat(batch_size, 1, 1)
-            )
-            target_text_attention_mask = target_text_attention_mask.repeat(
-                batch_size, 1
+                self.get_text_embeddings_batch(self.expand_to_batch(edit_target_prompt, batch_size))
             )
 
-            target_lyric_token_idx = (
-                torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
+            target_lyric_token_idx, target_lyric_mask = self.tokenize_lyrics_batch(
+                self.expand_to_batch(edit_target_lyrics, batch_size), debug=True
             )
-            target_lyric_mask = (
-                torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-            )
-            if len(edit_target_lyrics) > 0:
-                target_lyric_token_idx = self.tokenize_lyrics(
-                    edit_target_lyrics, debug=True
-                )
-                target_lyric_mask = [1] * len(target_lyric_token_idx)
-                target_lyric_token_idx = (
-                    torch.tensor(target_lyric_token_idx)
-                    .unsqueeze(0)
-                    .to(self.device)
-                    .repeat(batch_size, 1)
-                )
-                target_lyric_mask = (
-                    torch.tensor(target_lyric_mask)
-                    .unsqueeze(0)
-                    .to(self.device)
-                    .repeat(batch_size, 1)
-                )
 
             target_speaker_embeds = speaker_embeds.clone()
 
@@ -1655,24 +2388,32 @@ class ACEStepPipeline:
                 audio2audio_enable=audio2audio_enable,
                 ref_audio_strength=ref_audio_strength,
                 ref_latents=ref_latents,
+                guidance_truncation_threshold=guidance_truncation_threshold,
+                guidance_truncation_patience=guidance_truncation_patience,
             )
 
         end_time = time.time()
         diffusion_time_cost = end_time - start_time
         start_time = end_time
 
-        output_paths = self.latents2audio(
-            latents=target_latents,
-            target_wav_duration_second=audio_duration,
-            save_path=save_path,
-            format=format,
-        )
+        if stream:
+            # decoded while the caller consumes it, see latents2audio_stream
+            output_paths = []
+            audio_stream = self.latents2audio_stream(target_latents)
+            latent2audio_time_cost = None
+        else:
+            output_paths = self.latents2audio(
+                latents=target_latents,
+                target_wav_duration_second=audio_duration,
+                save_path=save_path,
+                format=format,
+            )
 
-        # Clean up memory after generation
-        self.cleanup_memory()
+            # Clean up memory after generation
+            self.cleanup_memory()
 
-        end_time = time.time()
-        latent2audio_time_cost = end_time - start_time
+            end_time = time.time()
+            latent2audio_time_cost = end_time - start_time
         timecosts = {
             "preprocess": preprocess_time_cost,
             "diffusion": diffusion_time_cost,
@@ -1716,14 +2457,32 @@ class ACEStepPipeline:
             "audio2audio_enable": audio2audio_enable,
             "ref_audio_strength": ref_audio_strength,
             "ref_audio_input": ref_audio_input,
+            "guidance_truncation_threshold": guidance_truncation_threshold,
+            "guidance_truncation_patience": guidance_truncation_patience,
         }
+        if profiler is not None:
+            input_params_json["profile"] = profiler.summary()
+        if self.last_step_cache_stats is not None:
+            input_params_json["step_cache"] = self.last_step_cache_stats
+        if self.last_guidance_truncation_stats is not None:
+            input_params_json["guidance_truncation"] = self.last_guidance_truncation_stats
         # save input_params_json
-        for output_audio_path in output_paths:
+        for i, output_audio_path in enumerate(output_paths):
             input_params_json_save_path = output_audio_path.replace(
                 f".{format}", "_input_params.json"
             )
             input_params_json["audio_path"] = output_audio_path
+            if task != "edit":
+                input_params_json["prompt"] = prompts[i]
+                input_params_json["lyrics"] = lyrics_list[i]
+            input_params_json["guidance_scale"] = guidance_scales[i]
+            if profiler is not None:
+                input_params_json["trace_path"] = profiler.export_chrome_trace(
+                    output_audio_path.replace(f".{format}", "_trace.json")
+                )
             with open(input_params_json_save_path, "w", encoding="utf-8") as f:
                 json.dump(input_params_json, f, indent=4, ensure_ascii=False)
 
+        if stream:
+            return [audio_stream, input_params_json]
         return output_paths + [input_params_json]
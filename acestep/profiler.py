@@ -0,0 +1,220 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+_local = threading.local()
+
+# span memory: peak CUDA allocation inside the span, or the process RSS high-water mark
+MEMORY_KEYS = ("peak_memory_mb", "process_peak_rss_mb")
+
+
+def get_profiler():
+    """The profiler active on this thread, a no-op NullProfiler if none is."""
+    return getattr(_local, "profiler", None) or NULL_PROFILER
+
+
+def span(name, cat="stage", **args):
+    """Times a block with the active profiler, see Profiler.span."""
+    return get_profiler().span(name, cat=cat, **args)
+
+
+def profiled(name, cat="stage"):
+    """Decorator version of span."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, cat=cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def activates_profiler(func):
+    """Runs func with a new Profiler active when it is called with profile=True."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not kwargs.get("profile"):
+            return func(*args, **kwargs)
+        with Profiler().activate():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def process_peak_rss_mb():
+    """High-water mark of the process RSS so far, not of any particular span."""
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 ** 2)
+    return peak / 1024
+
+
+class NullProfiler:
+    enabled = False
+
+    def span(self, name, cat="stage", **args):
+        return nullcontext()
+
+    def instrument_modules(self, modules, cat="module"):
+        return nullcontext()
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler:
+    """
+    Records nested timing spans of one generation.
+
+    Spans are closed in LIFO order on the thread that activated the profiler.
+    With CUDA, every span boundary synchronizes the device so that spans measure
+    the kernels they launched, and the peak allocated memory inside each span is
+    recorded as peak_memory_mb. Otherwise the running process peak RSS at the end
+    of the span is recorded as process_peak_rss_mb.
+    """
+
+    enabled = True
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.track_cuda_memory = torch.cuda.is_available()
+        self.events = []
+        self._stack = []
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._tid = threading.get_ident()
+
+    @contextmanager
+    def activate(self):
+        """Makes this profiler the active one on the current thread."""
+        previous = getattr(_local, "profiler", None)
+        _local.profiler = self
+        try:
+            yield self
+        finally:
+            _local.profiler = previous
+
+    def _update_peaks(self):
+        # the peak counter is reset for every span, so fold it into all open spans first
+        if not self.track_cuda_memory:
+            return
+        peak = torch.cuda.max_memory_allocated() / (1024 ** 2)
+        for open_span in self._stack:
+            open_span["peak_memory_mb"] = max(open_span["peak_memory_mb"], peak)
+
+    @contextmanager
+    def span(self, name, cat="stage", **args):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self._update_peaks()
+        if self.track_cuda_memory:
+            torch.cuda.reset_peak_memory_stats()
+        record = {"name": name, "cat": cat, "args": args}
+        if self.track_cuda_memory:
+            record["peak_memory_mb"] = 0.0
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            self._update_peaks()
+            self._stack.pop()
+            if not self.track_cuda_memory:
+                record["process_peak_rss_mb"] = process_peak_rss_mb()
+            record["ts"] = (start - self._origin) * 1e6
+            record["dur"] = (end - start) * 1e6
+            self.events.append(record)
+
+    @contextmanager
+    def instrument_modules(self, modules, cat="module"):
+        """Records a span for every forward of the given {name: module} while active."""
+        handles = []
+        open_spans = {}
+
+        def pre_hook(name):
+            def hook(module, args):
+                open_spans.setdefault(name, []).append(self.span(name, cat=cat))
+                open_spans[name][-1].__enter__()
+
+            return hook
+
+        def post_hook(name):
+            def hook(module, args, output):
+                open_spans[name].pop().__exit__(None, None, None)
+
+            return hook
+
+        for name, module in modules.items():
+            handles.append(module.register_forward_pre_hook(pre_hook(name)))
+            handles.append(module.register_forward_hook(post_hook(name)))
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def summary(self):
+        """Aggregates spans by name: count, total/mean/max seconds and peak memory."""
+        summary = {}
+        for event in self.events:
+            entry = summary.setdefault(
+                event["name"], {"count": 0, "total": 0.0, "max": 0.0}
+            )
+            duration = event["dur"] / 1e6
+            entry["count"] += 1
+            entry["total"] += duration
+            entry["max"] = max(entry["max"], duration)
+            for key in MEMORY_KEYS:
+                if key in event:
+                    entry[key] = max(entry.get(key, 0.0), event[key])
+        for entry in summary.values():
+            entry["mean"] = entry["total"] / entry["count"]
+        return dict(sorted(summary.items(), key=lambda item: -item[1]["total"]))
+
+    def chrome_trace(self):
+        return {
+            "traceEvents": [
+                {
+                    "name": event["name"],
+                    "cat": event["cat"],
+                    "ph": "X",
+                    "ts": event["ts"],
+                    "dur": event["dur"],
+                    "pid": self._pid,
+                    "tid": self._tid,
+                    "args": dict(event["args"], **{key: event[key] for key in MEMORY_KEYS if key in event}),
+                }
+                for event in sorted(self.events, key=lambda event: event["ts"])
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def export_chrome_trace(self, path):
+        """Writes the spans as Chrome trace JSON (chrome://tracing, Perfetto)."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        return path
@@ -0,0 +1,207 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Int8 dynamic quantization of the transformer and UMT5 linear layers for CPU serving.
+
+Weights are stored as per output channel symmetric int8 with float32 scales in plain
+safetensors files next to the float weights; activations are quantized per call. On
+CPU the weights are packed for the quantized engine (fbgemm/onednn) on first use,
+other devices dequantize them. Produce the files with:
+
+    python -m acestep.quantization --checkpoint_path ./checkpoints
+"""
+
+import os
+
+import click
+import torch
+import torch.nn.functional as F
+from accelerate import init_empty_weights
+from loguru import logger
+from safetensors.torch import load_file, save_model
+from torch import nn
+
+
+TRANSFORMER_INT8_WEIGHTS = "diffusion_pytorch_model_int8.safetensors"
+TEXT_ENCODER_INT8_WEIGHTS = "model_int8.safetensors"
+
+# the embedders, timestep MLP and final layer are small and sensitive, only the
+# blocks are quantized
+TRANSFORMER_QUANTIZED_MODULES = ("transformer_blocks", "lyric_encoder")
+TEXT_ENCODER_QUANTIZED_MODULES = ("encoder.block",)
+
+
+class Int8DynamicLinear(nn.Module):
+    """nn.Linear with int8 weights and dynamically quantized activations."""
+
+    def __init__(self, in_features, out_features, bias=True, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer(
+            "weight", torch.zeros(out_features, in_features, dtype=torch.int8, device=device)
+        )
+        self.register_buffer(
+            "weight_scale", torch.ones(out_features, dtype=torch.float32, device=device)
+        )
+        if bias:
+            self.register_buffer(
+                "bias", torch.zeros(out_features, dtype=torch.float32, device=device)
+            )
+        else:
+            self.bias = None
+        self._packed = None
+
+    @classmethod
+    def from_linear(cls, linear):
+        module = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            device=linear.weight.device,
+        )
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        module.weight = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        module.weight_scale = scale
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().float()
+        return module
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._packed = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def _pack(self):
+        weight = torch._make_per_channel_quantized_tensor(
+            self.weight.cpu(),
+            self.weight_scale.cpu().double(),
+            torch.zeros(self.out_features, dtype=torch.long),
+            0,
+        )
+        bias = self.bias.cpu() if self.bias is not None else None
+        self._packed = torch.ops.quantized.linear_prepack(weight, bias)
+
+    def forward(self, x):
+        engine = torch.backends.quantized.engine
+        if x.device.type == "cpu" and engine != "none":
+            if self._packed is None:
+                self._pack()
+            # fbgemm's AVX2 kernels saturate with full range activations
+            reduce_range = engine in ("fbgemm", "x86")
+            return torch.ops.quantized.linear_dynamic(
+                x.float(), self._packed, reduce_range
+            ).to(x.dtype)
+        weight = self.weight.to(x.dtype) * self.weight_scale.to(x.dtype)[:, None]
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def quantize_linear_layers(model, modules=None):
+    """Replaces the nn.Linear layers under the `modules` prefixes (all if None), returns their count."""
+    replaced = 0
+    for name, parent in list(model.named_modules()):
+        for child_name, child in list(parent.named_children()):
+            qualified_name = f"{name}.{child_name}" if name else child_name
+            if type(child) is not nn.Linear:
+                continue
+            if modules is not None and not any(
+                qualified_name == prefix or qualified_name.startswith(prefix + ".")
+                for prefix in modules
+            ):
+                continue
+            setattr(parent, child_name, Int8DynamicLinear.from_linear(child))
+            replaced += 1
+    return replaced
+
+
+def save_int8_model(model, path):
+    # save_model drops tied duplicates (UMT5 shares its token embedding)
+    save_model(model, path, metadata={"format": "pt", "quantization": "int8_dynamic"})
+    return path
+
+
+def load_int8_model(build, path, modules, device="cpu", dtype=torch.float32):
+    """
+    Builds a model with `build()` without allocating its weights, swaps in the int8
+    layers and assigns the tensors from the safetensors file at `path`.
+    """
+    with init_empty_weights():
+        model = build().to(dtype)
+    quantize_linear_layers(model, modules)
+    # int8 layers keep float32 scales and bias regardless of the model dtype
+    float32_tensors = {
+        f"{name}.{tensor_name}"
+        for name, module in model.named_modules()
+        if isinstance(module, Int8DynamicLinear)
+        for tensor_name in ("weight_scale", "bias")
+    }
+    tied_parameters = {}
+    for name, parameter in model.named_parameters(remove_duplicate=False):
+        tied_parameters.setdefault(id(parameter), []).append(name)
+
+    state_dict = load_file(path, device=str(device))
+    for name, tensor in state_dict.items():
+        if tensor.is_floating_point() and name not in float32_tensors:
+            state_dict[name] = tensor.to(dtype)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    # assign replaces parameters one by one, tied names are re-pointed at the loaded one
+    for names in tied_parameters.values():
+        loaded = [name for name in names if name in state_dict]
+        if len(names) > 1 and loaded:
+            parameter = model.get_parameter(loaded[0])
+            for name in names:
+                module_name, _, attr = name.rpartition(".")
+                setattr(model.get_submodule(module_name), attr, parameter)
+
+    missing = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{path} is missing {len(missing)} tensors, e.g. {missing[:5]}")
+    return model.to(device).eval()
+
+
+def export_int8_checkpoint(checkpoint_dir):
+    """Writes the int8 transformer and UMT5 weights next to the float ones."""
+    from transformers import UMT5EncoderModel
+
+    from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+
+    ace_step_checkpoint_path = os.path.join(checkpoint_dir, "ace_step_transformer")
+    text_encoder_checkpoint_path = os.path.join(checkpoint_dir, "umt5-base")
+
+    transformer = ACEStepTransformer2DModel.from_pretrained(
+        ace_step_checkpoint_path, torch_dtype=torch.float32
+    ).eval()
+    count = quantize_linear_layers(transformer, TRANSFORMER_QUANTIZED_MODULES)
+    path = save_int8_model(
+        transformer, os.path.join(ace_step_checkpoint_path, TRANSFORMER_INT8_WEIGHTS)
+    )
+    logger.info(f"Quantized {count} transformer linear layers to {path}")
+    del transformer
+
+    text_encoder_model = UMT5EncoderModel.from_pretrained(
+        text_encoder_checkpoint_path, torch_dtype=torch.float32
+    ).eval()
+    count = quantize_linear_layers(text_encoder_model, TEXT_ENCODER_QUANTIZED_MODULES)
+    path = save_int8_model(
+        text_encoder_model, os.path.join(text_encoder_checkpoint_path, TEXT_ENCODER_INT8_WEIGHTS)
+    )
+    logger.info(f"Quantized {count} UMT5 linear layers to {path}")
+    return checkpoint_dir
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, required=True, help="Checkpoint directory containing ace_step_transformer and umt5-base")
+def main(checkpoint_path):
+    export_int8_checkpoint(checkpoint_path)
+
+
+if __name__ == "__main__":
+    main()
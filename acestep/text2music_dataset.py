@@ -11,6 +11,7 @@ from pathlib import Path
 import re
 from acestep.language_segmentation import LangSegment
 from acestep.models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
+from acestep.music_dcae.resampler import resample
 import warnings
 
 warnings.simplefilter("ignore", category=FutureWarning)
@@ -322,7 +323,7 @@ class Text2MusicDataset(Dataset):
 
         # Resample if needed
         if sr != 48000:
-            audio = torchaudio.transforms.Resample(sr, 48000)(audio)
+            audio = resample(audio, sr, 48000)
 
         # Clip values to [-1.0, 1.0]
         audio = torch.clamp(audio, -1.0, 1.0)
@@ -0,0 +1,211 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a worker's job queue is at capacity."""
+
+
+class PipelineWorker:
+    """
+    Long-lived worker that owns one warm ACEStepPipeline on one device.
+
+    The pipeline is constructed and its checkpoint loaded once, on the worker
+    thread, when the worker starts. Jobs are callables taking the pipeline as
+    their only argument; they are executed one at a time in submission order.
+    """
+
+    def __init__(self, pipeline_factory, device_id=0, max_queue_size=8):
+        self.pipeline_factory = pipeline_factory
+        self.device_id = device_id
+        self.max_queue_size = max_queue_size
+        self.jobs = queue.Queue(maxsize=max_queue_size)
+        self.pipeline = None
+        self.ready = threading.Event()
+        self.load_error = None
+        self.load_time = None
+        self.busy = False
+        self.processed = 0
+        self.failed = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=f"acestep-worker-{self.device_id}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def wait_until_ready(self, timeout=None):
+        self.ready.wait(timeout)
+        if self.load_error is not None:
+            raise RuntimeError(
+                f"Worker on device {self.device_id} failed to load"
+            ) from self.load_error
+        return self.ready.is_set()
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            self.pipeline = self.pipeline_factory(self.device_id)
+            self.pipeline.ensure_loaded()
+        except Exception as e:
+            logger.exception(f"Worker on device {self.device_id} failed to load: {e}")
+            self.load_error = e
+            self.ready.set()
+            return
+        self.load_time = time.time() - start_time
+        logger.info(
+            f"Worker on device {self.device_id} ready in {self.load_time:.2f} seconds."
+        )
+        self.ready.set()
+
+        while not self._stopping.is_set():
+            try:
+                job = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job is None:
+                self.jobs.task_done()
+                break
+            fn, future = job
+            if not future.set_running_or_notify_cancel():
+                self.jobs.task_done()
+                continue
+            self.busy = True
+            try:
+                future.set_result(fn(self.pipeline))
+                self.processed += 1
+            except BaseException as e:
+                self.failed += 1
+                future.set_exception(e)
+            finally:
+                self.busy = False
+                self.jobs.task_done()
+        self._cancel_pending()
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                job[1].cancel()
+            self.jobs.task_done()
+
+    def submit(self, fn):
+        if self.load_error is not None:
+            raise RuntimeError(f"Worker on device {self.device_id} is not available")
+        if self._stopping.is_set():
+            raise RuntimeError(f"Worker on device {self.device_id} is stopping")
+        future = Future()
+        try:
+            self.jobs.put_nowait((fn, future))
+        except queue.Full:
+            raise QueueFullError(
+                f"Queue for device {self.device_id} is full ({self.max_queue_size} jobs)"
+            )
+        return future
+
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    def load(self):
+        return self.queue_depth() + int(self.busy)
+
+    def stats(self):
+        return {
+            "device_id": self.device_id,
+            "ready": self.ready.is_set() and self.load_error is None,
+            "busy": self.busy,
+            "queue_depth": self.queue_depth(),
+            "max_queue_size": self.max_queue_size,
+            "processed": self.processed,
+            "failed": self.failed,
+            "load_time": self.load_time,
+        }
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker after its running job; queued jobs are cancelled. Waits at
+        most `timeout` seconds for the running job to finish.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        try:
+            # wakes an idle worker right away, a full queue is noticed via _stopping
+            self.jobs.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+
+class PipelineWorkerPool:
+    """
+    One PipelineWorker per device with bounded queues.
+
+    Jobs are routed to the requested device if given, otherwise to the ready
+    worker with the fewest queued and running jobs.
+    """
+
+    def __init__(self, pipeline_factory, device_ids=(0,), max_queue_size=8):
+        self.workers = {
+            device_id: PipelineWorker(
+                pipeline_factory, device_id=device_id, max_queue_size=max_queue_size
+            )
+            for device_id in device_ids
+        }
+
+    def start(self, wait=True):
+        for worker in self.workers.values():
+            worker.start()
+        if wait:
+            for worker in self.workers.values():
+                worker.wait_until_ready()
+        return self
+
+    def submit(self, fn, device_id=None):
+        if device_id is not None:
+            if device_id not in self.workers:
+                raise ValueError(
+                    f"No worker for device {device_id}, available: {list(self.workers)}"
+                )
+            return self.workers[device_id].submit(fn)
+
+        candidates = [
+            worker
+            for worker in self.workers.values()
+            if worker.ready.is_set() and worker.load_error is None
+        ]
+        if not candidates:
+            raise RuntimeError("No worker is ready")
+        worker = min(candidates, key=lambda w: w.load())
+        return worker.submit(fn)
+
+    def queue_depth(self):
+        return sum(worker.queue_depth() for worker in self.workers.values())
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "workers": [worker.stats() for worker in self.workers.values()],
+        }
+
+    def stop(self, timeout=None):
+        for worker in self.workers.values():
+            worker.stop(timeout)
@@ -0,0 +1,161 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Micro-benchmark of the linear self-attention (CustomLiteLAProcessor2_0).
+
+Times one attention layer with the released model's width (20 heads of 128) on the
+sequence length of a 240 s song against the previous formulation (full float32
+upcast, ones-padded values, two matmuls), kept below as the reference. Parity is
+checked by tests/test_linear_attention.py.
+
+    python -m benchmarks.bench_linear_attention --durations 60,240 --dtypes float32,bfloat16
+"""
+
+import json
+import statistics
+import sys
+import time
+
+import click
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import Attention
+
+from acestep.models.ace_step_transformer import Qwen2RotaryEmbedding
+from acestep.models.customer_attention_processor import CustomLiteLAProcessor2_0
+
+
+def reference_linear_attention(attn, hidden_states, attention_mask, rotary_freqs_cis, eps=1e-15):
+    """The processor before the fused path, self-attention only."""
+    processor = attn.processor
+    batch_size = hidden_states.shape[0]
+    dtype = hidden_states.dtype
+    query = attn.to_q(hidden_states)
+    key = attn.to_k(hidden_states)
+    value = attn.to_v(hidden_states)
+
+    head_dim = key.shape[-1] // attn.heads
+    query = query.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
+    key = key.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1).transpose(-1, -2)
+    value = value.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
+    query = query.permute(0, 1, 3, 2)
+    if attn.norm_q is not None:
+        query = attn.norm_q(query)
+    if attn.norm_k is not None:
+        key = attn.norm_k(key)
+    query = processor.apply_rotary_emb(query, rotary_freqs_cis)
+    key = processor.apply_rotary_emb(key, rotary_freqs_cis)
+    query = query.permute(0, 1, 3, 2)
+
+    if attention_mask is not None:
+        attention_mask = attention_mask[:, None, :, None].to(key.dtype)
+        query = query * attention_mask.permute(0, 1, 3, 2)
+        key = key * attention_mask
+        value = value * attention_mask.permute(0, 1, 3, 2)
+
+    query = F.relu(query)
+    key = F.relu(key)
+    query, key, value = query.float(), key.float(), value.float()
+    value = F.pad(value, (0, 0, 0, 1), mode="constant", value=1.0)
+    hidden_states = torch.matmul(torch.matmul(value, key), query)
+    hidden_states = hidden_states[:, :, :-1] / (hidden_states[:, :, -1:] + eps)
+    hidden_states = hidden_states.view(batch_size, attn.heads * head_dim, -1).permute(0, 2, 1)
+    hidden_states = hidden_states.to(dtype)
+    hidden_states = attn.to_out[0](hidden_states)
+    return attn.to_out[1](hidden_states)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, warmup, repeats):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start_time = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+@click.command()
+@click.option("--durations", type=str, default="240", help="Comma separated audio durations in seconds")
+@click.option("--batch_size", type=int, default=3, help="Batch size (3 = cond, uncond and ERG branches)")
+@click.option("--dtypes", type=str, default="float32,bfloat16", help="Comma separated dtypes")
+@click.option("--heads", type=int, default=20, help="Attention heads")
+@click.option("--head_dim", type=int, default=128, help="Attention head dimension")
+@click.option("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device to run on")
+@click.option("--warmup", type=int, default=3, help="Untimed runs")
+@click.option("--repeats", type=int, default=10, help="Timed runs")
+@click.option("--output", type=str, default=None, help="Write the JSON report to this file instead of stdout")
+def main(durations, batch_size, dtypes, heads, head_dim, device, warmup, repeats, output):
+    device = torch.device(device)
+    torch.manual_seed(0)
+    dim = heads * head_dim
+    attn = Attention(
+        query_dim=dim,
+        dim_head=head_dim,
+        heads=heads,
+        out_dim=dim,
+        bias=True,
+        processor=CustomLiteLAProcessor2_0(),
+    ).eval()
+    rotary_emb = Qwen2RotaryEmbedding(head_dim, max_position_embeddings=32768, base=1000000.0)
+
+    results = []
+    for dtype_name in dtypes.split(","):
+        dtype = getattr(torch, dtype_name.strip())
+        attn.to(device=device, dtype=dtype)
+        rotary_emb.to(device=device)
+        for duration in [float(value) for value in durations.split(",") if value.strip()]:
+            # latent frames, the transformer sequence length (patch size 16 x 1)
+            seq_len = int(duration * 44100 / 512 / 8)
+            hidden_states = torch.randn(batch_size, seq_len, dim, device=device, dtype=dtype)
+            rotary_freqs_cis = rotary_emb(hidden_states, seq_len=seq_len)
+            full_mask = torch.ones(batch_size, seq_len, device=device, dtype=dtype)
+
+            with torch.no_grad():
+                reference_time = timeit(
+                    lambda: reference_linear_attention(attn, hidden_states, full_mask, rotary_freqs_cis),
+                    device, warmup, repeats,
+                )
+                # the transformer passes None for a mask without masked frames
+                fused_time = timeit(
+                    lambda: attn(hidden_states, attention_mask=None, rotary_freqs_cis=rotary_freqs_cis),
+                    device, warmup, repeats,
+                )
+
+            result = {
+                "dtype": dtype_name,
+                "duration": duration,
+                "seq_len": seq_len,
+                "batch_size": batch_size,
+                "reference_seconds": reference_time,
+                "fused_seconds": fused_time,
+                "speedup": reference_time / fused_time,
+            }
+            print(f"{dtype_name} {duration:.0f}s: {result['speedup']:.2f}x", file=sys.stderr)
+            results.append(result)
+
+    report = json.dumps(
+        {"device": str(device), "torch": torch.__version__, "num_threads": torch.get_num_threads(), "results": results},
+        indent=4,
+    )
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+End-to-end stage benchmark of ACEStepPipeline.
+
+Sweeps duration, infer_step, scheduler_type, cfg_type, batch size and ERG flags
+and reports per-stage latency, throughput and peak RSS as JSON. Without
+--checkpoint_path a tiny random-weight checkpoint is built, see tiny_models.py.
+
+    python -m benchmarks.bench_pipeline --durations 10,30 --infer_steps 10 --output results.json
+"""
+
+import functools
+import itertools
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import click
+import torch
+
+from acestep.pipeline_ace_step import ACEStepPipeline
+from acestep.profiler import process_peak_rss_mb
+from benchmarks.tiny_models import build_tiny_checkpoint
+
+
+PROMPT = "pop, rock, energetic, female vocal, guitar, drums, 120 bpm"
+LYRICS = """[verse]
+Neon lights are fading slow
+Counting steps on the road below
+[chorus]
+Hold on, hold on, we are almost home
+Hold on, hold on, we are almost home
+"""
+
+# ERG modes map to (use_erg_tag, use_erg_lyric, use_erg_diffusion)
+ERG_MODES = {
+    "all": (True, True, True),
+    "none": (False, False, False),
+    "tag": (True, False, False),
+    "lyric": (False, True, False),
+    "diffusion": (False, False, True),
+}
+
+# pipeline method -> stage name
+STAGES = {
+    "get_text_embeddings_batch": "text_encoder",
+    "get_text_embeddings_null_batch": "text_encoder",
+    "tokenize_lyrics_batch": "lyric_tokenizer",
+    "text2music_diffusion_process": "diffusion",
+    "latents2audio": "decode",
+}
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class StageRecorder:
+    """Times selected pipeline methods and samples the running process peak RSS after each of them."""
+
+    def __init__(self, pipeline):
+        self.records = {}
+        for method_name, stage in STAGES.items():
+            setattr(pipeline, method_name, self.wrap(getattr(pipeline, method_name), stage))
+
+    def wrap(self, method, stage):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            synchronize()
+            start_time = time.perf_counter()
+            result = method(*args, **kwargs)
+            synchronize()
+            record = self.records.setdefault(stage, {"latency": 0.0, "process_peak_rss_mb": 0.0})
+            record["latency"] += time.perf_counter() - start_time
+            record["process_peak_rss_mb"] = process_peak_rss_mb()
+            return result
+
+        return wrapper
+
+    def reset(self):
+        self.records = {}
+
+
+def capture_latents(pipeline):
+    """Returns a list that collects the latents of every text2music diffusion, as float32 CPU tensors."""
+    latents = []
+    diffusion = pipeline.text2music_diffusion_process
+
+    @functools.wraps(diffusion)
+    def capture(*args, **kwargs):
+        result = diffusion(*args, **kwargs)
+        latents.append(result.detach().float().cpu())
+        return result
+
+    pipeline.text2music_diffusion_process = capture
+    return latents
+
+
+def timed_runs(pipeline, recorder, warmup, repeats, **kwargs):
+    """Calls pipeline(**kwargs) warmup + repeats times, returns the stage records of the timed calls."""
+    runs = []
+    for i in range(warmup + repeats):
+        recorder.reset()
+        pipeline(**kwargs)
+        if i >= warmup:
+            runs.append(recorder.records)
+    return runs
+
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+
+def summarize(runs, duration, batch_size, infer_step):
+    summary = {}
+    for stage in runs[0]:
+        latencies = [run[stage]["latency"] for run in runs]
+        summary[stage] = {
+            "latency_mean": statistics.mean(latencies),
+            "latency_min": min(latencies),
+            "process_peak_rss_mb": max(run[stage]["process_peak_rss_mb"] for run in runs),
+        }
+    if "diffusion" in summary:
+        summary["diffusion"]["steps_per_second"] = (
+            infer_step / summary["diffusion"]["latency_mean"]
+        )
+    total = statistics.mean(sum(stage["latency"] for stage in run.values()) for run in runs)
+    summary["total"] = {
+        "latency_mean": total,
+        # seconds of audio generated per second of wall time
+        "audio_seconds_per_second": duration * batch_size / total,
+        "process_peak_rss_mb": process_peak_rss_mb(),
+    }
+    return summary
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, default="", help="Checkpoint directory, a tiny random-weight checkpoint is built if empty")
+@click.option("--bf16", type=bool, default=False, help="Whether to use bfloat16")
+@click.option("--device_id", type=int, default=0, help="Device ID to use")
+@click.option("--device", type=str, default=None, help="Device to run on (cpu, cuda, mps), detected if not set")
+@click.option("--cpu_threads", type=int, default=None, help="Intra-op threads with --device cpu")
+@click.option("--component_dtypes", type=str, default="", help="Comma separated component=dtype overrides, e.g. vocoder=float32,dcae=bfloat16")
+@click.option("--durations", type=str, default="10,30", help="Comma separated audio durations in seconds")
+@click.option("--infer_steps", type=str, default="10", help="Comma separated infer_step values")
+@click.option("--scheduler_types", type=str, default="euler", help="Comma separated scheduler types (euler, heun, pingpong)")
+@click.option("--cfg_types", type=str, default="apg", help="Comma separated cfg types (apg, cfg, cfg_star)")
+@click.option("--batch_sizes", type=str, default="1", help="Comma separated batch sizes")
+@click.option("--erg_modes", type=str, default="all,none", help=f"Comma separated ERG modes ({', '.join(ERG_MODES)})")
+@click.option("--guidance_truncation_thresholds", type=str, default="none", help="Comma separated guidance_truncation_threshold values, none disables it")
+@click.option("--warmup", type=int, default=1, help="Untimed runs per configuration")
+@click.option("--repeats", type=int, default=2, help="Timed runs per configuration")
+@click.option("--caches", type=bool, default=False, help="Keep the prompt/lyric caches enabled between runs")
+@click.option("--output", type=str, default=None, help="Write the JSON report to this file instead of stdout")
+def main(checkpoint_path, bf16, device_id, device, cpu_threads, component_dtypes, durations, infer_steps, scheduler_types, cfg_types, batch_sizes, erg_modes, guidance_truncation_thresholds, warmup, repeats, caches, output):
+    work_dir = tempfile.TemporaryDirectory(prefix="acestep_bench_")
+    if not checkpoint_path:
+        checkpoint_path = build_tiny_checkpoint(f"{work_dir.name}/checkpoints")
+
+    cache_kwargs = {} if caches else dict(text_embedding_cache_size=0, lyric_cache_size=0)
+    pipeline = ACEStepPipeline(
+        checkpoint_dir=checkpoint_path,
+        device_id=device_id,
+        dtype="bfloat16" if bf16 else "float32",
+        device=device,
+        cpu_threads=cpu_threads,
+        component_dtypes=dict(item.split("=") for item in parse_list(component_dtypes)),
+        **cache_kwargs,
+    )
+    start_time = time.perf_counter()
+    pipeline.ensure_loaded()
+    load_time = time.perf_counter() - start_time
+    recorder = StageRecorder(pipeline)
+
+    results = []
+    sweep = itertools.product(
+        parse_list(durations, float),
+        parse_list(infer_steps, int),
+        parse_list(scheduler_types),
+        parse_list(cfg_types),
+        parse_list(batch_sizes, int),
+        parse_list(erg_modes),
+        parse_list(guidance_truncation_thresholds, lambda value: None if value == "none" else float(value)),
+    )
+    for duration, infer_step, scheduler_type, cfg_type, batch_size, erg_mode, guidance_truncation_threshold in sweep:
+        use_erg_tag, use_erg_lyric, use_erg_diffusion = ERG_MODES[erg_mode]
+        config = dict(
+            audio_duration=duration,
+            infer_step=infer_step,
+            scheduler_type=scheduler_type,
+            cfg_type=cfg_type,
+            batch_size=batch_size,
+            use_erg_tag=use_erg_tag,
+            use_erg_lyric=use_erg_lyric,
+            use_erg_diffusion=use_erg_diffusion,
+            guidance_truncation_threshold=guidance_truncation_threshold,
+        )
+        runs = timed_runs(
+            pipeline,
+            recorder,
+            warmup,
+            repeats,
+            prompt=PROMPT,
+            lyrics=LYRICS,
+            manual_seeds="42",
+            save_path=f"{work_dir.name}/outputs/",
+            **config,
+        )
+        result = dict(config, erg_mode=erg_mode, stages=summarize(runs, duration, batch_size, infer_step))
+        if pipeline.last_guidance_truncation_stats is not None:
+            result["guidance_passes_saved"] = pipeline.last_guidance_truncation_stats["passes_saved"]
+        print(f"{json.dumps(config)} total: {result['stages']['total']['latency_mean']:.3f}s", file=sys.stderr)
+        results.append(result)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": str(pipeline.device),
+            "dtype": str(pipeline.dtype),
+            "component_dtypes": {
+                "text_encoder": str(pipeline.text_encoder_dtype),
+                "dcae": str(pipeline.dcae_dtype),
+                "vocoder": str(pipeline.vocoder_dtype),
+            },
+            "num_threads": torch.get_num_threads(),
+            "checkpoint": "tiny-random" if checkpoint_path.startswith(work_dir.name) else checkpoint_path,
+            "load_time": load_time,
+        },
+        "results": results,
+    }
+    report = json.dumps(report, indent=4)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+    work_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Parity and latency of the int8 dynamic quantization path against the float model.
+
+Writes the int8 weights (acestep.quantization) if the checkpoint has none, runs
+the same seeded generations with the float and the int8 pipeline and reports
+the latent MSE between them and per-stage latencies as JSON. Without
+--checkpoint_path a tiny random-weight checkpoint is built, see tiny_models.py.
+
+    python -m benchmarks.bench_quantization --durations 10,30 --infer_steps 10 --output int8.json
+"""
+
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import click
+import torch
+
+from acestep.pipeline_ace_step import ACEStepPipeline
+from acestep.quantization import TRANSFORMER_INT8_WEIGHTS, export_int8_checkpoint
+from benchmarks.bench_pipeline import (
+    LYRICS,
+    PROMPT,
+    StageRecorder,
+    capture_latents,
+    parse_list,
+    summarize,
+    timed_runs,
+)
+from benchmarks.tiny_models import build_tiny_checkpoint
+
+
+def file_size_mb(path):
+    return os.path.getsize(path) / (1024 ** 2) if os.path.exists(path) else None
+
+
+def load_pipeline(checkpoint_path, device_id, dtype, quantized):
+    pipeline = ACEStepPipeline(
+        checkpoint_dir=checkpoint_path,
+        device_id=device_id,
+        dtype=dtype,
+        quantized=quantized,
+        text_embedding_cache_size=0,
+        lyric_cache_size=0,
+    )
+    start_time = time.perf_counter()
+    pipeline.ensure_loaded()
+    load_time = time.perf_counter() - start_time
+    recorder = StageRecorder(pipeline)
+    return pipeline, recorder, capture_latents(pipeline), load_time
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, default="", help="Checkpoint directory, a tiny random-weight checkpoint is built if empty")
+@click.option("--reference_dtype", type=click.Choice(["bfloat16", "float32"]), default="bfloat16", help="dtype of the float reference pipeline")
+@click.option("--device_id", type=int, default=0, help="Device ID to use")
+@click.option("--durations", type=str, default="10,30", help="Comma separated audio durations in seconds")
+@click.option("--infer_steps", type=str, default="10", help="Comma separated infer_step values")
+@click.option("--warmup", type=int, default=1, help="Untimed runs per configuration")
+@click.option("--repeats", type=int, default=2, help="Timed runs per configuration")
+@click.option("--output", type=str, default=None, help="Write the JSON report to this file instead of stdout")
+def main(checkpoint_path, reference_dtype, device_id, durations, infer_steps, warmup, repeats, output):
+    work_dir = tempfile.TemporaryDirectory(prefix="acestep_bench_")
+    if not checkpoint_path:
+        checkpoint_path = build_tiny_checkpoint(f"{work_dir.name}/checkpoints")
+    transformer_path = os.path.join(checkpoint_path, "ace_step_transformer")
+    if not os.path.exists(os.path.join(transformer_path, TRANSFORMER_INT8_WEIGHTS)):
+        export_int8_checkpoint(checkpoint_path)
+
+    pipelines = {
+        "reference": load_pipeline(checkpoint_path, device_id, reference_dtype, False),
+        # the quantized kernels take float32 activations
+        "int8": load_pipeline(checkpoint_path, device_id, "float32", "int8"),
+    }
+
+    results = []
+    for duration in parse_list(durations, float):
+        for infer_step in parse_list(infer_steps, int):
+            config = dict(audio_duration=duration, infer_step=infer_step)
+            result = dict(config)
+            outputs = {}
+            for name, (pipeline, recorder, latents, _) in pipelines.items():
+                latents.clear()
+                runs = timed_runs(
+                    pipeline,
+                    recorder,
+                    warmup,
+                    repeats,
+                    prompt=PROMPT,
+                    lyrics=LYRICS,
+                    manual_seeds="42",
+                    save_path=f"{work_dir.name}/outputs/",
+                    **config,
+                )
+                outputs[name] = latents[-1]
+                result[name] = summarize(runs, duration, 1, infer_step)
+            reference, quantized = outputs["reference"], outputs["int8"]
+            mse = torch.mean((reference - quantized) ** 2).item()
+            result["parity"] = {
+                "latent_mse": mse,
+                # MSE relative to the latent variance, comparable across checkpoints
+                "latent_relative_mse": mse / max(reference.var().item(), 1e-12),
+                "latent_max_abs_diff": (reference - quantized).abs().max().item(),
+            }
+            result["speedup"] = {
+                stage: result["reference"][stage]["latency_mean"] / result["int8"][stage]["latency_mean"]
+                for stage in ("text_encoder", "diffusion", "total")
+                if stage in result["int8"]
+            }
+            print(
+                f"{json.dumps(config)} latent mse: {mse:.3e} "
+                f"diffusion speedup: {result['speedup'].get('diffusion', 0):.2f}x",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": str(pipelines["int8"][0].device),
+            "quantized_engine": torch.backends.quantized.engine,
+            "num_threads": torch.get_num_threads(),
+            "checkpoint": "tiny-random" if checkpoint_path.startswith(work_dir.name) else checkpoint_path,
+            "reference_dtype": reference_dtype,
+            "load_time": {name: entry[3] for name, entry in pipelines.items()},
+            "transformer_weights_mb": {
+                "reference": file_size_mb(os.path.join(transformer_path, "diffusion_pytorch_model.safetensors")),
+                "int8": file_size_mb(os.path.join(transformer_path, TRANSFORMER_INT8_WEIGHTS)),
+            },
+        },
+        "results": results,
+    }
+    report = json.dumps(report, indent=4)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+    work_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Speed and quality of the cross-step block cache (step_cache_threshold) against full steps.
+
+Runs the same seeded generations without the cache and with each threshold, and
+reports per-stage latencies, the speedup, the latent MSE to the uncached run and the
+cache hit statistics as JSON. Without --checkpoint_path a tiny random-weight
+checkpoint is built, see tiny_models.py.
+
+    python -m benchmarks.bench_step_cache --thresholds 0.05,0.1,0.2 --infer_steps 27,60 --output step_cache.json
+"""
+
+import json
+import platform
+import sys
+import tempfile
+
+import click
+import torch
+
+from acestep.pipeline_ace_step import ACEStepPipeline
+from benchmarks.bench_pipeline import (
+    LYRICS,
+    PROMPT,
+    StageRecorder,
+    capture_latents,
+    parse_list,
+    summarize,
+    timed_runs,
+)
+from benchmarks.tiny_models import build_tiny_checkpoint
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, default="", help="Checkpoint directory, a tiny random-weight checkpoint is built if empty")
+@click.option("--bf16", type=bool, default=True, help="Whether to use bfloat16")
+@click.option("--device_id", type=int, default=0, help="Device ID to use")
+@click.option("--thresholds", type=str, default="0.05,0.1,0.2", help="Comma separated step_cache_threshold values")
+@click.option("--warmup_steps", type=int, default=2, help="step_cache_warmup_steps")
+@click.option("--max_skips", type=int, default=2, help="step_cache_max_skips")
+@click.option("--durations", type=str, default="30", help="Comma separated audio durations in seconds")
+@click.option("--infer_steps", type=str, default="27,60", help="Comma separated infer_step values")
+@click.option("--seeds", type=str, default="42,1234", help="Comma separated seeds, every configuration runs each of them")
+@click.option("--warmup", type=int, default=1, help="Untimed runs per configuration")
+@click.option("--repeats", type=int, default=2, help="Timed runs per configuration")
+@click.option("--output", type=str, default=None, help="Write the JSON report to this file instead of stdout")
+def main(checkpoint_path, bf16, device_id, thresholds, warmup_steps, max_skips, durations, infer_steps, seeds, warmup, repeats, output):
+    work_dir = tempfile.TemporaryDirectory(prefix="acestep_bench_")
+    tiny = not checkpoint_path
+    if tiny:
+        checkpoint_path = build_tiny_checkpoint(f"{work_dir.name}/checkpoints")
+
+    pipeline = ACEStepPipeline(
+        checkpoint_dir=checkpoint_path,
+        device_id=device_id,
+        dtype="bfloat16" if bf16 else "float32",
+        step_cache_warmup_steps=warmup_steps,
+        step_cache_max_skips=max_skips,
+        text_embedding_cache_size=0,
+        lyric_cache_size=0,
+    )
+    pipeline.ensure_loaded()
+    recorder = StageRecorder(pipeline)
+    latents = capture_latents(pipeline)
+
+    def run(config, seed, save_path):
+        latents.clear()
+        runs = timed_runs(
+            pipeline,
+            recorder,
+            warmup,
+            repeats,
+            prompt=PROMPT,
+            lyrics=LYRICS,
+            manual_seeds=str(seed),
+            save_path=save_path,
+            **config,
+        )
+        return runs, latents[-1]
+
+    results = []
+    for duration in parse_list(durations, float):
+        for infer_step in parse_list(infer_steps, int):
+            for seed in parse_list(seeds, int):
+                config = dict(audio_duration=duration, infer_step=infer_step)
+                save_path = f"{work_dir.name}/outputs/"
+
+                pipeline.step_cache_threshold = None
+                runs, reference = run(config, seed, save_path)
+                baseline = summarize(runs, duration, 1, infer_step)
+                result = dict(config, seed=seed, baseline=baseline, cached={})
+
+                for threshold in parse_list(thresholds, float):
+                    pipeline.step_cache_threshold = threshold
+                    runs, cached = run(config, seed, save_path)
+                    stats = pipeline.last_step_cache_stats
+                    mse = torch.mean((reference - cached) ** 2).item()
+                    entry = summarize(runs, duration, 1, infer_step)
+                    entry["speedup"] = {
+                        stage: baseline[stage]["latency_mean"] / entry[stage]["latency_mean"]
+                        for stage in ("diffusion", "total")
+                    }
+                    entry["parity"] = {
+                        "latent_mse": mse,
+                        # MSE relative to the latent variance, comparable across checkpoints
+                        "latent_relative_mse": mse / max(reference.var().item(), 1e-12),
+                        "latent_max_abs_diff": (reference - cached).abs().max().item(),
+                    }
+                    entry["step_cache"] = stats
+                    result["cached"][str(threshold)] = entry
+                    print(
+                        f"{json.dumps(config)} seed {seed} threshold {threshold}: "
+                        f"hit rate {stats['hit_rate']:.2f}, "
+                        f"diffusion speedup {entry['speedup']['diffusion']:.2f}x, "
+                        f"latent relative mse {entry['parity']['latent_relative_mse']:.3e}",
+                        file=sys.stderr,
+                    )
+                results.append(result)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": str(pipeline.device),
+            "dtype": str(pipeline.dtype),
+            "checkpoint": "tiny-random" if tiny else checkpoint_path,
+            "warmup_steps": warmup_steps,
+            "max_skips": max_skips,
+        },
+        "results": results,
+    }
+    report = json.dumps(report, indent=4)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+    work_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+
+Builds a checkpoint directory with the same layout as the released one
+(music_dcae_f8c8, music_vocoder, ace_step_transformer, umt5-base) but with
+reduced configs and random weights, so the full pipeline runs on machines
+without GPUs or downloaded checkpoints.
+
+The sizes keep every tensor interface of the real models: 8 latent channels
+with 8x compression, 128 mel bins, a vocoder hop of 512 samples, a 1024 wide
+lyric encoder and enough transformer/UMT5 layers for the ERG hooks.
+"""
+
+import os
+
+import torch
+from diffusers import AutoencoderDC
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import PreTrainedTokenizerFast, UMT5Config, UMT5EncoderModel
+
+from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+from acestep.music_dcae.music_vocoder import ADaMoSHiFiGANV1
+
+
+TINY_TEXT_DIM = 64
+
+TINY_DCAE_CONFIG = dict(
+    in_channels=2,
+    latent_channels=8,
+    attention_head_dim=16,
+    encoder_block_types="ResBlock",
+    decoder_block_types="ResBlock",
+    encoder_block_out_channels=(16, 32, 32, 64),
+    decoder_block_out_channels=(16, 32, 32, 64),
+    encoder_layers_per_block=(1, 1, 1, 1),
+    decoder_layers_per_block=(1, 1, 1, 1),
+    encoder_qkv_multiscales=((), (), (), ()),
+    decoder_qkv_multiscales=((), (), (), ()),
+    upsample_block_type="interpolate",
+    downsample_block_type="Conv",
+    decoder_norm_types="rms_norm",
+    decoder_act_fns="silu",
+)
+
+TINY_VOCODER_CONFIG = dict(
+    input_channels=128,
+    depths=[1, 1, 1, 1],
+    dims=[16, 16, 32, 32],
+    upsample_rates=(8, 8, 8),
+    upsample_kernel_sizes=(16, 16, 16),
+    resblock_kernel_sizes=(3,),
+    resblock_dilation_sizes=((1, 3, 5),),
+    num_mels=32,
+    upsample_initial_channel=64,
+    pre_conv_kernel_size=7,
+    post_conv_kernel_size=7,
+)
+
+TINY_TRANSFORMER_CONFIG = dict(
+    # use_erg_diffusion hooks blocks 15-20
+    num_layers=20,
+    attention_head_dim=32,
+    num_attention_heads=2,
+    mlp_ratio=2.0,
+    text_embedding_dim=TINY_TEXT_DIM,
+    ssl_latent_dims=[64, 64],
+)
+
+TINY_UMT5_CONFIG = dict(
+    d_model=TINY_TEXT_DIM,
+    d_kv=16,
+    d_ff=128,
+    # use_erg_tag hooks blocks 8-10
+    num_layers=10,
+    num_heads=4,
+)
+
+TINY_VOCAB = [
+    "<pad>", "</s>", "<unk>", ",", "pop", "rock", "hip-hop", "rap", "jazz", "edm",
+    "piano", "guitar", "drums", "bass", "synth", "vocal", "female", "male",
+    "energetic", "melancholic", "upbeat", "chill", "bpm",
+]
+
+
+def build_tiny_tokenizer():
+    tokenizer = Tokenizer(
+        WordLevel({token: i for i, token in enumerate(TINY_VOCAB)}, unk_token="<unk>")
+    )
+    tokenizer.pre_tokenizer = Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+
+
+def build_tiny_checkpoint(checkpoint_dir, seed=0):
+    """Writes random-weight tiny models to checkpoint_dir and returns it."""
+    torch.manual_seed(seed)
+
+    AutoencoderDC(**TINY_DCAE_CONFIG).save_pretrained(
+        os.path.join(checkpoint_dir, "music_dcae_f8c8")
+    )
+    ADaMoSHiFiGANV1(**TINY_VOCODER_CONFIG).save_pretrained(
+        os.path.join(checkpoint_dir, "music_vocoder")
+    )
+    ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG).save_pretrained(
+        os.path.join(checkpoint_dir, "ace_step_transformer")
+    )
+
+    text_encoder_path = os.path.join(checkpoint_dir, "umt5-base")
+    tokenizer = build_tiny_tokenizer()
+    UMT5EncoderModel(
+        UMT5Config(vocab_size=len(TINY_VOCAB), pad_token_id=0, eos_token_id=1, **TINY_UMT5_CONFIG)
+    ).save_pretrained(text_encoder_path)
+    tokenizer.save_pretrained(text_encoder_path)
+    return checkpoint_dir
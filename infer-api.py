@@ -1,18 +1,34 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-import os
+import asyncio
+import concurrent.futures
+import struct
+import threading
+import click
+import torch
+from acestep.music_dcae.resampler import StreamingResampler
 from acestep.pipeline_ace_step import ACEStepPipeline
-from acestep.data_sampler import DataSampler
+from acestep.worker_pool import PipelineWorkerPool, QueueFullError
 import uuid
 
 app = FastAPI(title="ACEStep Pipeline API")
 
+# Created once at startup, see main()
+worker_pool: Optional[PipelineWorkerPool] = None
+# checkpoint_path, bf16 and torch_compile the workers were started with
+pool_config: dict = {}
+# --output_sample_rate, the rate of saved files and of streamed audio
+pool_output_sample_rate: int = 48000
+
 class ACEStepInput(BaseModel):
-    checkpoint_path: str
-    bf16: bool = True
-    torch_compile: bool = False
-    device_id: int = 0
+    # checkpoint_path, bf16 and torch_compile are configured when the server starts;
+    # requests may repeat them, but cannot change them (see check_pool_config).
+    checkpoint_path: Optional[str] = None
+    bf16: Optional[bool] = None
+    torch_compile: Optional[bool] = None
+    device_id: Optional[int] = None
     output_path: Optional[str] = None
     audio_duration: float
     prompt: str
@@ -32,75 +48,261 @@ class ACEStepInput(BaseModel):
     oss_steps: List[int]
     guidance_scale_text: float = 0.0
     guidance_scale_lyric: float = 0.0
+    profile: bool = False
+    guidance_truncation_threshold: Optional[float] = None
+    guidance_truncation_patience: int = 3
 
 class ACEStepOutput(BaseModel):
     status: str
     output_path: Optional[str]
     message: str
 
-def initialize_pipeline(checkpoint_path: str, bf16: bool, torch_compile: bool, device_id: int) -> ACEStepPipeline:
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
-    return ACEStepPipeline(
-        checkpoint_dir=checkpoint_path,
-        dtype="bfloat16" if bf16 else "float32",
-        torch_compile=torch_compile,
+def create_pipeline_factory(checkpoint_path: str, bf16: bool, torch_compile: bool, cpu_offload: bool, overlapped_decode: bool, block_streaming: bool = False, block_streaming_memory_mb: Optional[int] = None, output_sample_rate: int = 48000, duration_buckets: Optional[List[float]] = None, aot_transformer_dir: Optional[str] = None, quantized: str = "none", device: Optional[str] = None, cpu_threads: Optional[int] = None):
+    def factory(device_id: int) -> ACEStepPipeline:
+        return ACEStepPipeline(
+            checkpoint_dir=checkpoint_path,
+            device_id=device_id,
+            dtype="bfloat16" if bf16 else "float32",
+            torch_compile=torch_compile,
+            cpu_offload=cpu_offload,
+            overlapped_decode=overlapped_decode,
+            block_streaming=block_streaming,
+            block_streaming_memory_mb=block_streaming_memory_mb,
+            output_sample_rate=output_sample_rate,
+            duration_buckets=duration_buckets,
+            aot_transformer_dir=aot_transformer_dir,
+            quantized=False if quantized == "none" else quantized,
+            device=device,
+            cpu_threads=cpu_threads,
+        )
+    return factory
+
+# rate of the decoded chunks, resampled to output_sample_rate while streaming
+DECODE_SAMPLE_RATE = 44100
+# decoded chunks buffered per stream, the worker waits for slow clients beyond this
+STREAM_QUEUE_CHUNKS = 4
+
+def check_pool_config(input_data: ACEStepInput):
+    """Rejects requests asking for another model configuration than the warm workers run."""
+    for name, value in pool_config.items():
+        requested = getattr(input_data, name)
+        if requested is not None and requested != value:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{name}={requested!r} differs from the server configuration ({name}={value!r}), it is set when the server starts",
+            )
+
+def get_pipeline_params(input_data: ACEStepInput):
+    return dict(
+        audio_duration=input_data.audio_duration,
+        prompt=input_data.prompt,
+        lyrics=input_data.lyrics,
+        infer_step=input_data.infer_step,
+        guidance_scale=input_data.guidance_scale,
+        scheduler_type=input_data.scheduler_type,
+        cfg_type=input_data.cfg_type,
+        omega_scale=input_data.omega_scale,
+        manual_seeds=", ".join(map(str, input_data.actual_seeds)),
+        guidance_interval=input_data.guidance_interval,
+        guidance_interval_decay=input_data.guidance_interval_decay,
+        min_guidance_scale=input_data.min_guidance_scale,
+        use_erg_tag=input_data.use_erg_tag,
+        use_erg_lyric=input_data.use_erg_lyric,
+        use_erg_diffusion=input_data.use_erg_diffusion,
+        oss_steps=", ".join(map(str, input_data.oss_steps)),
+        guidance_scale_text=input_data.guidance_scale_text,
+        guidance_scale_lyric=input_data.guidance_scale_lyric,
+        profile=input_data.profile,
+        guidance_truncation_threshold=input_data.guidance_truncation_threshold,
+        guidance_truncation_patience=input_data.guidance_truncation_patience,
+        # one song per request, as before per-sample seeds; extra seeds are ignored
+        batch_size=1,
     )
 
+def wav_stream_header(sample_rate: int, num_channels: int, bits_per_sample: int = 16):
+    # RIFF/data sizes are unknown while streaming, use the maximum as most players do
+    byte_rate = sample_rate * num_channels * bits_per_sample // 8
+    block_align = num_channels * bits_per_sample // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, num_channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+def wav_to_pcm16(wav: torch.Tensor):
+    # (channels, samples) float -> interleaved little-endian int16
+    pcm = (wav.clamp(-1.0, 1.0) * 32767.0).to(torch.int16)
+    return pcm.t().contiguous().numpy().tobytes()
+
 @app.post("/generate", response_model=ACEStepOutput)
 async def generate_audio(input_data: ACEStepInput):
-    try:
-        # Initialize pipeline
-        model_demo = initialize_pipeline(
-            input_data.checkpoint_path,
-            input_data.bf16,
-            input_data.torch_compile,
-            input_data.device_id
-        )
-
-        # Prepare parameters
-        params = (
-            input_data.audio_duration,
-            input_data.prompt,
-            input_data.lyrics,
-            input_data.infer_step,
-            input_data.guidance_scale,
-            input_data.scheduler_type,
-            input_data.cfg_type,
-            input_data.omega_scale,
-            ", ".join(map(str, input_data.actual_seeds)),
-            input_data.guidance_interval,
-            input_data.guidance_interval_decay,
-            input_data.min_guidance_scale,
-            input_data.use_erg_tag,
-            input_data.use_erg_lyric,
-            input_data.use_erg_diffusion,
-            ", ".join(map(str, input_data.oss_steps)),
-            input_data.guidance_scale_text,
-            input_data.guidance_scale_lyric,
-        )
+    if worker_pool is None:
+        raise HTTPException(status_code=503, detail="Worker pool is not initialized")
+    check_pool_config(input_data)
 
-        # Generate output path if not provided
-        output_path = input_data.output_path or f"output_{uuid.uuid4().hex}.wav"
+    # Prepare parameters
+    params = get_pipeline_params(input_data)
 
-        # Run pipeline
-        model_demo(
-            *params,
-            save_path=output_path
-        )
+    # Generate output path if not provided
+    output_path = input_data.output_path or f"output_{uuid.uuid4().hex}.wav"
 
-        return ACEStepOutput(
-            status="success",
-            output_path=output_path,
-            message="Audio generated successfully"
+    try:
+        # Run pipeline on a warm worker
+        future = worker_pool.submit(
+            lambda pipeline: pipeline(**params, save_path=output_path),
+            device_id=input_data.device_id,
         )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    try:
+        await asyncio.wrap_future(future)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e)}")
 
+    return ACEStepOutput(
+        status="success",
+        output_path=output_path,
+        message="Audio generated successfully"
+    )
+
+@app.post("/generate_stream")
+async def generate_audio_stream(input_data: ACEStepInput):
+    """Streams a 16-bit PCM WAV at --output_sample_rate, as /generate saves, while the song is still being decoded."""
+    if worker_pool is None:
+        raise HTTPException(status_code=503, detail="Worker pool is not initialized")
+    check_pool_config(input_data)
+
+    params = get_pipeline_params(input_data)
+    sample_rate = pool_output_sample_rate
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    done = object()
+    # set when the client goes away, the worker stops decoding at the next chunk
+    cancelled = threading.Event()
+
+    def put(item):
+        # Blocks the worker while the queue is full, gives up once the stream is cancelled
+        future = asyncio.run_coroutine_threadsafe(chunks.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if cancelled.is_set():
+                    future.cancel()
+                    return
+
+    def run(pipeline):
+        # The generator must be consumed on the worker thread that owns the pipeline
+        try:
+            audio_stream, _ = pipeline(**params, stream=True)
+            # chunks are resampled as one signal, so that their boundaries do not click
+            resampler = StreamingResampler(DECODE_SAMPLE_RATE, sample_rate)
+            for _, wav in audio_stream:
+                if cancelled.is_set():
+                    break
+                wav = resampler(wav)
+                if wav.shape[-1] > 0:
+                    put(wav)
+            else:
+                tail = resampler.flush()
+                if tail is not None and tail.shape[-1] > 0:
+                    put(tail)
+        finally:
+            put(done)
+
+    try:
+        future = worker_pool.submit(run, device_id=input_data.device_id)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job = asyncio.wrap_future(future)
+
+    async def next_chunk():
+        # `done` is only put by run, a job cancelled while queued or failing before
+        # it starts never puts it, so the job is awaited along with the queue
+        get = asyncio.ensure_future(chunks.get())
+        await asyncio.wait([get, job], return_when=asyncio.FIRST_COMPLETED)
+        if get.done():
+            return get.result()
+        get.cancel()
+        if not chunks.empty():
+            return chunks.get_nowait()
+        return done
+
+    # Wait for the first chunk so that generation errors are still reported as HTTP errors
+    first_chunk = await next_chunk()
+    if first_chunk is done:
+        try:
+            await job
+        except BaseException as e:
+            cancelled.set()
+            raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e) or type(e).__name__}")
+        raise HTTPException(status_code=500, detail="Error generating audio: no audio was decoded")
+
+    async def body():
+        try:
+            yield wav_stream_header(sample_rate, first_chunk.shape[0])
+            chunk = first_chunk
+            while chunk is not done:
+                yield wav_to_pcm16(chunk)
+                chunk = await next_chunk()
+        finally:
+            cancelled.set()
+
+    return StreamingResponse(body(), media_type="audio/wav")
+
+@app.get("/queue")
+async def queue_status():
+    if worker_pool is None:
+        raise HTTPException(status_code=503, detail="Worker pool is not initialized")
+    return worker_pool.stats()
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    if worker_pool is None:
+        return {"status": "starting"}
+    return {"status": "healthy", "queue_depth": worker_pool.queue_depth()}
 
-if __name__ == "__main__":
+@click.command()
+@click.option("--checkpoint_path", type=str, default="", help="Path to the checkpoint directory")
+@click.option("--bf16", type=bool, default=True, help="Whether to use bfloat16")
+@click.option("--torch_compile", type=bool, default=False, help="Whether to use torch compile")
+@click.option("--cpu_offload", type=bool, default=False, help="Whether to use CPU offloading (only load current stage's model to GPU)")
+@click.option("--overlapped_decode", type=bool, default=False, help="Whether to use overlapped decoding (run dcae and vocoder using sliding windows)")
+@click.option("--block_streaming", type=bool, default=False, help="Whether to stream transformer blocks through the GPU (low memory), turns off the cross-attention K/V cache")
+@click.option("--block_streaming_memory_mb", type=int, default=None, help="GPU memory budget for transformer blocks when streaming")
+@click.option("--output_sample_rate", type=int, default=48000, help="Sample rate of saved and streamed audio, 44100 skips resampling")
+@click.option("--duration_buckets", type=str, default="", help="Comma separated durations in seconds the transformer input is padded up to, e.g. 30,60,120,240 (precompiled at startup with --torch_compile)")
+@click.option("--aot_transformer_dir", type=str, default=None, help="Directory of AOT compiled transformer packages from acestep.aot_export")
+@click.option("--quantized", type=click.Choice(["none", "int4", "int8"]), default="none", help="Load quantized weights, int8 is the CPU path (python -m acestep.quantization)")
+@click.option("--device", type=str, default=None, help="Device type to run on (cpu, cuda, mps), detected if not set")
+@click.option("--cpu_threads", type=int, default=None, help="Intra-op threads of the server process with --device cpu")
+@click.option("--device_ids", type=str, default="0", help="Comma separated device IDs, one warm worker per device")
+@click.option("--max_queue_size", type=int, default=8, help="Maximum number of queued jobs per worker")
+@click.option("--host", type=str, default="0.0.0.0", help="Host to bind")
+@click.option("--port", type=int, default=8000, help="Port to bind")
+def main(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, block_streaming, block_streaming_memory_mb, output_sample_rate, duration_buckets, aot_transformer_dir, quantized, device, cpu_threads, device_ids, max_queue_size, host, port):
+    global worker_pool, pool_config, pool_output_sample_rate
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    duration_buckets = [float(duration) for duration in duration_buckets.split(",") if duration.strip()]
+    device_ids = [int(device_id) for device_id in device_ids.split(",")]
+    if device == "cpu" and len(device_ids) > 1:
+        # thread pools are per process, CPU workers would share and oversubscribe them
+        raise click.BadParameter("--device cpu runs a single worker, pass one device ID", param_hint="--device_ids")
+    pool_config = dict(checkpoint_path=checkpoint_path, bf16=bf16, torch_compile=torch_compile)
+    pool_output_sample_rate = output_sample_rate
+    worker_pool = PipelineWorkerPool(
+        create_pipeline_factory(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, block_streaming, block_streaming_memory_mb, output_sample_rate, duration_buckets, aot_transformer_dir, quantized, device, cpu_threads),
+        device_ids=device_ids,
+        max_queue_size=max_queue_size,
+    ).start(wait=True)
+    uvicorn.run(app, host=host, port=port)
+
+if __name__ == "__main__":
+    main()
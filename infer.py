@@ -47,8 +47,11 @@ def sample_data(json_data):
     "--overlapped_decode", type=bool, default=False, help="Whether to use overlapped decoding (run dcae and vocoder using sliding windows)"
 )
 @click.option("--device_id", type=int, default=0, help="Device ID to use")
+@click.option("--device", type=str, default=None, help="Device to run on (cpu, cuda, mps), detected if not set")
+@click.option("--cpu_threads", type=int, default=None, help="Intra-op threads with --device cpu")
+@click.option("--step_cache_threshold", type=float, default=None, help="Skip the transformer blocks on steps whose input changed less than this (e.g. 0.1)")
 @click.option("--output_path", type=str, default=None, help="Path to save the output")
-def main(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, device_id, output_path):
+def main(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, device_id, device, cpu_threads, step_cache_threshold, output_path):
     os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
 
     model_demo = ACEStepPipeline(
@@ -56,7 +59,10 @@ def main(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, d
         dtype="bfloat16" if bf16 else "float32",
         torch_compile=torch_compile,
         cpu_offload=cpu_offload,
-        overlapped_decode=overlapped_decode
+        overlapped_decode=overlapped_decode,
+        device=device,
+        cpu_threads=cpu_threads,
+        step_cache_threshold=step_cache_threshold,
     )
     print(model_demo)
 
@@ -107,6 +113,7 @@ def main(checkpoint_path, bf16, torch_compile, cpu_offload, overlapped_decode, d
         guidance_scale_text=guidance_scale_text,
         guidance_scale_lyric=guidance_scale_lyric,
         save_path=output_path,
+        batch_size=1,
     )
 
 
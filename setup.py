@@ -29,6 +29,9 @@ setup(
             "peft",
             "tensorboard",
             "tensorboardX"
-        ]
+        ],
+        "test": [
+            "pytest>=7.0",  # pythonpath in pytest.ini
+        ],
     },
 )
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+from acestep.pipeline_ace_step import ACEStepPipeline
+from benchmarks.tiny_models import TINY_TRANSFORMER_CONFIG
+
+
+def make_decode_inputs(transformer, batch_size=2, frame_length=24, text_length=8, lyric_length=12):
+    """Random encoder outputs and latents for ACEStepTransformer2DModel.decode."""
+    config = transformer.config
+    encoder_hidden_states, encoder_hidden_mask = transformer.encode(
+        torch.randn(batch_size, text_length, config.text_embedding_dim),
+        torch.ones(batch_size, text_length, dtype=torch.long),
+        torch.zeros(batch_size, config.speaker_embedding_dim),
+        torch.randint(0, config.lyric_encoder_vocab_size, (batch_size, lyric_length)),
+        torch.ones(batch_size, lyric_length, dtype=torch.long),
+    )
+    return dict(
+        hidden_states=torch.randn(batch_size, config.in_channels, 16, frame_length),
+        attention_mask=torch.ones(batch_size, frame_length),
+        encoder_hidden_states=encoder_hidden_states,
+        encoder_hidden_mask=encoder_hidden_mask,
+        output_length=frame_length,
+    )
+
+
+@pytest.fixture
+def decode_inputs():
+    return make_decode_inputs
+
+
+@pytest.fixture
+def tiny_transformer():
+    torch.manual_seed(0)
+    return ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG).eval()
+
+
+@pytest.fixture
+def make_pipeline(tmp_path):
+    """Builds CPU pipelines without loading any checkpoint, for the cache and batching logic."""
+
+    def make(**kwargs):
+        return ACEStepPipeline(
+            checkpoint_dir=str(tmp_path / "checkpoints"), device="cpu", dtype="float32", **kwargs
+        )
+
+    return make
@@ -0,0 +1,209 @@
+import torch
+
+from acestep.cache_utils import DiskCache, LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b") is None
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1}
+
+
+def test_lru_cache_of_size_zero_stores_nothing():
+    cache = LRUCache(max_size=0)
+    cache.put("a", 1)
+    assert len(cache) == 0
+    assert cache.get("a", "missing") == "missing"
+
+
+def test_disk_cache_round_trip_and_unreadable_entries(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    key = ("text", ("a prompt",), 256)
+    tensors = {"last_hidden_states": torch.randn(1, 4, 8)}
+    cache.put(key, tensors)
+
+    loaded = DiskCache(str(tmp_path)).get(key)
+    torch.testing.assert_close(loaded["last_hidden_states"], tensors["last_hidden_states"])
+    assert cache.get(("text", ("another prompt",), 256)) is None
+
+    with open(cache.path(key), "wb") as f:
+        f.write(b"truncated")
+    assert cache.get(key) is None
+
+
+def fake_text_encoder(pipeline):
+    """Replaces the text encoder calls of `pipeline`, returning the prompts they were called with."""
+    calls = []
+
+    def encode_text(texts, text_max_length=256):
+        calls.append(("text", tuple(texts)))
+        return torch.randn(len(texts), 4, 8), torch.ones(len(texts), 4, dtype=torch.long)
+
+    def encode_text_null(texts, text_max_length=256, tau=0.01, l_min=8, l_max=10):
+        calls.append(("text_null", tuple(texts), tau))
+        return torch.randn(len(texts), 4, 8)
+
+    pipeline.encode_text = encode_text
+    pipeline.encode_text_null = encode_text_null
+    return calls
+
+
+def test_text_embeddings_are_cached_and_returned_as_copies(make_pipeline):
+    pipeline = make_pipeline()
+    calls = fake_text_encoder(pipeline)
+
+    first, mask = pipeline.get_text_embeddings(["pop, piano"])
+    expected = first.clone()
+    first.zero_()
+    mask.zero_()
+    second, second_mask = pipeline.get_text_embeddings(["pop, piano"])
+
+    assert calls == [("text", ("pop, piano",))]
+    torch.testing.assert_close(second, expected)
+    assert bool(second_mask.all())
+
+
+def test_text_embedding_keys_include_tau_dtypes_and_quantization(make_pipeline):
+    pipeline = make_pipeline()
+    calls = fake_text_encoder(pipeline)
+
+    pipeline.get_text_embeddings_null(["pop"], tau=0.01)
+    pipeline.get_text_embeddings_null(["pop"], tau=0.01)
+    pipeline.get_text_embeddings_null(["pop"], tau=0.02)
+    assert calls == [("text_null", ("pop",), 0.01), ("text_null", ("pop",), 0.02)]
+
+    calls.clear()
+    pipeline.get_text_embeddings(["pop"])
+    pipeline.text_encoder_dtype = torch.bfloat16
+    pipeline.get_text_embeddings(["pop"])
+    pipeline.quantized = "int8"
+    pipeline.get_text_embeddings(["pop"])
+    assert len(calls) == 3
+
+
+def test_text_embeddings_are_shared_through_the_disk_cache(make_pipeline, tmp_path):
+    cache_dir = str(tmp_path / "text_embeddings")
+    writer = make_pipeline(text_embedding_cache_dir=cache_dir)
+    fake_text_encoder(writer)
+    expected, _ = writer.get_text_embeddings(["pop"])
+
+    reader = make_pipeline(text_embedding_cache_dir=cache_dir)
+    calls = fake_text_encoder(reader)
+    actual, _ = reader.get_text_embeddings(["pop"])
+
+    assert calls == []
+    torch.testing.assert_close(actual, expected)
+
+
+class FakeLyricTokenizer:
+    def __init__(self, failing_lines=()):
+        self.failing_lines = set(failing_lines)
+        self.calls = []
+
+    def encode(self, line, lang):
+        self.calls.append(line)
+        if line in self.failing_lines:
+            raise ValueError(f"cannot tokenize {line}")
+        return [len(line), ord(line[0])]
+
+    def batch_decode(self, token_ids):
+        return [str(ids) for ids in token_ids]
+
+
+def lyric_pipeline(make_pipeline, failing_lines=()):
+    pipeline = make_pipeline()
+    pipeline.lyric_tokenizer = FakeLyricTokenizer(failing_lines)
+    pipeline.get_lang = lambda text: "en"
+    return pipeline
+
+
+def test_lyric_lines_and_lyrics_are_tokenized_once(make_pipeline):
+    pipeline = lyric_pipeline(make_pipeline)
+    lyrics = "[chorus]\nla la\n\nhey\nla la"
+
+    tokens = pipeline.tokenize_lyrics(lyrics)
+    # the repeated chorus line is tokenized once
+    assert pipeline.lyric_tokenizer.calls == ["[chorus]", "la la", "hey"]
+    assert tokens == [261, 8, 91, 2, 5, 108, 2, 2, 3, 104, 2, 5, 108, 2]
+
+    tokens.append(0)
+    assert pipeline.tokenize_lyrics(lyrics) == tokens[:-1]
+    assert pipeline.tokenize_lyrics("hey") == [261, 3, 104, 2]
+    assert pipeline.lyric_tokenizer.calls == ["[chorus]", "la la", "hey"]
+
+
+def test_lines_the_tokenizer_failed_on_are_retried(make_pipeline):
+    pipeline = lyric_pipeline(make_pipeline, failing_lines={"bad"})
+
+    assert pipeline.tokenize_lyrics("good\nbad") == [261, 4, 103, 2]
+    pipeline.lyric_tokenizer.failing_lines.clear()
+    assert pipeline.tokenize_lyrics("good\nbad") == [261, 4, 103, 2, 3, 98, 2]
+    assert pipeline.lyric_tokenizer.calls == ["good", "bad", "bad"]
+
+
+def test_debug_tokenization_bypasses_the_lyric_caches(make_pipeline):
+    pipeline = lyric_pipeline(make_pipeline)
+
+    pipeline.tokenize_lyrics("la la", debug=True)
+    assert len(pipeline.lyric_cache) == 0 and len(pipeline.lyric_line_cache) == 0
+    pipeline.tokenize_lyrics("la la")
+    pipeline.tokenize_lyrics("la la", debug=True)
+    assert pipeline.lyric_tokenizer.calls == ["la la"] * 3
+
+
+def fake_audio_encoder(pipeline):
+    """Replaces the DCAE encoding of `pipeline`, returning the paths it was called with."""
+    calls = []
+
+    def encode_audio_latents(input_audio_path):
+        calls.append(input_audio_path)
+        return torch.randn(1, 8, 16, 10)
+
+    pipeline.encode_audio_latents = encode_audio_latents
+    return calls
+
+
+def write_audio_file(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_source_latents_are_keyed_by_file_content(make_pipeline, tmp_path):
+    pipeline = make_pipeline()
+    calls = fake_audio_encoder(pipeline)
+    original = write_audio_file(tmp_path / "song.wav", b"song")
+    copy = write_audio_file(tmp_path / "copy.wav", b"song")
+
+    first = pipeline.infer_latents(original)
+    expected = first.clone()
+    first.zero_()
+    torch.testing.assert_close(pipeline.infer_latents(copy), expected)
+    assert calls == [original]
+
+    write_audio_file(tmp_path / "song.wav", b"edited song")
+    pipeline.infer_latents(original)
+    pipeline.dcae_dtype = torch.bfloat16
+    pipeline.infer_latents(copy)
+    assert calls == [original, original, copy]
+
+
+def test_source_latents_are_shared_through_the_disk_cache(make_pipeline, tmp_path):
+    cache_dir = str(tmp_path / "latents")
+    path = write_audio_file(tmp_path / "song.wav", b"song")
+    writer = make_pipeline(latent_cache_dir=cache_dir)
+    fake_audio_encoder(writer)
+    expected = writer.infer_latents(path)
+
+    reader = make_pipeline(latent_cache_dir=cache_dir)
+    calls = fake_audio_encoder(reader)
+    torch.testing.assert_close(reader.infer_latents(path), expected)
+    assert calls == []
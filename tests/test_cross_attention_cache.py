@@ -0,0 +1,21 @@
+import torch
+
+
+@torch.no_grad()
+def test_decode_matches_with_and_without_cross_attention_cache(tiny_transformer, decode_inputs):
+    transformer = tiny_transformer
+    inputs = decode_inputs(transformer)
+    timesteps = [torch.full((2,), t) for t in (900.0, 500.0, 100.0)]
+
+    reference = [transformer.decode(timestep=t, **inputs).sample for t in timesteps]
+
+    processors = [block.cross_attn.processor for block in transformer.transformer_blocks]
+    with transformer.cross_attention_cache():
+        assert all(processor.cross_attention_cache == {} for processor in processors)
+        cached = [transformer.decode(timestep=t, **inputs).sample for t in timesteps]
+        # one entry per block for the single encoder state, reused on later steps
+        assert all(len(processor.cross_attention_cache) == 1 for processor in processors)
+    assert all(processor.cross_attention_cache is None for processor in processors)
+
+    for expected, actual in zip(reference, cached):
+        torch.testing.assert_close(actual, expected)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from acestep.apg_guidance import AdaptiveGuidanceTruncation
+
+
+def predictions(*deltas):
+    """pred_cond and a pred_uncond whose relative distance to it is `deltas[i]` for sample i."""
+    pred_cond = torch.ones(len(deltas), 8, 16, 4)
+    pred_uncond = pred_cond * (1 - torch.tensor(deltas).view(-1, 1, 1, 1))
+    return pred_cond, pred_uncond
+
+
+def run(truncation, deltas):
+    truncated = []
+    for step, delta in enumerate(deltas):
+        truncation.update(step, *predictions(delta))
+        truncated.append(truncation.truncated)
+    return truncated
+
+
+def test_truncates_after_patience_converged_steps_at_the_next_check():
+    truncation = AdaptiveGuidanceTruncation(threshold=0.05, patience=3, check_interval=4)
+    truncated = run(truncation, [0.5, 0.5, 0.01, 0.01, 0.01, 0.01, 0.01, 0.01])
+
+    # converged from step 4 on, read back at step 7
+    assert truncated == [False] * 7 + [True]
+    assert truncation.truncated_at == 8
+    assert [record["delta"] for record in truncation.deltas] == pytest.approx([0.5, 0.5] + [0.01] * 6)
+
+
+def test_converged_steps_must_be_consecutive():
+    truncation = AdaptiveGuidanceTruncation(threshold=0.05, patience=3, check_interval=1)
+    truncated = run(truncation, [0.01, 0.01, 0.5, 0.01, 0.01, 0.01])
+
+    assert truncated == [False] * 5 + [True]
+    assert truncation.truncated_at == 6
+
+
+def test_every_sample_in_the_batch_has_to_converge():
+    truncation = AdaptiveGuidanceTruncation(threshold=0.05, patience=1, check_interval=1)
+    for step in range(4):
+        truncation.update(step, *predictions(0.01, 0.2))
+
+    assert not truncation.truncated
+    assert truncation.deltas[-1]["delta"] == pytest.approx(0.2)
+
+
+def test_summary_reads_back_pending_steps():
+    truncation = AdaptiveGuidanceTruncation(threshold=0.05, patience=1, check_interval=4)
+    run(truncation, [0.01, 0.01])
+    truncation.skip(2)
+
+    summary = truncation.summary()
+    assert [record["step"] for record in summary["deltas"]] == [0, 1]
+    # the steps already ran with guidance, so the summary does not truncate
+    assert summary["truncated_at_step"] is None
+    assert summary["passes_saved"] == 2
@@ -0,0 +1,139 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import Attention
+
+from acestep.models.ace_step_transformer import Qwen2RotaryEmbedding
+from acestep.models.customer_attention_processor import (
+    CustomLiteLAProcessor2_0,
+    RotaryTables,
+)
+
+
+# largest relative error accepted against the baseline, per dtype
+TOLERANCES = {torch.float32: 1e-4, torch.bfloat16: 2e-2}
+# the same against a 240 s latent; bfloat16 only differs by the rounding of the output
+LONG_SEQUENCE_TOLERANCES = {torch.float32: 1e-5, torch.bfloat16: 4e-3}
+
+
+class BaselineLiteLAProcessor:
+    """
+    CustomLiteLAProcessor2_0 before the fused path, reduced to the self-attention the
+    transformer blocks run: complex-pair RoPE, full float32 upcast, values padded with
+    a row of ones and two matmuls.
+    """
+
+    eps = 1e-15
+
+    def apply_rotary_emb(self, x, freqs_cis):
+        cos, sin = freqs_cis
+        cos, sin = cos[None, None].to(x.device), sin[None, None].to(x.device)
+        x_real, x_imag = x.reshape(*x.shape[:-1], -1, 2).unbind(-1)
+        x_rotated = torch.stack([-x_imag, x_real], dim=-1).flatten(3)
+        return (x.float() * cos + x_rotated.float() * sin).to(x.dtype)
+
+    def __call__(self, attn, hidden_states, attention_mask=None, rotary_freqs_cis=None, **kwargs):
+        batch_size = hidden_states.shape[0]
+        dtype = hidden_states.dtype
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        head_dim = key.shape[-1] // attn.heads
+        query = query.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
+        key = key.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1).transpose(-1, -2)
+        value = value.transpose(-1, -2).reshape(batch_size, attn.heads, head_dim, -1)
+        query = query.permute(0, 1, 3, 2)
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+        if rotary_freqs_cis is not None:
+            query = self.apply_rotary_emb(query, rotary_freqs_cis)
+            key = self.apply_rotary_emb(key, rotary_freqs_cis)
+        query = query.permute(0, 1, 3, 2)
+
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, None, :, None].to(key.dtype)
+            query = query * attention_mask.permute(0, 1, 3, 2)
+            key = key * attention_mask
+            value = value * attention_mask.permute(0, 1, 3, 2)
+
+        query, key, value = F.relu(query).float(), F.relu(key).float(), value.float()
+        value = F.pad(value, (0, 0, 0, 1), mode="constant", value=1.0)
+        hidden_states = torch.matmul(torch.matmul(value, key), query)
+        hidden_states = hidden_states[:, :, :-1] / (hidden_states[:, :, -1:] + self.eps)
+        hidden_states = hidden_states.view(batch_size, attn.heads * head_dim, -1).permute(0, 2, 1)
+        hidden_states = attn.to_out[0](hidden_states.to(dtype))
+        return attn.to_out[1](hidden_states), None
+
+
+def relative_error(output, reference):
+    return ((output.float() - reference.float()).norm() / reference.float().norm()).item()
+
+
+def make_attention(heads, head_dim, dtype):
+    return Attention(
+        query_dim=heads * head_dim,
+        dim_head=head_dim,
+        heads=heads,
+        out_dim=heads * head_dim,
+        bias=True,
+        processor=CustomLiteLAProcessor2_0(),
+    ).eval().to(dtype)
+
+
+def rotary_tables(hidden_states, head_dim, seq_len):
+    return Qwen2RotaryEmbedding(head_dim, max_position_embeddings=4096, base=1000000.0)(
+        hidden_states, seq_len=seq_len
+    )
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("masked", [False, True])
+@torch.no_grad()
+def test_fused_linear_attention_matches_baseline(dtype, masked):
+    torch.manual_seed(0)
+    batch_size, seq_len, heads, head_dim = 3, 77, 4, 32
+    attn = make_attention(heads, head_dim, dtype)
+    hidden_states = torch.randn(batch_size, seq_len, heads * head_dim, dtype=dtype)
+    cos, sin = rotary_tables(hidden_states, head_dim, seq_len)
+    mask = torch.ones(batch_size, seq_len, dtype=dtype)
+    if masked:
+        # a different number of padded frames per sample
+        for i in range(batch_size):
+            mask[i, seq_len - 10 * (i + 1):] = 0
+
+    baseline, _ = BaselineLiteLAProcessor()(
+        attn, hidden_states, attention_mask=mask, rotary_freqs_cis=(cos, sin)
+    )
+    fused, _ = attn(
+        hidden_states,
+        # decode passes None for masks without padded frames
+        attention_mask=mask if masked else None,
+        rotary_freqs_cis=RotaryTables.from_freqs(cos, sin),
+    )
+
+    assert fused.dtype == dtype
+    assert relative_error(fused, baseline) <= TOLERANCES[dtype]
+    if masked:
+        # padded frames only carry the output projection bias in both versions
+        padded = mask == 0
+        torch.testing.assert_close(fused[padded], baseline[padded])
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@torch.no_grad()
+def test_fused_linear_attention_matches_baseline_on_long_sequences(dtype):
+    # the K^T V state and its normalizer sum over the whole sequence; kept in
+    # float32 they match the baseline at the latent length of a 240 s song
+    torch.manual_seed(0)
+    seq_len, heads, head_dim = int(240 * 44100 / 512 / 8), 4, 32
+    attn = make_attention(heads, head_dim, dtype)
+    hidden_states = torch.randn(1, seq_len, heads * head_dim, dtype=dtype)
+    cos, sin = rotary_tables(hidden_states, head_dim, seq_len)
+
+    baseline, _ = BaselineLiteLAProcessor()(attn, hidden_states, rotary_freqs_cis=(cos, sin))
+    fused, _ = attn(hidden_states, rotary_freqs_cis=RotaryTables.from_freqs(cos, sin))
+
+    assert relative_error(fused, baseline) <= LONG_SEQUENCE_TOLERANCES[dtype]
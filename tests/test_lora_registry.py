@@ -0,0 +1,92 @@
+import pytest
+import torch
+
+import acestep.lora_registry
+from acestep.lora_registry import LORA_WEIGHTS_NAME, LoRARegistry
+
+
+class FakeLoRAModel:
+    """The adapter API of the transformer that LoRARegistry uses, with 1MB adapters."""
+
+    def __init__(self):
+        self.adapter_weights = {}
+        self.lora_enabled = True
+        self.active_adapters = None
+        self.loaded_paths = []
+
+    def load_lora_adapter(self, path, adapter_name, with_alpha, prefix):
+        self.loaded_paths.append(path)
+        self.adapter_weights[adapter_name] = torch.zeros(256 * 1024)
+
+    def delete_adapters(self, adapter_names):
+        for adapter_name in adapter_names:
+            del self.adapter_weights[adapter_name]
+
+    def disable_lora(self):
+        self.lora_enabled = False
+
+    def enable_lora(self):
+        self.lora_enabled = True
+
+    def named_parameters(self):
+        for adapter_name, weight in self.adapter_weights.items():
+            yield f"transformer_blocks.0.attn.to_q.lora_A.{adapter_name}.weight", weight
+
+
+@pytest.fixture
+def model(monkeypatch):
+    model = FakeLoRAModel()
+
+    def set_weights_and_activate_adapters(model, adapter_names, weights):
+        model.active_adapters = dict(zip(adapter_names, weights))
+
+    monkeypatch.setattr(acestep.lora_registry, "set_weights_and_activate_adapters", set_weights_and_activate_adapters)
+    return model
+
+
+@pytest.fixture
+def lora_dirs(tmp_path):
+    dirs = {}
+    for name in ("a", "b", "c"):
+        (tmp_path / name).mkdir()
+        dirs[name] = str(tmp_path / name)
+    return dirs
+
+
+def test_least_recently_used_adapter_is_evicted(model, lora_dirs):
+    registry = LoRARegistry(model, max_adapters=2)
+    for name in ("a", "b", "a", "c"):
+        registry.activate(lora_dirs[name])
+
+    stats = registry.stats()
+    assert stats["resident"] == [lora_dirs["a"], lora_dirs["c"]]
+    assert stats["loads"] == 3 and stats["evictions"] == 1
+    assert len(model.adapter_weights) == 2
+    assert model.loaded_paths[-1].endswith(LORA_WEIGHTS_NAME)
+
+
+def test_adapters_are_evicted_beyond_the_memory_budget(model, lora_dirs):
+    registry = LoRARegistry(model, max_adapters=4, max_memory_mb=1.5)
+    registry.activate(lora_dirs["a"])
+    registry.activate(lora_dirs["b"])
+
+    stats = registry.stats()
+    assert stats["resident"] == [lora_dirs["b"]]
+    assert stats["resident_memory_mb"] == pytest.approx(1.0)
+
+
+def test_switching_to_none_and_back_does_not_reload(model, lora_dirs):
+    registry = LoRARegistry(model)
+    registry.activate(lora_dirs["a"], 0.5)
+    adapter_name = registry.adapters[lora_dirs["a"]]["adapter_name"]
+    assert model.active_adapters == {adapter_name: 0.5}
+
+    registry.activate("none")
+    assert not model.lora_enabled
+    assert registry.activate("none") == 0.0
+
+    registry.activate(lora_dirs["a"], 0.8)
+    assert model.lora_enabled
+    assert model.active_adapters == {adapter_name: 0.8}
+    assert registry.stats()["loads"] == 1
+    assert registry.stats()["switches"] == 3
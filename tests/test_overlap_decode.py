@@ -0,0 +1,111 @@
+import os
+
+import pytest
+import torch
+from diffusers import AutoencoderDC
+
+from acestep.music_dcae.music_dcae_pipeline import MusicDCAE
+from acestep.music_dcae.music_vocoder import ADaMoSHiFiGANV1
+from benchmarks.tiny_models import TINY_DCAE_CONFIG, TINY_VOCODER_CONFIG
+
+
+@pytest.fixture(scope="module")
+def music_dcae(tmp_path_factory):
+    torch.manual_seed(0)
+    checkpoint_dir = tmp_path_factory.mktemp("checkpoints")
+    AutoencoderDC(**TINY_DCAE_CONFIG).save_pretrained(os.path.join(checkpoint_dir, "music_dcae_f8c8"))
+    ADaMoSHiFiGANV1(**TINY_VOCODER_CONFIG).save_pretrained(os.path.join(checkpoint_dir, "music_vocoder"))
+    return MusicDCAE(
+        dcae_checkpoint_path=os.path.join(checkpoint_dir, "music_dcae_f8c8"),
+        vocoder_checkpoint_path=os.path.join(checkpoint_dir, "music_vocoder"),
+    ).eval()
+
+
+@torch.no_grad()
+def reference_decode_overlap(music_dcae, latent_item):
+    """decode_overlap before the window plan: segments grown with torch.cat, at 44.1kHz."""
+    dcae_win_len_latent = 512
+    dcae_anchor_offset = dcae_win_len_latent // 4
+    dcae_anchor_hop = dcae_win_len_latent // 2
+    dcae_mel_overlap_len = dcae_win_len_latent * 8 // 4
+    vocoder_win_len_audio = 512 * 512
+    vocoder_overlap_len_audio = 1024
+    vocoder_hop_len_audio = vocoder_win_len_audio - 2 * vocoder_overlap_len_audio
+    vocoder_input_mel_frames_per_block = vocoder_win_len_audio // 512
+    crossfade_len_audio = 128
+    cf_win_tail = torch.linspace(1, 0, crossfade_len_audio)[None, None]
+    cf_win_head = torch.linspace(0, 1, crossfade_len_audio)[None, None]
+
+    current_latent = (latent_item / music_dcae.scale_factor + music_dcae.shift_factor).unsqueeze(0)
+    latent_len = current_latent.shape[3]
+    dcae_anchors = list(range(dcae_anchor_offset, latent_len - dcae_anchor_offset, dcae_anchor_hop))
+    if not dcae_anchors:
+        dcae_anchors = [dcae_anchor_offset]
+    mels_segments = []
+    for i, anchor in enumerate(dcae_anchors):
+        win_start_idx = max(0, anchor - dcae_anchor_offset)
+        win_end_idx = min(latent_len, win_start_idx + dcae_win_len_latent)
+        dcae_input_segment = current_latent[:, :, :, win_start_idx:win_end_idx]
+        mel_output_full = music_dcae.dcae.decoder(dcae_input_segment)
+        is_first = i == 0
+        is_last = i == len(dcae_anchors) - 1
+        if is_first and is_last:
+            mel_to_keep = mel_output_full[:, :, :, :dcae_input_segment.shape[3] * 8]
+        elif is_first:
+            mel_to_keep = mel_output_full[:, :, :, :-dcae_mel_overlap_len]
+        elif is_last:
+            mel_to_keep = mel_output_full[:, :, :, dcae_mel_overlap_len:]
+        else:
+            mel_to_keep = mel_output_full[:, :, :, dcae_mel_overlap_len:-dcae_mel_overlap_len]
+        if mel_to_keep.shape[3] > 0:
+            mels_segments.append(mel_to_keep)
+    mels = torch.cat(mels_segments, dim=3)
+    mels = mels * 0.5 + 0.5
+    mels = mels * (music_dcae.max_mel_value - music_dcae.min_mel_value) + music_dcae.min_mel_value
+    mel_total_frames = mels.shape[3]
+
+    def vocode(mel_frame_start):
+        mel_block = mels[0, :, :, mel_frame_start:mel_frame_start + vocoder_input_mel_frames_per_block]
+        pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
+        return music_dcae.vocoder.decode(torch.nn.functional.pad(mel_block, (0, pad_len)))
+
+    current_audio_output = vocode(0)[:, :, :-vocoder_overlap_len_audio]
+    p_audio_samples = vocoder_hop_len_audio
+    total_audio_len = mel_total_frames * 512
+    while p_audio_samples < total_audio_len:
+        new_audio_win = vocode(p_audio_samples // 512)
+        actual_cf_len = min(
+            crossfade_len_audio,
+            current_audio_output.shape[2],
+            new_audio_win.shape[2] - (vocoder_overlap_len_audio - crossfade_len_audio),
+        )
+        tail_part = current_audio_output[:, :, -actual_cf_len:]
+        head_part = new_audio_win[:, :, vocoder_overlap_len_audio - actual_cf_len:vocoder_overlap_len_audio]
+        crossfaded_segment = tail_part * cf_win_tail[:, :, :actual_cf_len] + head_part * cf_win_head[:, :, :actual_cf_len]
+        current_audio_output = torch.cat([current_audio_output[:, :, :-actual_cf_len], crossfaded_segment], dim=2)
+        if p_audio_samples + vocoder_hop_len_audio >= total_audio_len:
+            segment_to_append = new_audio_win[:, :, vocoder_overlap_len_audio:]
+        else:
+            segment_to_append = new_audio_win[:, :, vocoder_overlap_len_audio:-vocoder_overlap_len_audio]
+        current_audio_output = torch.cat([current_audio_output, segment_to_append], dim=2)
+        p_audio_samples += vocoder_hop_len_audio
+    wav = current_audio_output.squeeze(1)
+    return wav[:, :music_dcae._overlap_max_audio_length(latent_item, 44100)]
+
+
+# one DCAE window and one vocoder window; several of each
+@pytest.mark.parametrize("latent_frames", [40, 700])
+@pytest.mark.parametrize("max_window_batch", [1, 8])
+def test_overlap_decode_matches_reference(music_dcae, latent_frames, max_window_batch):
+    torch.manual_seed(1)
+    latents = torch.randn(1, 8, 16, latent_frames)
+
+    reference = reference_decode_overlap(music_dcae, latents[0])
+    sr, wavs = music_dcae.decode_overlap(latents, max_window_batch=max_window_batch)
+    chunks = [chunk for index, chunk in music_dcae.iter_decode_overlap(latents) if index == 0]
+    streamed = torch.cat(chunks, dim=1)
+
+    assert sr == 44100
+    assert wavs[0].shape == reference.shape == streamed.shape
+    torch.testing.assert_close(wavs[0], reference, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(streamed, reference, rtol=1e-4, atol=1e-4)
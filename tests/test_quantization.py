@@ -0,0 +1,106 @@
+import copy
+
+import pytest
+import torch
+from transformers import UMT5Config, UMT5EncoderModel
+
+from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+from acestep.quantization import (
+    TEXT_ENCODER_QUANTIZED_MODULES,
+    TRANSFORMER_QUANTIZED_MODULES,
+    Int8DynamicLinear,
+    load_int8_model,
+    quantize_linear_layers,
+    save_int8_model,
+)
+from benchmarks.tiny_models import TINY_TRANSFORMER_CONFIG, TINY_UMT5_CONFIG, TINY_VOCAB
+
+
+PACKED_ENGINE = next(
+    (
+        engine
+        for engine in ("x86", "fbgemm", "onednn", "qnnpack")
+        if engine in torch.backends.quantized.supported_engines
+    ),
+    None,
+)
+ENGINES = [
+    # "none" makes Int8DynamicLinear dequantize its weights, as on GPUs
+    "none",
+    pytest.param(
+        PACKED_ENGINE,
+        marks=pytest.mark.skipif(PACKED_ENGINE is None, reason="no quantized CPU engine"),
+    ),
+]
+
+
+def round_trip(model, build, modules, path):
+    """The model quantized in memory and the same model saved and loaded again."""
+    quantized = copy.deepcopy(model)
+    quantize_linear_layers(quantized, modules)
+    save_int8_model(quantized, str(path))
+    return quantized, load_int8_model(build, str(path), modules)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@torch.no_grad()
+def test_int8_text_encoder_round_trip(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(torch.backends.quantized, "engine", engine)
+    torch.manual_seed(0)
+    config = UMT5Config(vocab_size=len(TINY_VOCAB), pad_token_id=0, eos_token_id=1, **TINY_UMT5_CONFIG)
+    model = UMT5EncoderModel(config).eval()
+    quantized, loaded = round_trip(
+        model, lambda: UMT5EncoderModel(config), TEXT_ENCODER_QUANTIZED_MODULES, tmp_path / "umt5.safetensors"
+    )
+
+    # the token embedding is shared with the encoder and saved once
+    assert loaded.encoder.embed_tokens.weight is loaded.shared.weight
+    torch.testing.assert_close(loaded.shared.weight, model.shared.weight)
+
+    input_ids = torch.randint(0, len(TINY_VOCAB), (2, 12))
+    attention_mask = torch.ones_like(input_ids)
+    expected = quantized(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    actual = loaded(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    torch.testing.assert_close(actual, expected)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@torch.no_grad()
+def test_int8_transformer_round_trip(engine, tmp_path, monkeypatch, decode_inputs):
+    monkeypatch.setattr(torch.backends.quantized, "engine", engine)
+    torch.manual_seed(0)
+    model = ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG).eval()
+    quantized, loaded = round_trip(
+        model,
+        lambda: ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG),
+        TRANSFORMER_QUANTIZED_MODULES,
+        tmp_path / "transformer.safetensors",
+    )
+
+    inputs = decode_inputs(quantized)
+    timestep = torch.full((2,), 500.0)
+    expected = quantized.decode(timestep=timestep, **inputs).sample
+    actual = loaded.decode(timestep=timestep, **inputs).sample
+    torch.testing.assert_close(actual, expected)
+
+
+def test_int8_layers_keep_float32_scales_and_bias(tmp_path):
+    torch.manual_seed(0)
+    model = ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG).eval()
+    quantize_linear_layers(model, TRANSFORMER_QUANTIZED_MODULES)
+    path = save_int8_model(model, str(tmp_path / "transformer.safetensors"))
+    loaded = load_int8_model(
+        lambda: ACEStepTransformer2DModel(**TINY_TRANSFORMER_CONFIG),
+        path,
+        TRANSFORMER_QUANTIZED_MODULES,
+        dtype=torch.bfloat16,
+    )
+
+    layers = [module for module in loaded.modules() if isinstance(module, Int8DynamicLinear)]
+    assert layers
+    for layer in layers:
+        assert layer.weight.dtype == torch.int8
+        assert layer.weight_scale.dtype == torch.float32
+        assert layer.bias is None or layer.bias.dtype == torch.float32
+    # layers outside the quantized modules follow the requested dtype
+    assert loaded.t_block[1].weight.dtype == torch.bfloat16
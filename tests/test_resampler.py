@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from acestep.music_dcae.resampler import StreamingResampler, resample
+
+
+@pytest.mark.parametrize("new_freq", [48000, 32000, 44100])
+def test_streaming_resampler_matches_one_resample(new_freq):
+    torch.manual_seed(0)
+    audio = torch.randn(2, 44100)
+    resampler = StreamingResampler(44100, new_freq)
+
+    # uneven chunk sizes, some shorter than the context
+    chunks = [resampler(chunk) for chunk in audio.split([100, 5000, 37, 12000, 26963], dim=-1)]
+    tail = resampler.flush()
+    if tail is not None:
+        chunks.append(tail)
+    streamed = torch.cat(chunks, dim=-1)
+
+    expected = resample(audio, 44100, new_freq)
+    assert streamed.shape == expected.shape
+    torch.testing.assert_close(streamed, expected, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,45 @@
+import torch
+
+from acestep.models.step_cache import StepCache
+
+
+def denoise(transformer, inputs, num_steps, step_cache=None):
+    samples = []
+    for i, t in enumerate(torch.linspace(900.0, 100.0, num_steps)):
+        if step_cache is not None:
+            step_cache.begin_step(i, num_steps)
+        samples.append(transformer.decode(timestep=t.expand(2), **inputs).sample)
+    return samples
+
+
+@torch.no_grad()
+def test_step_cache_hits_between_warmup_cooldown_and_forced_refreshes(tiny_transformer, decode_inputs):
+    transformer = tiny_transformer
+    inputs = decode_inputs(transformer)
+    # every call that may skip the blocks does
+    step_cache = StepCache(threshold=float("inf"), warmup_steps=2, cooldown_steps=1, max_consecutive_hits=2)
+
+    with transformer.step_cache(step_cache):
+        denoise(transformer, inputs, num_steps=8, step_cache=step_cache)
+
+    summary = step_cache.summary()
+    # steps 0-1 warm up, 4 follows two hits in a row and 7 cools down
+    assert summary["calls"] == 8
+    assert summary["hits"] == 4
+    assert summary["hit_steps"] == [2, 3, 5, 6]
+    assert all(isinstance(record["change"], (float, type(None))) for record in summary["steps"])
+
+
+@torch.no_grad()
+def test_step_cache_without_threshold_matches_uncached_decode(tiny_transformer, decode_inputs):
+    transformer = tiny_transformer
+    inputs = decode_inputs(transformer)
+
+    reference = denoise(transformer, inputs, num_steps=6)
+    step_cache = StepCache(threshold=0.0, warmup_steps=1, cooldown_steps=1)
+    with transformer.step_cache(step_cache):
+        cached = denoise(transformer, inputs, num_steps=6, step_cache=step_cache)
+
+    assert step_cache.summary()["hits"] == 0
+    for expected, actual in zip(reference, cached):
+        torch.testing.assert_close(actual, expected)
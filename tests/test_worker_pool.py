@@ -0,0 +1,127 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+
+from acestep.worker_pool import PipelineWorker, PipelineWorkerPool, QueueFullError
+
+
+class FakePipeline:
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.calls = []
+
+    def ensure_loaded(self):
+        pass
+
+    def __call__(self, **params):
+        self.calls.append(params)
+        return [params["save_path"], params]
+
+
+def test_full_queue_raises_queue_full_error():
+    worker = PipelineWorker(FakePipeline, max_queue_size=1).start()
+    worker.wait_until_ready()
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_job(pipeline):
+        started.set()
+        release.wait()
+
+    try:
+        running = worker.submit(blocking_job)
+        started.wait()
+        queued = worker.submit(lambda pipeline: pipeline.device_id)
+        with pytest.raises(QueueFullError):
+            worker.submit(lambda pipeline: pipeline.device_id)
+    finally:
+        release.set()
+    assert queued.result(timeout=5) == 0
+    assert running.result(timeout=5) is None
+    worker.stop(timeout=5)
+
+
+def test_jobs_go_to_the_least_loaded_ready_worker():
+    pool = PipelineWorkerPool(FakePipeline, device_ids=(0, 1)).start()
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_job(pipeline):
+        started.set()
+        return release.wait()
+
+    try:
+        busy = pool.submit(blocking_job, device_id=0)
+        started.wait()
+        assert pool.submit(lambda pipeline: pipeline.device_id).result(timeout=5) == 1
+        with pytest.raises(ValueError):
+            pool.submit(lambda pipeline: None, device_id=2)
+    finally:
+        release.set()
+    assert busy.result(timeout=5)
+    pool.stop(timeout=5)
+
+
+def test_worker_that_failed_to_load_rejects_jobs():
+    def factory(device_id):
+        raise RuntimeError("no checkpoint")
+
+    worker = PipelineWorker(factory).start()
+    with pytest.raises(RuntimeError, match="failed to load"):
+        worker.wait_until_ready(timeout=5)
+    with pytest.raises(RuntimeError, match="not available"):
+        worker.submit(lambda pipeline: None)
+
+
+@pytest.fixture
+def infer_api(monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "infer-api.py")
+    spec = importlib.util.spec_from_file_location("infer_api", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    pool = PipelineWorkerPool(FakePipeline).start()
+    monkeypatch.setattr(module, "worker_pool", pool)
+    monkeypatch.setattr(module, "pool_config", {"checkpoint_path": "/checkpoints", "bf16": True, "torch_compile": False})
+    yield module
+    pool.stop(timeout=5)
+
+
+REQUEST = dict(
+    audio_duration=10.0,
+    prompt="pop",
+    lyrics="[verse]\nla la",
+    infer_step=10,
+    guidance_scale=15.0,
+    scheduler_type="euler",
+    cfg_type="apg",
+    omega_scale=10.0,
+    actual_seeds=[1],
+    guidance_interval=0.5,
+    guidance_interval_decay=0.0,
+    min_guidance_scale=3.0,
+    use_erg_tag=True,
+    use_erg_lyric=True,
+    use_erg_diffusion=True,
+    oss_steps=[],
+)
+
+
+def test_generate_rejects_requests_for_another_model_configuration(infer_api):
+    from fastapi.testclient import TestClient
+
+    client = TestClient(infer_api.app)
+    response = client.post("/generate", json=dict(REQUEST, bf16=False))
+    assert response.status_code == 400
+    assert "bf16=False" in response.json()["detail"]
+
+    # repeating the server configuration is accepted
+    response = client.post(
+        "/generate", json=dict(REQUEST, checkpoint_path="/checkpoints", bf16=True, output_path="out.wav")
+    )
+    assert response.status_code == 200
+    assert response.json()["output_path"] == "out.wav"
+    pipeline = infer_api.worker_pool.workers[0].pipeline
+    assert [call["save_path"] for call in pipeline.calls] == ["out.wav"]